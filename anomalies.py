@@ -0,0 +1,179 @@
+# anomalies.py
+
+"""Streaming error-spike detection per (endpoint, country).
+
+Ingestion feeds every processed chunk to a SpikeDetector. The detector keeps
+a ring of the last SPIKE_HISTORY_WINDOWS event-time windows of request and
+error counts per key, so each event costs one slot update. Windows that
+fall out of the ring are folded into an exponentially weighted mean and
+variance of the error rate. That baseline is finished over the ring when
+anomalies are listed, so events arriving out of order within the ring are
+still counted in the right window.
+
+A key is flagged while its latest window's error rate exceeds the baseline
+by SPIKE_THRESHOLD standard deviations.
+"""
+
+import math
+import os
+import threading
+from datetime import datetime, timezone
+
+from metrics import inc as inc_metric
+
+SPIKE_WINDOW_SECONDS = int(os.environ.get("SPIKE_WINDOW_SECONDS", "3600"))
+SPIKE_HISTORY_WINDOWS = int(os.environ.get("SPIKE_HISTORY_WINDOWS", "48"))
+SPIKE_ALPHA = float(os.environ.get("SPIKE_ALPHA", "0.1"))
+SPIKE_THRESHOLD = float(os.environ.get("SPIKE_THRESHOLD", "3"))
+# Statuses at or above this count as errors (404 and 500 by default)
+SPIKE_ERROR_MIN_STATUS = int(os.environ.get("SPIKE_ERROR_MIN_STATUS", "400"))
+SPIKE_MIN_ERRORS = 5
+SPIKE_MIN_BASELINE_WINDOWS = 5
+# Keeps a perfectly steady baseline from flagging every small wobble
+SPIKE_STD_FLOOR = 0.02
+# Only keys whose latest window is this close to the newest data are active
+SPIKE_ACTIVE_WINDOWS = 2
+
+def _ewm_update(mean, var, value, alpha=SPIKE_ALPHA):
+    """One step of an exponentially weighted mean and variance."""
+    if mean is None:
+        return value, 0.0
+    diff = value - mean
+    increment = alpha * diff
+    return mean + increment, (1 - alpha) * (var + diff * increment)
+
+class _Series:
+    """Ring of [window, requests, errors] slots plus the folded baseline."""
+
+    __slots__ = ("latest", "slots", "mean", "var", "folded")
+
+    def __init__(self, size):
+        self.latest = None
+        self.slots = [None] * size
+        self.mean = None
+        self.var = 0.0
+        self.folded = 0
+
+    def fold(self, slot):
+        self.mean, self.var = _ewm_update(self.mean, self.var, slot[2] / slot[1])
+        self.folded += 1
+
+class SpikeDetector:
+    """Rolling per-(endpoint, country) request and error counts."""
+
+    stage = "spike_detection"
+
+    def __init__(self, window_seconds=SPIKE_WINDOW_SECONDS, history=SPIKE_HISTORY_WINDOWS):
+        self.window_seconds = window_seconds
+        self.history = history
+        self.latest = None
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Pickled by ingestd.py into the ingest state (see ingest_state.py)
+        with self._lock:
+            state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, country, window, requests, errors):
+        """Count requests and errors for one key in window (an int window index)."""
+        series = self._series.get((endpoint, country))
+        if series is None:
+            series = self._series[(endpoint, country)] = _Series(self.history)
+
+        size = self.history
+        if series.latest is None or window > series.latest:
+            if series.latest is not None:
+                # Fold the windows that fall out of the ring, oldest first
+                for w in range(series.latest - size + 1, min(series.latest, window - size) + 1):
+                    slot = series.slots[w % size]
+                    if slot is not None and slot[0] == w:
+                        series.fold(slot)
+                        series.slots[w % size] = None
+            series.latest = window
+            if self.latest is None or window > self.latest:
+                self.latest = window
+        elif window <= series.latest - size:
+            inc_metric("spike_detector_late_requests", requests)
+            return
+
+        slot = series.slots[window % size]
+        if slot is None or slot[0] != window:
+            slot = series.slots[window % size] = [window, 0, 0]
+        slot[1] += requests
+        slot[2] += errors
+
+    def observe_frame(self, df):
+        """Feed a chunk of processed log rows.
+
+        The chunk is first reduced to counts per (window, endpoint, country),
+        then each count is added in window order.
+        """
+        import pandas as pd
+        if df.empty:
+            return
+        counts = pd.DataFrame({
+            'window': (df['datetime'] - pd.Timestamp(0)) // pd.Timedelta(seconds=self.window_seconds),
+            'endpoint': df['endpoint'],
+            'country': df['plotly_country'],
+            'requests': 1,
+            'errors': (df['status'] >= SPIKE_ERROR_MIN_STATUS).astype('int64'),
+        }).groupby(['window', 'endpoint', 'country'], observed=True)[['requests', 'errors']].sum()
+        with self._lock:
+            for (window, endpoint, country), requests, errors in zip(
+                    counts.index, counts['requests'].tolist(), counts['errors'].tolist()):
+                self.add(endpoint, country, int(window), requests, errors)
+
+    def _window_start(self, window):
+        return datetime.fromtimestamp(window * self.window_seconds, tz=timezone.utc).replace(tzinfo=None)
+
+    def anomalies(self):
+        """Active spikes, highest score first, as plain dicts."""
+        found = []
+        with self._lock:
+            if self.latest is None:
+                return found
+            for (endpoint, country), series in self._series.items():
+                if series.latest < self.latest - SPIKE_ACTIVE_WINDOWS + 1:
+                    continue
+                current = series.slots[series.latest % self.history]
+                if current is None or current[2] < SPIKE_MIN_ERRORS:
+                    continue
+                # Finish the baseline over the windows still in the ring
+                mean, var, windows = series.mean, series.var, series.folded
+                for slot in sorted(s for s in series.slots if s is not None and s is not current):
+                    mean, var = _ewm_update(mean, var, slot[2] / slot[1])
+                    windows += 1
+                if windows < SPIKE_MIN_BASELINE_WINDOWS:
+                    continue
+                rate = current[2] / current[1]
+                score = (rate - mean) / max(math.sqrt(var), SPIKE_STD_FLOOR)
+                if score >= SPIKE_THRESHOLD:
+                    found.append({
+                        'endpoint': endpoint,
+                        'country': country,
+                        'window_start': self._window_start(current[0]),
+                        'requests': int(current[1]),
+                        'errors': int(current[2]),
+                        'error_rate': rate,
+                        'baseline_rate': mean,
+                        'score': score,
+                    })
+        return sorted(found, key=lambda a: a['score'], reverse=True)
+
+_detector = SpikeDetector()
+
+def get_detector():
+    """The process's detector, fed each new row once (see utils.observe_log)."""
+    return _detector
+
+def publish(detector):
+    """Make detector the one the dashboard reads from."""
+    global _detector
+    _detector = detector
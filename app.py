@@ -1,26 +1,91 @@
 # app.py
 
+import time
+_import_started = time.perf_counter()
+
 import dash
 from dash import Dash, dcc, html, Input, Output, State, callback, no_update, dash_table
 import dash_bootstrap_components as dbc
+from flask import jsonify
 from pages import home, analytics
 import os
-import pandas as pd
-from utils import process_logs
+import threading
+from partitions import LOG_PATH, is_partitioned, start_compactor
+from manifest import current as current_version
+
+# "eager" warms up before the app is importable, "background" serves the
+# layout immediately and warms up in a daemon thread.
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "eager")
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "120"))
+# How often to check for a newly published log version (e.g. from
+# ingestd.py) and process it in the background, off the request path;
+# 0 leaves it to the first callback that reads the log
+DATA_REFRESH_SECONDS = float(os.environ.get("DATA_REFRESH_SECONDS", "5"))
+
+_warmup_done = threading.Event()
+_warmup_state = {"ready": False, "error": None, "rows": 0, "seconds": None}
 
 def ensure_data_loaded():
     """Ensure log data exists and is valid"""
     os.makedirs("data", exist_ok=True)
     
-    # Check if data needs to be regenerated
-    if not os.path.exists("data/server_logs.csv"):
+    # Check if data needs to be regenerated; workers racing here each
+    # publish a complete version, so readers never see a partial file
+    if not os.path.exists(current_version(LOG_PATH)[1]):
         print("Generating fresh log data...")
         from log_generator import generate_logs
-        generate_logs(num_entries=5000, output_file="data/server_logs.csv", refresh=True)
+        generate_logs(num_entries=5000, output_file=LOG_PATH, refresh=True)
     else:
         print("Using existing log data")
+    if is_partitioned(LOG_PATH):
+        start_compactor(LOG_PATH)
+
+def warm_up():
+    """Create the log file if needed, import heavy modules and prime the log cache"""
+    started = time.perf_counter()
+    try:
+        ensure_data_loaded()
+        import plotly.express  # noqa: F401 - first import is the slow part
+        from utils import get_dashboard_logs
+        _warmup_state["rows"] = len(get_dashboard_logs())
+    except Exception as e:
+        print(f"Warm-up error: {e}")
+        _warmup_state["error"] = str(e)
+    finally:
+        _warmup_state["seconds"] = round(time.perf_counter() - started, 3)
+        _warmup_state["ready"] = _warmup_state["error"] is None
+        _warmup_done.set()
+        print(f"Warm-up finished in {_warmup_state['seconds']}s")
 
-ensure_data_loaded()
+if STARTUP_MODE == "background":
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+else:
+    warm_up()
+
+def refresh_data():
+    """Bring the dashboard's data up to date whenever a new version of the log is published.
+
+    Only rows appended since the loaded version are processed (see
+    utils.log_sources).
+    """
+    _warmup_done.wait()
+    seen = current_version(LOG_PATH)[0]
+    while True:
+        time.sleep(DATA_REFRESH_SECONDS)
+        version = current_version(LOG_PATH)[0]
+        if version == seen:
+            continue
+        try:
+            from utils import get_dashboard_logs
+            started = time.perf_counter()
+            rows = len(get_dashboard_logs())
+            print(f"Loaded log version {version} ({rows} rows) in {time.perf_counter() - started:.2f}s")
+            seen = version
+        except Exception as e:
+            print(f"Error refreshing log data: {e}")
+
+if DATA_REFRESH_SECONDS > 0:
+    threading.Thread(target=refresh_data, name="data-refresh", daemon=True).start()
 
 # Initialize the app
 app = Dash(
@@ -32,6 +97,9 @@ app = Dash(
     meta_tags=[{'name': 'viewport', 'content': 'width=device-width, initial-scale=1'}]
 )
 
+# WSGI entry point, e.g. gunicorn app:server
+server = app.server
+
 # Data store for sharing data across pages
 data_store = dcc.Store(id='data-store')
 
@@ -71,8 +139,10 @@ app.layout = html.Div(
     Input('url', 'pathname')
 )
 def load_data(pathname):
-    df = process_logs()
-    return df.to_dict('records')
+    # In background mode the layout is served before warm-up completes
+    _warmup_done.wait(timeout=WARMUP_TIMEOUT)
+    from payloads import dashboard_store
+    return dashboard_store()
 
 
 # Page Routing
@@ -88,6 +158,38 @@ def display_page(pathname):
     else:
         return html.Div("404 Page Not Found", key="not-found")
 
+# Answer page-load callbacks from the newest precompute.py snapshot when
+# there is one (wrapped first so the metrics below count served responses)
+import precompute
+precompute.serve_snapshots(app)
+
+# Warn about (and count) responses over their payload budget
+import payloads
+payloads.enforce_budgets(app)
+
+# Opt-in cProfile capture of slow callbacks, listed on /admin/slow-requests
+import profiling
+profiling.profile_callbacks(app)
+profiling.register_route(app.server)
+
+# Per-callback latency/payload metrics on /metrics (covers pages/* too,
+# since their callbacks are registered on import above)
+import metrics
+metrics.instrument_callbacks(app)
+metrics.register_route(app.server)
+
+# Gzip JSON responses, the data-store above all
+payloads.register_compression(app.server)
+
+# Readiness probe: 200 once data is loaded, 503 while warming up
+@app.server.route("/ready")
+def ready():
+    body = dict(_warmup_state, startup_mode=STARTUP_MODE, import_seconds=IMPORT_SECONDS)
+    return jsonify(body), (200 if _warmup_state["ready"] else 503)
+
+IMPORT_SECONDS = round(time.perf_counter() - _import_started, 3)
+print(f"App imported in {IMPORT_SECONDS}s (startup mode: {STARTUP_MODE})")
+
 # Run the app
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,141 @@
+// Clientside aggregation for the User Distribution tab.
+// Used when the app runs with CLIENTSIDE_AGGREGATION=1: the server sends the
+// demographic cube from utils.get_demographic_cube once per data change and
+// dropdown changes are handled here without a server round trip.
+
+(function () {
+    var PLASMA = ['#0d0887', '#46039f', '#7201a8', '#9c179e', '#bd3786',
+                  '#d8576b', '#ed7953', '#fb9f3a', '#fdca26', '#f0f921'];
+    var PASTEL = ['rgb(102, 197, 204)', 'rgb(246, 207, 113)', 'rgb(248, 156, 116)',
+                  'rgb(220, 176, 242)', 'rgb(135, 197, 95)', 'rgb(158, 185, 243)',
+                  'rgb(254, 136, 177)', 'rgb(201, 219, 116)', 'rgb(139, 224, 164)',
+                  'rgb(180, 151, 231)', 'rgb(179, 179, 179)'];
+    var BASE_LAYOUT = {
+        paper_bgcolor: 'var(--card-bg)',
+        plot_bgcolor: 'var(--card-bg)',
+        font: {color: 'var(--text-color)'},
+        margin: {t: 40, b: 20}
+    };
+
+    function decode(b64, dtype) {
+        var binary = atob(b64);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        if (dtype === 'uint8') {
+            return bytes;
+        }
+        if (dtype === 'uint16') {
+            return new Uint16Array(bytes.buffer);
+        }
+        return new Uint32Array(bytes.buffer);
+    }
+
+    // Decoding is done once per cube, not once per dropdown change
+    var decodedCube = null;
+    var decoded = null;
+
+    function columns(cube) {
+        if (cube !== decodedCube) {
+            var dims = {};
+            Object.keys(cube.dimensions).forEach(function (name) {
+                var dim = cube.dimensions[name];
+                dims[name] = {labels: dim.labels, codes: decode(dim.codes, dim.dtype)};
+            });
+            decoded = {dimensions: dims, counts: decode(cube.counts, 'uint32')};
+            decodedCube = cube;
+        }
+        return decoded;
+    }
+
+    function layout(extra) {
+        return Object.assign({}, BASE_LAYOUT, extra);
+    }
+
+    function updateChart(demographicType, countries, cube) {
+        if (!cube || !cube.length) {
+            return {data: [], layout: layout({})};
+        }
+        var cols = columns(cube);
+        var dim = cols.dimensions[demographicType] || cols.dimensions.user_role;
+        var countryDim = cols.dimensions.plotly_country;
+
+        var allowed = null;
+        if (countries && countries.length) {
+            allowed = new Uint8Array(countryDim.labels.length);
+            countries.forEach(function (country) {
+                var index = countryDim.labels.indexOf(country);
+                if (index >= 0) {
+                    allowed[index] = 1;
+                }
+            });
+        }
+
+        var sums = new Float64Array(dim.labels.length);
+        var total = 0;
+        for (var i = 0; i < cube.length; i++) {
+            if (allowed && !allowed[countryDim.codes[i]]) {
+                continue;
+            }
+            sums[dim.codes[i]] += cols.counts[i];
+            total += cols.counts[i];
+        }
+        if (!total) {
+            return {data: [], layout: layout({})};
+        }
+
+        // Same ordering as value_counts(): most common first
+        var order = [];
+        for (var j = 0; j < sums.length; j++) {
+            if (sums[j] > 0) {
+                order.push(j);
+            }
+        }
+        order.sort(function (a, b) { return sums[b] - sums[a]; });
+        var labels = order.map(function (k) { return dim.labels[k]; });
+        var values = order.map(function (k) { return sums[k]; });
+
+        if (demographicType === 'age_group') {
+            var traces = labels.map(function (label, k) {
+                return {
+                    type: 'bar',
+                    name: label,
+                    legendgroup: label,
+                    x: [label],
+                    y: [values[k]],
+                    text: [values[k]],
+                    textposition: 'auto',
+                    marker: {color: PLASMA[k % PLASMA.length]},
+                    hovertemplate: 'age_group=' + label + '<br>Number of Users=%{y}<extra></extra>'
+                };
+            });
+            return {
+                data: traces,
+                layout: layout({
+                    title: {text: 'Age Group Distribution'},
+                    barmode: 'relative',
+                    legend: {title: {text: 'age_group'}, tracegroupgap: 0},
+                    xaxis: {title: {text: 'age_group'}, categoryorder: 'array', categoryarray: labels},
+                    yaxis: {title: {text: 'Number of Users'}}
+                })
+            };
+        }
+
+        return {
+            data: [{
+                type: 'pie',
+                labels: labels,
+                values: values,
+                hole: 0.3,
+                marker: {colors: labels.map(function (label, k) { return PASTEL[k % PASTEL.length]; })},
+                hovertemplate: 'user_role=%{label}<br>count=%{value}<extra></extra>'
+            }],
+            layout: layout({title: {text: 'User Role Distribution'}, legend: {tracegroupgap: 0}})
+        };
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        demographics: {update_chart: updateChart}
+    });
+})();
@@ -0,0 +1,225 @@
+# cache.py
+
+"""Memoization of the utils query helpers, keyed by dataset version.
+
+Results are keyed by (dataset version, function name, normalized arguments).
+Frames and stores handed out by utils are registered with a version string
+derived from the log file they were built from, so a changed log can never
+be served stale results. Arguments without a registered version (e.g. a
+frame rebuilt from the browser's data-store) are not cached.
+
+The process-local tier is an LRU bounded by CACHE_MAX_BYTES. With CACHE_DIR
+set, results are also pickled there so other gunicorn workers can reuse
+them. CACHE_TTL_SECONDS expires entries in both tiers (0 means never).
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from metrics import record_cache, set_cache_size
+
+CACHE_MAX_BYTES = int(float(os.environ.get("CACHE_MAX_MB", "64")) * 1024 * 1024)
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "0"))
+CACHE_DIR = os.environ.get("CACHE_DIR", "")
+CACHE_DISK_MAX_BYTES = int(float(os.environ.get("CACHE_DISK_MAX_MB", "256")) * 1024 * 1024)
+
+# id(obj) -> (weak reference, version). Frames cannot be dict keys, and a
+# version attached through DataFrame.attrs would leak into filtered copies.
+_versions = {}
+# Re-entrant: a weakref callback can run from garbage collection while held
+_versions_lock = threading.RLock()
+
+def register_version(obj, version):
+    """Declare that obj holds the data identified by version."""
+    with _versions_lock:
+        key = id(obj)
+        _versions[key] = (weakref.ref(obj, lambda _: _forget(key)), version)
+    return obj
+
+def _forget(key):
+    with _versions_lock:
+        entry = _versions.get(key)
+        if entry is not None and entry[0]() is None:
+            del _versions[key]
+
+def version_of(obj):
+    """Registered version of obj, or None."""
+    entry = _versions.get(id(obj))
+    if entry is not None and entry[0]() is obj:
+        return entry[1]
+    return None
+
+def _sizeof(value):
+    if hasattr(value, "memory_usage"):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum() if hasattr(usage, "sum") else usage)
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+def _copy(value):
+    # Cached frames are shared, so callers get their own copy to modify
+    return value.copy() if hasattr(value, "copy") else value
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by the total size of its values."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size, stored at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl and time.time() - entry[2] > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time())
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+            set_cache_size(self.bytes, len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            set_cache_size(0, 0)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+class DiskCache:
+    """Pickled results in a directory shared between worker processes."""
+
+    def __init__(self, directory, max_bytes=CACHE_DISK_MAX_BYTES, ttl=CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def put(self, key, value):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written under a temporary name so readers never see half a file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+            self._prune()
+        except Exception as e:
+            print(f"Could not write cache entry {key}: {e}")
+
+    def _prune(self):
+        """Delete the least recently written entries beyond max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pkl"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+memory_cache = LRUCache()
+disk_cache = DiskCache(CACHE_DIR) if CACHE_DIR else None
+
+def _normalize(value):
+    """Hashable, process-independent form of an argument, or raise KeyError."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    version = version_of(value)
+    if version is None:
+        raise KeyError("unversioned argument")
+    return ("dataset", version)
+
+def memoize(func):
+    """Cache func's results per dataset version and normalized arguments."""
+    signature = inspect.signature(func)
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not CACHE_MAX_BYTES and disk_cache is None:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        try:
+            key = repr((name, tuple((k, _normalize(v)) for k, v in bound.arguments.items())))
+        except KeyError:
+            record_cache(name, "bypass")
+            return func(*args, **kwargs)
+
+        value = memory_cache.get(key)
+        if value is not None:
+            record_cache(name, "hit")
+            return _copy(value)
+
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        if disk_cache is not None:
+            value = disk_cache.get(digest)
+            if value is not None:
+                record_cache(name, "disk_hit")
+                memory_cache.put(key, value, _sizeof(value))
+                return _copy(value)
+
+        record_cache(name, "miss")
+        value = func(*args, **kwargs)
+        memory_cache.put(key, value, _sizeof(value))
+        if disk_cache is not None:
+            disk_cache.put(digest, value)
+        return _copy(value)
+
+    return wrapper
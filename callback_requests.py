@@ -0,0 +1,38 @@
+# callback_requests.py
+
+"""Request bodies for Dash's /_dash-update-component endpoint.
+
+Shared by precompute.py, which replays the default calls through the app's
+test client, and loadtest.py, which replays them against gunicorn. Both
+build bodies from the callback descriptions on /_dash-dependencies.
+"""
+
+def split_outputs(output):
+    """Parse a callback output id such as "..a.figure...b.data.." into (id, prop) pairs."""
+    if output.startswith(".."):
+        parts = output[2:-2].split("...")
+    else:
+        parts = [output]
+    return [tuple(part.rsplit(".", 1)) for part in parts]
+
+def update_body(dependency, values, changed=None):
+    """Body calling dependency with values keyed by "id.prop".
+
+    changed lists the "id.prop" inputs that triggered the call; by default
+    all of them, as on a page load.
+    """
+    def prop(p):
+        return {"id": p["id"], "property": p["property"],
+                "value": values.get(f"{p['id']}.{p['property']}")}
+
+    outputs = [{"id": id_, "property": property_} for id_, property_ in split_outputs(dependency["output"])]
+    inputs = [prop(p) for p in dependency["inputs"]]
+    if changed is None:
+        changed = [f"{p['id']}.{p['property']}" for p in inputs]
+    return {
+        "output": dependency["output"],
+        "outputs": outputs if dependency["output"].startswith("..") else outputs[0],
+        "inputs": inputs,
+        "state": [prop(p) for p in dependency.get("state", [])],
+        "changedPropIds": changed,
+    }
@@ -0,0 +1,239 @@
+# figures.py
+
+"""Shared inputs and cheap construction for the dashboard's figures.
+
+- store_frame() turns data-store contents into a DataFrame once per
+  data-store version rather than once per callback. The frame is
+  registered with a dataset version derived from it, so the memoized utils
+  helpers (e.g. get_dimension_counts) compute each aggregate once per data
+  version for all callbacks.
+- bar_figure() and pie_figure() build figure dicts in the shape Plotly
+  Express produces for the same call, without Express's data munging and
+  graph_objects validation. That takes a few hundred microseconds instead
+  of tens of milliseconds. Numeric columns are sent as base64 typed arrays,
+  as go.Figure would encode them. Set FIGURE_VALIDATE=1 to validate the
+  figures anyway through go.Figure, e.g. while changing a builder.
+- build_figures() runs independent figure builders concurrently on a
+  shared pool of FIGURE_WORKERS threads. Builders run outside the Flask
+  request context.
+"""
+
+import base64
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import register_version
+
+FIGURE_WORKERS = int(os.environ.get("FIGURE_WORKERS", "4"))
+FIGURE_VALIDATE = os.environ.get("FIGURE_VALIDATE", "0") == "1"
+# Distinct data-store contents whose frames are kept
+STORE_FRAMES = 2
+
+_frames = OrderedDict()  # data-store version or contents digest -> frame
+_frames_lock = threading.Lock()
+
+def _digest(data):
+    try:
+        import orjson
+        text = orjson.dumps(data)
+    except ImportError:
+        text = json.dumps(data, separators=(",", ":")).encode()
+    return hashlib.blake2b(text, digest_size=16).hexdigest()
+
+def _cached_frame(key):
+    with _frames_lock:
+        df = _frames.get(key)
+        if df is not None:
+            _frames.move_to_end(key)
+        return df
+
+def _keep_frame(key, records):
+    import pandas as pd
+    df = register_version(pd.DataFrame(records), f"store:{key}")
+    with _frames_lock:
+        _frames[key] = df
+        while len(_frames) > STORE_FRAMES:
+            _frames.popitem(last=False)
+    return df
+
+def keep_store_frame(version, records):
+    """Record the frame of a data-store this process built (see payloads.store_records)."""
+    if _cached_frame(version) is None:
+        _keep_frame(version, records)
+
+def store_frame(data):
+    """data-store contents as a DataFrame shared by every caller with the same contents.
+
+    Only versions this process builds itself are trusted, so a browser
+    cannot pass off other records under them. Anything else, e.g. contents
+    from before the log changed, is keyed by a digest of the records.
+    The frame must not be modified; use assign() or copy() for derived columns.
+    """
+    import payloads
+    version = data["version"]
+    df = _cached_frame(version)
+    if df is None and version == payloads.dashboard_store_version():
+        # Loaded by another worker; building it here registers the frame
+        payloads.dashboard_store()
+        df = _cached_frame(version)
+    if df is None:
+        key = f"contents:{_digest(data['records'])}"
+        df = _cached_frame(key)
+        if df is None:
+            df = _keep_frame(key, data["records"])
+    return df
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=FIGURE_WORKERS, thread_name_prefix="figures")
+        return _pool
+
+def build_figures(*builders):
+    """Call the argument-less builders concurrently; returns their results in order."""
+    if FIGURE_WORKERS <= 1 or len(builders) < 2:
+        return [build() for build in builders]
+    futures = [_executor().submit(build) for build in builders[1:]]
+    # The calling thread builds the first one itself
+    first = builders[0]()
+    return [first] + [future.result() for future in futures]
+
+@functools.lru_cache(maxsize=None)
+def _template():
+    import plotly.io as pio
+    return pio.templates[pio.templates.default].to_plotly_json()
+
+def _merge(base, updates):
+    """base with updates merged in, recursing into nested dicts."""
+    merged = dict(base)
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = _merge(merged[key], value)
+        merged[key] = value
+    return merged
+
+def _figure(data, layout, updates):
+    figure = {"data": data, "layout": _merge(layout, updates or {})}
+    if FIGURE_VALIDATE:
+        import plotly.graph_objects as go
+        return go.Figure(figure)
+    return figure
+
+# numpy dtype -> plotly.js typed array type
+TYPED_ARRAY_TYPES = {"int8": "i1", "uint8": "u1", "int16": "i2", "uint16": "u2",
+                     "int32": "i4", "uint32": "u4", "float32": "f4", "float64": "f8"}
+
+@functools.lru_cache(maxsize=None)
+def _typed_arrays():
+    """Whether the bundled plotly.js decodes typed array specs (plotly 6 on)."""
+    import plotly
+    return int(plotly.__version__.split(".")[0]) >= 6
+
+def _narrow(array):
+    """64-bit integers as the smallest type holding them; plotly.js has no 64-bit arrays."""
+    import numpy as np
+    if array.dtype.kind not in "iu" or array.dtype.itemsize != 8:
+        return array
+    if array.dtype.kind == "i":
+        candidates = (np.int8, np.int16, np.int32)
+    else:
+        candidates = (np.uint8, np.uint16, np.uint32)
+    low, high = array.min(), array.max()
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return array.astype(dtype)
+    return array
+
+def _array(values):
+    """A column as trace data: a base64 typed array spec when numeric, else a list."""
+    import numpy as np
+    array = np.asarray(values)
+    if array.size and array.dtype.kind in "iuf" and _typed_arrays():
+        array = _narrow(array)
+        dtype = TYPED_ARRAY_TYPES.get(array.dtype.name)
+        if dtype is not None:
+            # plotly.js reads the bytes as little-endian
+            array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+            spec = {"dtype": dtype, "bdata": base64.b64encode(array.tobytes()).decode("ascii")}
+            if array.ndim > 1:
+                spec["shape"] = ", ".join(str(n) for n in array.shape)
+            return spec
+    return array.tolist()
+
+def _hover(*parts):
+    return "<br>".join(parts) + "<extra></extra>"
+
+def bar_figure(frame, x, y, color=None, title=None, labels=None, colors=None,
+               barmode="relative", layout=None):
+    """px.bar(frame, x=x, y=y, color=color, ...) as a figure dict; layout holds update_layout values."""
+    labels = labels or {}
+    label = lambda col: labels.get(col, col)
+    colors = colors or _template()["layout"]["colorway"]
+    groups = [(None, frame)] if color is None else frame.groupby(color, sort=False, observed=True)
+    traces = []
+    for i, (value, group) in enumerate(groups):
+        trace = {
+            "type": "bar",
+            "x": _array(group[x]),
+            "y": _array(group[y]),
+            "orientation": "v",
+            "alignmentgroup": "True",
+            "textposition": "auto",
+            "xaxis": "x",
+            "yaxis": "y",
+            "marker": {"color": colors[i % len(colors)], "pattern": {"shape": ""}},
+        }
+        hover = [f"{label(x)}=%{{x}}", f"{label(y)}=%{{y}}"]
+        if color is None:
+            trace.update(name="", showlegend=False, legendgroup="", offsetgroup="")
+        else:
+            name = str(value)
+            trace.update(name=name, showlegend=True, legendgroup=name, offsetgroup=name)
+            hover.insert(0, f"{label(color)}={name}")
+        trace["hovertemplate"] = _hover(*hover)
+        traces.append(trace)
+    return _figure(traces, {
+        "template": _template(),
+        "title": {"text": title},
+        "barmode": barmode,
+        "xaxis": {"anchor": "y", "domain": [0.0, 1.0], "title": {"text": label(x)}},
+        "yaxis": {"anchor": "x", "domain": [0.0, 1.0], "title": {"text": label(y)}},
+        "legend": {"title": {"text": label(color) if color else None}, "tracegroupgap": 0},
+        "margin": {"t": 60},
+    }, layout)
+
+def pie_figure(frame, names, values, title=None, labels=None, colors=None, hole=None, layout=None):
+    """px.pie(frame, names=names, values=values, ...) as a figure dict; layout holds update_layout values."""
+    labels = labels or {}
+    trace = {
+        "type": "pie",
+        "labels": _array(frame[names]),
+        "values": _array(frame[values]),
+        "domain": {"x": [0.0, 1.0], "y": [0.0, 1.0]},
+        "name": "",
+        "legendgroup": "",
+        "showlegend": True,
+        "hovertemplate": _hover(f"{labels.get(names, names)}=%{{label}}",
+                                f"{labels.get(values, values)}=%{{value}}"),
+    }
+    if hole is not None:
+        trace["hole"] = hole
+    base = {
+        "template": _template(),
+        "title": {"text": title},
+        "legend": {"tracegroupgap": 0},
+        "margin": {"t": 60},
+    }
+    if colors:
+        base["piecolorway"] = list(colors)
+    return _figure([trace], base, layout)
@@ -0,0 +1,58 @@
+# ingest_state.py
+
+"""Running results ingestd.py publishes for the web app.
+
+ingestd.py feeds each batch it stores to the log's SpikeDetector and
+SessionTracker, and in aggregate mode folds it into the log's aggregate (see
+utils.aggregate_logs). It then writes them to INGEST_STATE_FILE with the log
+position they cover (see utils.log_sources). For a newly published version
+the app adopts them instead of reading the log, and only processes the rows
+after that position when the state lags behind.
+
+The file is replaced atomically, and readers only unpickle it again when
+its mtime or size changes.
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+
+import manifest
+
+INGEST_STATE_FILE = os.environ.get("INGEST_STATE_FILE", "data/ingest_state.pkl")
+
+def save(state, path=INGEST_STATE_FILE):
+    """Atomically replace the state at path with the dict state."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    manifest.make_readable(tmp_path)
+    os.replace(tmp_path, path)
+
+# path -> (stat signature, state)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def load(path=INGEST_STATE_FILE):
+    """The state last saved to path, or None."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _loaded_lock:
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        print(f"Ignoring unreadable ingest state {path}: {e}")
+        return None
+    with _loaded_lock:
+        _loaded[path] = (signature, state)
+    return state
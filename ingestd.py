@@ -0,0 +1,457 @@
+# ingestd.py
+
+"""Standalone ingestion daemon that tails appended log files.
+
+    python ingestd.py [--watch data/incoming] [--pattern "*.csv"] [--once]
+
+Watches INGEST_WATCH_DIR for files matching INGEST_PATTERN (CSV logs in the
+server_logs.csv format, e.g. one per web server) and moves their new lines
+into the dashboard's log at LOG_PATH:
+
+- The reader task polls the files and reads new bytes in whole-line batches
+  of up to INGEST_BATCH_BYTES. It parses and validates them with the
+  loaders' own code. A rotated file (a new inode under the same name) is
+  read to its end before the new one is opened. A truncated file is read
+  again from the top.
+- Parsed batches go through a queue of INGEST_QUEUE_BATCHES. When the
+  writer falls behind, the reader waits, so memory stays bounded.
+- The writer task takes everything queued at once and appends the valid
+  lines to the log storage, which publishes a new version (see
+  manifest.py) for the app to pick up. With LOG_BACKEND=sqlite it appends
+  the same rows to the SQLite store (see storage.py). It then checkpoints
+  each file's offset to INGEST_CHECKPOINT_FILE. Rejected rows are appended
+  to INGEST_QUARANTINE_FILE and flushed before the checkpoint.
+- The writer also feeds each stored batch to the log's SpikeDetector and
+  SessionTracker, and with INGEST_MODE=aggregate folds it into the log's
+  running aggregate (see utils.aggregate_logs). They are saved with the log
+  position they cover (see ingest_state.py), so the app adopts them instead
+  of re-reading the log. On startup a saved state of the same log is
+  continued; otherwise the whole log is read once to build it.
+
+Offsets only advance once a batch is stored, so a restart resumes where the
+last run stopped. Only the batch being stored during a crash can be stored
+twice. On SIGINT or SIGTERM the reader stops, the writer drains the queue,
+and the offsets are checkpointed before exit. Every INGEST_REPORT_SECONDS the
+daemon prints throughput and lag: bytes not yet stored, queued batches, and
+the delay from read to publish.
+
+With a single-file log each publish appends a segment (see
+manifest.append_segment) rather than copying the log.
+"""
+
+import asyncio
+import fnmatch
+import json
+import os
+import signal
+import tempfile
+import time
+
+import anomalies
+import ingest_state
+import manifest
+import sessions
+import utils
+from partitions import LOG_HEADER, LOG_PATH, PartitionWriter, is_partitioned
+
+INGEST_WATCH_DIR = os.environ.get("INGEST_WATCH_DIR", "data/incoming")
+INGEST_PATTERN = os.environ.get("INGEST_PATTERN", "*.csv")
+INGEST_BATCH_BYTES = int(os.environ.get("INGEST_BATCH_BYTES", str(4 << 20)))
+INGEST_QUEUE_BATCHES = int(os.environ.get("INGEST_QUEUE_BATCHES", "8"))
+INGEST_POLL_SECONDS = float(os.environ.get("INGEST_POLL_SECONDS", "1"))
+INGEST_REPORT_SECONDS = float(os.environ.get("INGEST_REPORT_SECONDS", "10"))
+INGEST_CHECKPOINT_FILE = os.environ.get("INGEST_CHECKPOINT_FILE", "data/ingest_offsets.json")
+INGEST_QUARANTINE_FILE = os.environ.get("INGEST_QUARANTINE_FILE", "data/ingest_quarantine.csv")
+
+class Tail:
+    """Read position in one watched file: its inode, byte offset and line number."""
+
+    def __init__(self, path, inode=None, offset=0, line=1):
+        self.path = path
+        self.inode = inode
+        self.offset = offset
+        self.line = line
+        self.columns = None
+        self.file = None
+
+    def state(self):
+        return {"inode": self.inode, "offset": self.offset, "line": self.line}
+
+    def _open(self):
+        """Open the file at the current offset; False until its header is complete."""
+        f = open(self.path, "rb")
+        stat = os.fstat(f.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            if self.inode is not None:
+                print(f"{self.path} was rotated or truncated, reading it from the top")
+            self.inode, self.offset, self.line = stat.st_ino, 0, 1
+        header = f.readline()
+        if not header.endswith(b"\n"):
+            f.close()
+            return False
+        self.columns = header.decode("utf-8", "replace").strip().split(",")
+        missing = [col for col in utils.REQUIRED_COLUMNS if col not in self.columns]
+        if missing:
+            f.close()
+            raise utils.LogFormatError(f"{self.path} is missing required columns: {missing}")
+        if self.offset == 0:
+            self.offset, self.line = len(header), 2
+        f.seek(self.offset)
+        self.file = f
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _read_lines(self, max_bytes):
+        data = self.file.read(max_bytes)
+        cut = data.rfind(b"\n") + 1
+        if cut == 0 and len(data) == max_bytes:
+            # One line longer than a batch
+            data += self.file.readline()
+            cut = data.rfind(b"\n") + 1
+        # A partly written last line is left for the next read
+        self.file.seek(self.offset + cut)
+        return data[:cut]
+
+    def read(self, max_bytes):
+        """(first line number, block of whole new lines), or None when there are none."""
+        if self.file is None and not self._open():
+            return None
+        block = self._read_lines(max_bytes)
+        if not block:
+            # At the end of the open file; switch if the name now points
+            # elsewhere or the file shrank
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                # Rotated away and not recreated yet
+                return None
+            if stat.st_ino == self.inode and stat.st_size >= self.offset:
+                return None
+            self.close()
+            if not self._open():
+                return None
+            block = self._read_lines(max_bytes)
+            if not block:
+                return None
+        first = self.line
+        self.offset += len(block)
+        self.line += block.count(b"\n")
+        return first, block
+
+class Batch:
+    """Parsed new lines of one file, and the file position after them."""
+
+    def __init__(self, path, position, lines, rows, bad_lines, invalid, size):
+        self.path = path
+        self.position = position
+        self.lines = lines
+        self.rows = rows
+        self.bad_lines = bad_lines
+        self.invalid = invalid
+        self.size = size
+        self.read_at = time.monotonic()
+
+def parse_batch(tail, first, block):
+    """Validate and enrich a block of tail's lines into a Batch."""
+    rows, bad_lines = utils.parse_log_block(block, tail.columns, first)
+    valid, invalid = utils.validate_rows(rows)
+    raw = block.split(b"\n")
+    # Stored lines follow the log's own column order
+    order = None if tail.columns == LOG_HEADER else [tail.columns.index(col) for col in LOG_HEADER]
+    lines = []
+    for number in valid.index:
+        line = raw[number - first].rstrip(b"\r")
+        if order is not None:
+            fields = line.split(b",")
+            line = b",".join(fields[i] for i in order)
+        lines.append(line)
+    return Batch(tail.path, tail.state(), lines, utils.enrich_logs(valid),
+                 bad_lines, invalid, len(block))
+
+def store_lines(log_path, lines):
+    """Append raw log lines to the log at log_path as a new version; returns its id."""
+    if is_partitioned(log_path):
+        PartitionWriter(log_path).write_lines(lines)
+        return manifest.current(log_path)[0]
+    return manifest.append_segment(log_path, LOG_HEADER, lines)
+
+def load_checkpoint(path=INGEST_CHECKPOINT_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"Ignoring unreadable ingest checkpoint {path}: {e}")
+        return {}
+
+def save_checkpoint(offsets, path=INGEST_CHECKPOINT_FILE):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(offsets, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+class IngestDaemon:
+    """Reader and writer tasks joined by a bounded queue; see the module docstring."""
+
+    def __init__(self, watch_dir=INGEST_WATCH_DIR, pattern=INGEST_PATTERN, log_path=LOG_PATH,
+                 batch_bytes=INGEST_BATCH_BYTES, queue_batches=INGEST_QUEUE_BATCHES,
+                 poll_seconds=INGEST_POLL_SECONDS, report_seconds=INGEST_REPORT_SECONDS,
+                 checkpoint_file=INGEST_CHECKPOINT_FILE, quarantine_file=INGEST_QUARANTINE_FILE):
+        self.watch_dir = watch_dir
+        self.pattern = pattern
+        self.log_path = log_path
+        self.batch_bytes = batch_bytes
+        self.queue_batches = queue_batches
+        self.poll_seconds = poll_seconds
+        self.report_seconds = report_seconds
+        self.checkpoint_file = checkpoint_file
+        self.quarantine_file = quarantine_file
+        # Stored positions; the tails run ahead of them by what is queued
+        self.offsets = load_checkpoint(checkpoint_file)
+        self.tails = {path: Tail(path, **state) for path, state in self.offsets.items()}
+        self.failed = {}
+        self.aggregating = utils.INGEST_MODE == "aggregate"
+        # Fed every row of the log once, like the running aggregate when
+        # aggregating; position is the log_sources() position they cover
+        self.detector, self.tracker = anomalies.SpikeDetector(), sessions.SessionTracker()
+        self.aggregate = self.position = None
+        self.quarantine = None
+        self.lines = self.bytes = self.rejected = self.versions = 0
+        self.latency = None
+
+    def _watched(self):
+        try:
+            names = sorted(os.listdir(self.watch_dir))
+        except FileNotFoundError:
+            names = []
+        for name in fnmatch.filter(names, self.pattern):
+            path = os.path.join(self.watch_dir, name)
+            if os.path.isfile(path) and path not in self.tails:
+                self.tails[path] = Tail(path)
+        return list(self.tails.values())
+
+    def _next_batch(self, tail):
+        try:
+            read = tail.read(self.batch_bytes)
+        except FileNotFoundError:
+            return None
+        except utils.LogFormatError as e:
+            if self.failed.get(tail.path) != tail.inode:
+                print(f"Skipping {tail.path}: {e}")
+                self.failed[tail.path] = tail.inode
+            return None
+        return None if read is None else parse_batch(tail, *read)
+
+    def _save_state(self):
+        """Publish the detector, tracker and aggregate with the log position they cover."""
+        if self.position is not None:
+            ingest_state.save({"log": os.path.abspath(self.log_path), "freq": utils.AGGREGATE_TIME_FREQ,
+                               "position": self.position, "detector": self.detector,
+                               "tracker": self.tracker, "aggregate": self.aggregate})
+
+    def _scan(self, sources):
+        """Feed the rows at sources to the detector and tracker; returns their aggregate when aggregating."""
+        observers = (self.detector, self.tracker)
+        # Rows rejected here were already quarantined when they were read
+        if self.aggregating:
+            return utils.aggregate_logs(self.log_path, sources=sources, resume=True,
+                                        quarantine_file=None, observers=observers)
+        for _ in utils.iter_processed_chunks(self.log_path, sources=sources, observers=observers):
+            pass
+        return None
+
+    def _extend(self, added, position):
+        if self.aggregating:
+            self.aggregate = utils.merge_aggregates([self.aggregate, added])
+        self.position = position
+        self._save_state()
+
+    def resume_state(self):
+        """Continue the saved state of the log, or build it from the whole log."""
+        state = ingest_state.load()
+        if (state is not None and state.get("log") == os.path.abspath(self.log_path) and "detector" in state
+                and (not self.aggregating or (state.get("freq") == utils.AGGREGATE_TIME_FREQ
+                                              and state.get("aggregate") is not None))):
+            try:
+                sources, position = utils.log_sources(self.log_path, since=state["position"])
+            except FileNotFoundError:
+                sources = None
+            if sources is not None:
+                self.detector, self.tracker = state["detector"], state["tracker"]
+                self.aggregate = state["aggregate"] if self.aggregating else None
+                self.position = state["position"]
+                # Rows published since the state was saved, e.g. by a run
+                # that stopped before saving it
+                self._extend(self._scan(sources), position)
+                print(f"Continuing the state of {self.log_path} at version {position['version']}")
+                return
+        self._scan_all()
+
+    def _scan_all(self):
+        self.detector, self.tracker = anomalies.SpikeDetector(), sessions.SessionTracker()
+        self.aggregate = utils.merge_aggregates([]) if self.aggregating else None
+        try:
+            sources, position = utils.log_sources(self.log_path)
+            added = self._scan(sources)
+        except FileNotFoundError:
+            # No log yet; the first batch stored starts it
+            self.position = None
+            return
+        self._extend(added, position)
+
+    def _advance(self, lines, rows):
+        """Bring the state up to date after storing lines, parsed as rows."""
+        if self.position is None:
+            self._scan_all()
+            return
+        sources, position = utils.log_sources(self.log_path, since=self.position)
+        if sources is None:
+            print(f"{self.log_path} was rewritten, reading it in full")
+            self._scan_all()
+            return
+        if utils.position_rows(position) - utils.position_rows(self.position) == len(lines):
+            self.detector.observe_frame(rows)
+            self.tracker.observe_frame(rows)
+            added = utils.aggregate_rows(rows) if self.aggregating else None
+        else:
+            # Another writer published rows too; read everything new
+            added = self._scan(sources)
+        self._extend(added, position)
+
+    def _apply(self, batches):
+        lines = [line for batch in batches for line in batch.lines]
+        if lines:
+            import pandas as pd
+            version = store_lines(self.log_path, lines)
+            self.versions += 1
+            print(f"Published {len(lines)} new log rows as version {version} of {self.log_path}")
+            rows = pd.concat([batch.rows for batch in batches], ignore_index=True)
+            store = utils.get_store()
+            if store is not None:
+                utils.append_to_store(store, rows, version, self.log_path)
+            self._advance(lines, rows)
+        rejected = 0
+        for batch in batches:
+            if batch.bad_lines or not batch.invalid.empty:
+                if self.quarantine is None:
+                    self.quarantine = utils.Quarantine(self.quarantine_file, append=True)
+                self.quarantine.add_lines(batch.bad_lines)
+                self.quarantine.add_rows(batch.invalid)
+                rejected += len(batch.bad_lines) + len(batch.invalid)
+            self.offsets[batch.path] = batch.position
+            self.bytes += batch.size
+        if rejected:
+            # Before the checkpoint, so a restart never skips rejected rows
+            self.quarantine.flush()
+            self.rejected += rejected
+        self.lines += len(lines)
+        self.latency = time.monotonic() - min(batch.read_at for batch in batches)
+        save_checkpoint(self.offsets, self.checkpoint_file)
+
+    async def _read(self, queue, stop, once):
+        while not stop.is_set():
+            idle = True
+            for tail in self._watched():
+                batch = await asyncio.to_thread(self._next_batch, tail)
+                if batch is not None:
+                    idle = False
+                    # Waits while the writer is behind
+                    await queue.put(batch)
+                if stop.is_set():
+                    break
+            if idle:
+                if once:
+                    break
+                try:
+                    await asyncio.wait_for(stop.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        await queue.put(None)
+
+    async def _write(self, queue):
+        done = False
+        while not done:
+            batches = [await queue.get()]
+            while not queue.empty():
+                batches.append(queue.get_nowait())
+            if batches[-1] is None:
+                done = True
+                batches.pop()
+            if batches:
+                await asyncio.to_thread(self._apply, batches)
+
+    def report(self, queue, elapsed):
+        behind = 0
+        for path, tail in self.tails.items():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            stored = self.offsets.get(path, {})
+            behind += size - stored.get("offset", 0) if stored.get("inode") == tail.inode else size
+        latency = "-" if self.latency is None else f"{self.latency:.2f}s"
+        print(f"Ingested {self.lines} rows ({self.lines / elapsed:.0f} rows/s, "
+              f"{self.bytes / elapsed / 1e6:.2f} MB/s) in {self.versions} versions, "
+              f"{self.rejected} rejected; {behind / 1e6:.2f} MB behind, "
+              f"{queue.qsize()}/{self.queue_batches} batches queued, read-to-publish {latency}; "
+              f"{len(self.detector.anomalies())} active error spikes")
+
+    async def _report(self, queue, started):
+        while True:
+            await asyncio.sleep(self.report_seconds)
+            self.report(queue, time.monotonic() - started)
+
+    async def run(self, once=False):
+        """Ingest until stopped by a signal, or with once=True until the files are read."""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+
+        await asyncio.to_thread(self.resume_state)
+        started = time.monotonic()
+        queue = asyncio.Queue(maxsize=self.queue_batches)
+        reader = asyncio.create_task(self._read(queue, stop, once))
+        reporter = asyncio.create_task(self._report(queue, started))
+        try:
+            # The reader ends the writer by queueing None
+            await self._write(queue)
+        finally:
+            reader.cancel()
+            reporter.cancel()
+            for tail in self.tails.values():
+                tail.close()
+            if self.quarantine is not None:
+                self.quarantine.close()
+        self.report(queue, time.monotonic() - started)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Tail log files into the dashboard's log")
+    parser.add_argument("--watch", default=INGEST_WATCH_DIR, help="Directory of log files to tail")
+    parser.add_argument("--pattern", default=INGEST_PATTERN, help="File name pattern to tail")
+    parser.add_argument("--log", default=LOG_PATH, help="Log to publish into")
+    parser.add_argument("--batch-bytes", type=int, default=INGEST_BATCH_BYTES)
+    parser.add_argument("--queue-batches", type=int, default=INGEST_QUEUE_BATCHES)
+    parser.add_argument("--poll", type=float, default=INGEST_POLL_SECONDS, help="Seconds between polls")
+    parser.add_argument("--report", type=float, default=INGEST_REPORT_SECONDS, help="Seconds between reports")
+    parser.add_argument("--checkpoint", default=INGEST_CHECKPOINT_FILE)
+    parser.add_argument("--once", action="store_true", help="Exit once every file is read")
+    args = parser.parse_args()
+    daemon = IngestDaemon(args.watch, args.pattern, args.log, args.batch_bytes, args.queue_batches,
+                          args.poll, args.report, args.checkpoint)
+    print(f"Ingesting {os.path.join(args.watch, args.pattern)} into {args.log}")
+    asyncio.run(daemon.run(once=args.once))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+# loadtest.py
+
+"""Replay dashboard callbacks against the app running under gunicorn.
+
+For every dataset size, a log of that many rows is generated with
+log_generator. The app is then started under gunicorn once per worker and
+thread combination. Concurrent simulated clients replay
+``/_dash-update-component`` requests for the callbacks behind ``/`` and
+``/analytics``:
+- page loads
+- map click drilldown
+- dropdown changes
+- exports
+
+Request bodies are synthesized from ``/_dash-dependencies`` and the real
+data-store contents, so each carries what a browser would send. To replay
+requests recorded from a browser instead, pass ``--payloads`` with a JSON
+lines file of ``{"name": ..., "body": ...}`` objects. Their bodies can be
+copied from the devtools network tab.
+
+Tab switches on the analytics page are handled by dbc.Tabs in the browser
+and reach the server only as the page-load callbacks replayed here.
+
+Example:
+    python loadtest.py --sizes 5000,50000 --workers 1,2,4 --threads 4 --clients 16
+
+The report lists throughput plus p50/p95/p99 latency per callback, and the
+peak RSS of the gunicorn workers (read from /proc, so Linux only).
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from callback_requests import split_outputs, update_body
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PLACEHOLDER = "__DATA_STORE__"
+READY_TIMEOUT = 600
+RSS_SAMPLE_SECONDS = 0.5
+
+# (name, output, triggering input, variants of input values)
+HOME_STEPS = [
+    ("load_data", "data-store.data", "url.pathname", [{"url.pathname": "/"}]),
+    ("display_page", "page-content.children", "url.pathname", [{"url.pathname": "/"}]),
+    ("update_map", "world-map.figure", "data-store.data", [{}]),
+    ("map_click_drilldown", "drilldown-modal.is_open", "world-map.clickData", [
+        {"world-map.clickData": {"points": [{"location": iso3}]}}
+        for iso3 in ("USA", "JPN", "DEU", "BRA", "IND")
+    ]),
+    # selected-country holds Plotly names, as set by map_click_drilldown
+    ("drilldown_charts", "country-request-types.figure", "selected-country.data", [
+        {"selected-country.data": country}
+        for country in ("United States of America", "Japan", "Germany", "Brazil", "India")
+    ]),
+    ("export_country", "download-country-data.data", "export-drilldown-btn.n_clicks", [
+        {"export-drilldown-btn.n_clicks": 1, "selected-country.data": "Japan"}
+    ]),
+    ("export_all", "download-all-data.data", "export-all-btn.n_clicks", [
+        {"export-all-btn.n_clicks": 1}
+    ]),
+]
+
+ANALYTICS_STEPS = [
+    ("display_page", "page-content.children", "url.pathname", [{"url.pathname": "/analytics"}]),
+    ("country_filter", "country-filter-demographic.options", "data-store.data", [{}]),
+    ("request_pie", "request-pie.figure", "data-store.data", [{}]),
+    ("request_trends", "request-trends.figure", "data-store.data", [{}]),
+    ("demographic_chart", "demographic-chart.figure", "demographic-type.value", [
+        {"demographic-type.value": kind, "country-filter-demographic.value": countries}
+        for kind in ("age_group", "user_role")
+        for countries in (None, ["Japan", "Germany"])
+    ]),
+    ("demographic_cube", "demographic-cube.data", "data-store.data", [{}]),
+    ("crossfilter", "crossfilter-chart.figure", "crossfilter-x.value", [
+        {"crossfilter-x.value": x, "crossfilter-y.value": y}
+        for x in ("age_group", "user_role", "plotly_country")
+        for y in ("request_type", "status")
+    ]),
+    ("stats_table", "stats-table-container.children", "stats-groupby.value", [
+        {"stats-groupby.value": group}
+        for group in ("overall", "plotly_country", "age_group", "user_role")
+    ]),
+    ("error_spikes", "error-spikes-container.children", "error-spikes-interval.n_intervals", [
+        {"error-spikes-interval.n_intervals": 1}
+    ]),
+    ("export_analytics", "download-analytics.data", "export-analytics-btn.n_clicks", [
+        {"export-analytics-btn.n_clicks": 1}
+    ]),
+]
+
+def _request(conn, method, path, body_parts=None):
+    """Send a request over a keep-alive connection and return (status, body)."""
+    conn.putrequest(method, path)
+    if body_parts is not None:
+        conn.putheader("Content-Type", "application/json")
+        conn.putheader("Content-Length", str(sum(len(p) for p in body_parts)))
+    conn.endheaders()
+    for part in body_parts or ():
+        conn.send(part)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+class Payload:
+    """A callback request body, split around the data-store value."""
+
+    def __init__(self, name, body):
+        self.name = name
+        text = json.dumps(body)
+        marker = json.dumps(DATA_PLACEHOLDER)
+        self.parts = [part.encode("utf-8") for part in text.split(marker)]
+
+    def body(self, data_json):
+        parts = [self.parts[0]]
+        for part in self.parts[1:]:
+            parts += [data_json, part]
+        return parts
+
+def synthesize_payloads(host, port):
+    """Build the replayed sessions from the running app.
+
+    Returns (sessions, data_json): sessions maps a page to its Payload list,
+    and data_json is the serialized data-store each payload embeds.
+    """
+    conn = http.client.HTTPConnection(host, port, timeout=READY_TIMEOUT)
+    status, body = _request(conn, "GET", "/_dash-dependencies")
+    if status != 200:
+        raise RuntimeError(f"/_dash-dependencies returned {status}")
+    dependencies = {}
+    for dependency in json.loads(body):
+        if dependency.get("clientside_function"):
+            continue
+        for id_, property_ in split_outputs(dependency["output"]):
+            dependencies[f"{id_}.{property_}"] = dependency
+
+    load = update_body(dependencies["data-store.data"], {"url.pathname": "/"}, ["url.pathname"])
+    status, body = _request(conn, "POST", "/_dash-update-component", [json.dumps(load).encode("utf-8")])
+    if status != 200:
+        raise RuntimeError(f"load_data returned {status}")
+    data = json.loads(body)["response"]["data-store"]["data"]
+    data_json = json.dumps(data).encode("utf-8")
+    conn.close()
+
+    sessions = {}
+    for page, steps in (("/", HOME_STEPS), ("/analytics", ANALYTICS_STEPS)):
+        payloads = []
+        for name, output, trigger, variants in steps:
+            dependency = dependencies.get(output)
+            if dependency is None:
+                # e.g. demographic_chart when CLIENTSIDE_AGGREGATION=1
+                continue
+            for variant in variants:
+                values = {"data-store.data": DATA_PLACEHOLDER, "url.pathname": page}
+                values.update(variant)
+                payloads.append(Payload(name, update_body(dependency, values, [trigger])))
+        sessions[page] = payloads
+    return sessions, data_json
+
+def load_recorded_payloads(path):
+    """Read recorded {"name", "body"} JSON lines into a single session."""
+    payloads = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                payloads.append(Payload(entry["name"], entry["body"]))
+    return {"recorded": payloads}, b"null"
+
+def _worker_pids(master_pid):
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+class RSSMonitor(threading.Thread):
+    """Sample the RSS of gunicorn's workers and keep the peaks."""
+
+    def __init__(self, master_pid):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.peak_per_worker = 0
+        self.peak_total = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            sizes = [_rss_bytes(pid) for pid in _worker_pids(self.master_pid)]
+            if sizes:
+                self.peak_per_worker = max(self.peak_per_worker, max(sizes))
+                self.peak_total = max(self.peak_total, sum(sizes))
+            self._stop_event.wait(RSS_SAMPLE_SECONDS)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def _client(host, port, payloads, data_json, deadline, offset, results, lock):
+    """Replay payloads in order, starting at offset, until the deadline."""
+    conn = http.client.HTTPConnection(host, port, timeout=120)
+    timings = []
+    for payload in itertools.islice(itertools.cycle(payloads), offset, None):
+        if time.perf_counter() >= deadline:
+            break
+        started = time.perf_counter()
+        try:
+            status, body = _request(conn, "POST", "/_dash-update-component", payload.body(data_json))
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=120)
+            status, body = None, b""
+        timings.append((payload.name, time.perf_counter() - started, status, len(body)))
+    conn.close()
+    with lock:
+        results.extend(timings)
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(results, elapsed):
+    """Per-callback counts, errors, latency percentiles (ms) and mean response size."""
+    by_name = {}
+    for name, seconds, status, size in results:
+        by_name.setdefault(name, []).append((seconds, status, size))
+    summary = {}
+    for name, rows in sorted(by_name.items()):
+        latencies = sorted(seconds * 1000 for seconds, _, _ in rows)
+        summary[name] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, status, _ in rows if status is None or status >= 400),
+            "p50_ms": round(_percentile(latencies, 0.50), 1),
+            "p95_ms": round(_percentile(latencies, 0.95), 1),
+            "p99_ms": round(_percentile(latencies, 0.99), 1),
+            "response_kb": round(sum(size for _, _, size in rows) / len(rows) / 1024, 1),
+        }
+    return {
+        "requests": len(results),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "callbacks": summary,
+    }
+
+def _wait_ready(host, port, process):
+    deadline = time.time() + READY_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            status, _ = _request(conn, "GET", "/ready")
+            conn.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("app did not become ready")
+
+def start_gunicorn(workdir, port, workers, threads):
+    """Start gunicorn serving app:server with workdir as the data directory.
+
+    Not with --preload: app.py starts its warm-up, data-refresh and
+    compactor threads on import, and those would not survive the fork.
+    """
+    command = [sys.executable, "-m", "gunicorn", "--pythonpath", REPO_DIR,
+               "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+               "--threads", str(threads), "--timeout", str(READY_TIMEOUT),
+               "--log-level", "warning"]
+    command.append("app:server")
+    log = open(os.path.join(workdir, "gunicorn.log"), "w")
+    return subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+
+def stop_gunicorn(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def prepare_dataset(root, size):
+    """Directory whose data/server_logs.csv holds size generated rows."""
+    from log_generator import generate_logs
+    from manifest import read_manifest
+    workdir = os.path.join(root, f"rows-{size}")
+    log_file = os.path.join(workdir, "data", "server_logs.csv")
+    if read_manifest(log_file) is None:
+        print(f"Generating {size} log rows in {log_file}")
+        generate_logs(size, output_file=log_file, refresh=True)
+    return workdir
+
+def run(size, workdir, workers, threads, args):
+    """One gunicorn configuration against one dataset; returns the summary dict."""
+    host, port = "127.0.0.1", args.port
+    process = start_gunicorn(workdir, port, workers, threads)
+    try:
+        _wait_ready(host, port, process)
+        if args.payloads:
+            sessions, data_json = load_recorded_payloads(args.payloads)
+        else:
+            sessions, data_json = synthesize_payloads(host, port)
+
+        monitor = RSSMonitor(process.pid)
+        monitor.start()
+        results, lock = [], threading.Lock()
+        pages = list(sessions.values())
+        started = time.perf_counter()
+        deadline = started + args.duration
+        clients = []
+        for i in range(args.clients):
+            payloads = pages[i % len(pages)]
+            client = threading.Thread(target=_client, args=(
+                host, port, payloads, data_json, deadline,
+                random.randrange(len(payloads)), results, lock))
+            client.start()
+            clients.append(client)
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - started
+        monitor.stop()
+    finally:
+        stop_gunicorn(process)
+
+    summary = summarize(results, elapsed)
+    summary.update({
+        "rows": size,
+        "workers": workers,
+        "threads": threads,
+        "clients": args.clients,
+        "data_store_kb": round(len(data_json) / 1024, 1),
+        "peak_worker_rss_mb": round(monitor.peak_per_worker / 2**20, 1),
+        "peak_total_rss_mb": round(monitor.peak_total / 2**20, 1),
+    })
+    return summary
+
+def print_report(summary):
+    print()
+    print(f"rows={summary['rows']} workers={summary['workers']} threads={summary['threads']} "
+          f"clients={summary['clients']}: {summary['requests']} requests, "
+          f"{summary['throughput_rps']} req/s, data-store {summary['data_store_kb']} KB, "
+          f"peak RSS {summary['peak_worker_rss_mb']} MB/worker "
+          f"({summary['peak_total_rss_mb']} MB total)")
+    print(f"  {'callback':<22}{'n':>7}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'resp KB':>10}")
+    for name, row in summary["callbacks"].items():
+        print(f"  {name:<22}{row['requests']:>7}{row['errors']:>6}{row['p50_ms']:>10}"
+              f"{row['p95_ms']:>10}{row['p99_ms']:>10}{row['response_kb']:>10}")
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the dashboard under gunicorn.")
+    parser.add_argument("--sizes", type=_int_list, default=[5000, 50000],
+                        help="comma-separated log sizes in rows")
+    parser.add_argument("--workers", type=_int_list, default=[2],
+                        help="comma-separated gunicorn worker counts")
+    parser.add_argument("--threads", type=_int_list, default=[4],
+                        help="comma-separated gunicorn thread counts")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent simulated clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per configuration")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--payloads", help="JSON lines of recorded callback requests to replay")
+    parser.add_argument("--workdir", help="where generated logs are kept (default: a temp dir)")
+    parser.add_argument("--json", dest="json_path", help="also write all summaries to this file")
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix="dash-loadtest-")
+    summaries = []
+    try:
+        for size in args.sizes:
+            workdir = prepare_dataset(root, size)
+            for workers, threads in itertools.product(args.workers, args.threads):
+                try:
+                    summary = run(size, workdir, workers, threads, args)
+                except RuntimeError as e:
+                    print(f"rows={size} workers={workers} threads={threads} failed: {e} "
+                          f"(see {os.path.join(workdir, 'gunicorn.log')})")
+                    continue
+                print_report(summary)
+                summaries.append(summary)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(summaries, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ from datetime import datetime, timedelta
 import csv
 import ipaddress
 import os
-import pandas as pd
 
 # List of possible endpoints
 endpoints = [
@@ -91,29 +90,49 @@ def generate_log_entry():
     return [time_str, ip, "GET", endpoint, status, country, user_role, age_group]
 
 def generate_logs(num_entries=1000, output_file="data/server_logs.csv", refresh=False):
-    """Generate log entries and save to CSV with refresh option"""
+    """Generate log entries and save to CSV with refresh option
+
+    output_file may also be a partition root (see partitions.py), in which
+    case each entry is appended to the partition of its date.
+    """
+    from partitions import is_partitioned
+    from manifest import new_version
+    if is_partitioned(output_file):
+        return _generate_partitioned(num_entries, output_file, refresh)
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
-    mode = 'w' if refresh else 'a'
-    header = refresh or not os.path.exists(output_file)
-    
-    with open(output_file, mode, newline='') as f:
-        writer = csv.writer(f)
-        if header:
-            writer.writerow(["timestamp", "ip", "method", "endpoint", "status", 
-                           "country", "user_role", "age_group"])
+    # Readers may be reading the current version, so entries are written to
+    # a new one, appended to a copy of the current one unless refreshing
+    with new_version(output_file, rows_added=num_entries) as draft:
+        header = refresh or draft.base is None
+        if not header:
+            draft.copy_current()
         
-        for _ in range(num_entries):
-            entry = generate_log_entry()
-            writer.writerow(entry)
-    
-    # Remove duplicates if appending
-    if not refresh:
-        df = pd.read_csv(output_file)
-        df = df.drop_duplicates()
-        df.to_csv(output_file, index=False)
+        with open(draft.path, 'w' if header else 'a', newline='') as f:
+            writer = csv.writer(f)
+            if header:
+                writer.writerow(["timestamp", "ip", "method", "endpoint", "status", 
+                               "country", "user_role", "age_group"])
+            
+            for _ in range(num_entries):
+                entry = generate_log_entry()
+                writer.writerow(entry)
+        
+        # Remove duplicates if appending
+        if not header:
+            import pandas as pd
+            df = pd.read_csv(draft.path)
+            df = df.drop_duplicates()
+            df.to_csv(draft.path, index=False)
     
-    print(f"Generated {num_entries} log entries in {output_file}")
+    print(f"Generated {num_entries} log entries in {output_file} (version {draft.version})")
+
+def _generate_partitioned(num_entries, root, refresh):
+    from partitions import PartitionWriter, clear
+    if refresh:
+        clear(root)
+    written = PartitionWriter(root).write_rows(generate_log_entry() for _ in range(num_entries))
+    print(f"Generated {num_entries} log entries in {written} partitions of {root}")
 
 if __name__ == "__main__":
     generate_logs(5000)
\ No newline at end of file
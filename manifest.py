@@ -0,0 +1,336 @@
+# manifest.py
+
+"""Immutable log versions published through a manifest.
+
+Writers never modify a log that a reader may be reading. new_version()
+has the writer fill a temporary file, renames it into LOG_VERSIONS_DIR under
+the next version number, and then atomically replaces
+<log path>.manifest.json with one that names the new file. Version ids only grow: writers take a lock file, readers take no
+lock at all.
+
+current() reads the manifest. pinned() reads it once per Flask request, so
+every read in one callback sees the same version. The loaders and every
+cache built on them key on the version id rather than on file stats. A log
+path without a manifest (e.g. a file copied in by hand) is read directly
+and keyed on its mtime and size, as before.
+
+append_segment() publishes appended lines without copying the log: the
+new version is the previous one plus a segment file holding just those
+lines, listed in the manifest with its row and byte counts. A run of
+trailing segments is merged into one whenever the one before the newest is
+no larger than the newest (like carries in a binary counter), so a log
+holds O(log n) segments and each line is copied O(log n) times. Merging
+keeps the lines in order, so a reader that has processed a version up to
+some row and byte count can continue from there in any later version with
+the same base file (see utils.log_sources).
+
+Files a newer version no longer uses are listed as retired and deleted
+once the last version using them falls out of LOG_VERSIONS_KEEP.
+
+For a partitioned log (see partitions.py) the manifest names the partition
+root itself, and each part written bumps the version.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+MANIFEST_SUFFIX = ".manifest.json"
+# Published versions kept besides the current one, for readers still on them
+LOG_VERSIONS_KEEP = int(os.environ.get("LOG_VERSIONS_KEEP", "2"))
+LOCK_TIMEOUT_SECONDS = 30
+# A lock file older than this was left behind by a crashed writer
+STALE_LOCK_SECONDS = 300
+
+def _read_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+_UMASK = _read_umask()
+
+def make_readable(path):
+    """Give a file from mkstemp (mode 0600) or a directory from mkdtemp the
+    mode open() or makedirs() would, per the umask.
+
+    Published files are read by other processes, e.g. the web app running
+    as another user than ingestd.py.
+    """
+    os.chmod(path, (0o777 if os.path.isdir(path) else 0o666) & ~_UMASK)
+
+@contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT_SECONDS):
+    """Hold an exclusive lock file; works across processes and platforms."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_LOCK_SECONDS:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for {path}")
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+def manifest_path(log_path):
+    return os.path.normpath(log_path) + MANIFEST_SUFFIX
+
+def versions_dir(log_path):
+    return os.environ.get("LOG_VERSIONS_DIR") or os.path.join(os.path.dirname(log_path) or ".", "versions")
+
+def read_manifest(log_path):
+    """The manifest of log_path as a dict, or None when it has none."""
+    try:
+        with open(manifest_path(log_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"Ignoring unreadable manifest of {log_path}: {e}")
+        return None
+
+def _resolve(log_path):
+    """(version id, base file, segments) of log_path, with absolute paths.
+
+    Segments are dicts with path, rows and bytes (excluding the header).
+    """
+    manifest = read_manifest(log_path)
+    if manifest is None:
+        return None, log_path, []
+    directory = os.path.dirname(manifest_path(log_path))
+    segments = [dict(segment, path=os.path.join(directory, segment["path"]))
+                for segment in manifest.get("segments", [])]
+    return manifest["version"], os.path.join(directory, manifest["path"]), segments
+
+def current(log_path):
+    """(version id, base file holding the data) of log_path; the id is None without a manifest."""
+    return _resolve(log_path)[:2]
+
+def _pinned(log_path):
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return _resolve(log_path)
+    if not has_request_context():
+        return _resolve(log_path)
+    pins = g.setdefault("_log_versions", {})
+    if log_path in pins:
+        return pins[log_path]
+    resolved = _resolve(log_path)
+    # A log that does not exist yet is not pinned, so one generated during
+    # the request is picked up
+    if resolved[0] is not None:
+        pins[log_path] = resolved
+    return resolved
+
+def pinned(log_path):
+    """current(log_path), fixed for the rest of the Flask request once read."""
+    return _pinned(log_path)[:2]
+
+def pinned_segments(log_path):
+    """Segments appended to the base file of pinned(log_path), oldest first."""
+    return _pinned(log_path)[2]
+
+def files(log_path):
+    """Every CSV file of log_path's current version, base first; each has a header."""
+    _, base, segments = _resolve(log_path)
+    return [base] + [segment["path"] for segment in segments]
+
+def _write_manifest(log_path, version, data_path, info):
+    target = manifest_path(log_path)
+    directory = os.path.dirname(target) or "."
+    manifest = dict(info, version=version, path=os.path.relpath(data_path, directory),
+                    published=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=1)
+    make_readable(tmp_path)
+    os.replace(tmp_path, target)
+
+def publish(log_path, data_path=None, **info):
+    """Point log_path's manifest at data_path (default: log_path) under the next version id."""
+    os.makedirs(os.path.dirname(manifest_path(log_path)) or ".", exist_ok=True)
+    with file_lock(manifest_path(log_path) + ".lock"):
+        version = ((read_manifest(log_path) or {}).get("version") or 0) + 1
+        _write_manifest(log_path, version, data_path or log_path, info)
+    return version
+
+def _relative(log_path, path):
+    return os.path.relpath(path, os.path.dirname(manifest_path(log_path)) or ".")
+
+def _retire(log_path, manifest, version, paths):
+    """manifest's retired files plus paths, which versions before version use.
+
+    Files that no kept version uses any more are deleted and left out.
+    """
+    directory = os.path.dirname(manifest_path(log_path)) or "."
+    retired = list((manifest or {}).get("retired", []))
+    retired += [{"path": _relative(log_path, path), "until": version} for path in paths]
+    kept = []
+    for entry in retired:
+        if entry["until"] > version - LOG_VERSIONS_KEEP:
+            kept.append(entry)
+            continue
+        try:
+            os.remove(os.path.join(directory, entry["path"]))
+        except FileNotFoundError:
+            pass
+    return kept
+
+def _copy_lines(path, out):
+    """Append the lines of CSV file path, without its header, to the binary file out."""
+    with open(path, "rb") as f:
+        f.readline()
+        shutil.copyfileobj(f, out)
+
+class Draft:
+    """The next version of a log being written: fill path, optionally starting from base.
+
+    segments are those appended to base in the current version; copy_current()
+    copies both.
+    """
+
+    def __init__(self, base, path, version, segments=()):
+        self.base = base
+        self.path = path
+        self.version = version
+        self.segments = list(segments)
+
+    def copy_current(self):
+        """Fill path with the current version's lines: base, then each segment's."""
+        shutil.copyfile(self.base, self.path)
+        with open(self.path, "ab") as out:
+            if self.segments and os.path.getsize(self.base):
+                with open(self.base, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read() != b"\n":
+                        out.write(b"\n")
+            for segment in self.segments:
+                _copy_lines(segment["path"], out)
+
+@contextmanager
+def new_version(log_path, **info):
+    """Write the next immutable version of log_path; yields a Draft.
+
+    The version is published when the block exits without an error. Writers
+    hold the lock throughout, so one appending to draft.base never loses
+    rows published by another meanwhile.
+    """
+    directory = versions_dir(log_path)
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(log_path))
+    with file_lock(manifest_path(log_path) + ".lock"):
+        manifest = read_manifest(log_path)
+        version = ((manifest or {}).get("version") or 0) + 1
+        _, base, segments = _resolve(log_path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            yield Draft(base if os.path.exists(base) else None, tmp_path, version, segments)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        data_path = os.path.join(directory, f"{stem}-{version:06d}{ext}")
+        make_readable(tmp_path)
+        os.replace(tmp_path, data_path)
+        # Only files published here are ever deleted, not e.g. a log the
+        # manifest was pointed at by hand
+        replaced = [path for path in [base] + [segment["path"] for segment in segments]
+                    if manifest and os.path.dirname(os.path.abspath(path)) == os.path.abspath(directory)]
+        retired = _retire(log_path, manifest, version, replaced)
+        _write_manifest(log_path, version, data_path, dict(info, retired=retired))
+        in_use = {os.path.basename(entry["path"]) for entry in retired}
+        _prune(directory, stem, ext, version, in_use)
+
+def append_segment(log_path, header, lines, **info):
+    """Publish log_path plus lines (bytes, without line endings) as its next version.
+
+    The lines go to a new segment file under header (a list of column names),
+    merged with the trailing segments per the module docstring. A log without
+    a manifest yet is published as a new version instead. Returns the version id.
+    """
+    if read_manifest(log_path) is None:
+        with new_version(log_path, rows_added=len(lines), **info) as draft:
+            if draft.base is not None:
+                draft.copy_current()
+            with open(draft.path, "ab") as f:
+                if draft.base is None:
+                    f.write(",".join(header).encode() + b"\n")
+                f.write(b"\n".join(lines) + b"\n")
+        return draft.version
+
+    directory = versions_dir(log_path)
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(log_path))
+    data = b"\n".join(lines) + b"\n"
+    with file_lock(manifest_path(log_path) + ".lock"):
+        manifest = read_manifest(log_path)
+        version = manifest["version"] + 1
+        _, base, segments = _resolve(log_path)
+        # Merge while the segment before is no larger than what it is merged into
+        merged = []
+        size = len(data)
+        while segments and segments[-1]["bytes"] <= size:
+            size += segments[-1]["bytes"]
+            merged.insert(0, segments.pop())
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as out:
+            out.write(",".join(header).encode() + b"\n")
+            for segment in merged:
+                _copy_lines(segment["path"], out)
+            out.write(data)
+        path = os.path.join(directory, f"{stem}-{version:06d}-segment{ext}")
+        make_readable(tmp_path)
+        os.replace(tmp_path, path)
+        segments.append({"path": path, "rows": len(lines) + sum(s["rows"] for s in merged), "bytes": size})
+        retired = _retire(log_path, manifest, version, [segment["path"] for segment in merged])
+        _write_manifest(log_path, version, base, dict(
+            info, rows_added=len(lines), retired=retired,
+            segments=[dict(segment, path=_relative(log_path, segment["path"])) for segment in segments]))
+    return version
+
+def publish_file(log_path, file, **info):
+    """Publish a copy of file as the next version of log_path; returns its version id."""
+    import shutil
+    with new_version(log_path, source=file, **info) as draft:
+        shutil.copyfile(file, draft.path)
+    return draft.version
+
+def _prune(directory, stem, ext, version, in_use=()):
+    """Delete base files of versions before those kept, except the retired ones in_use."""
+    for name in os.listdir(directory):
+        if not (name.startswith(stem + "-") and name.endswith(ext)) or name in in_use:
+            continue
+        number = name[len(stem) + 1:len(name) - len(ext)]
+        if number.isdigit() and int(number) < version - LOG_VERSIONS_KEEP:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show or publish versions of a log")
+    parser.add_argument("command", choices=["show", "publish"])
+    parser.add_argument("log_path", nargs="?", default="data/server_logs.csv")
+    parser.add_argument("--file", help="File to publish as the next version (copied)")
+    args = parser.parse_args()
+    if args.command == "publish":
+        if not args.file:
+            parser.error("publish needs --file")
+        print(f"Published {args.log_path} version {publish_file(args.log_path, args.file)}")
+    else:
+        print(json.dumps(read_manifest(args.log_path), indent=1))
@@ -0,0 +1,228 @@
+# metrics.py
+
+"""In-process metrics for Dash callbacks and log processing.
+
+Everything is kept per worker process and exposed in the Prometheus text
+format on ``/metrics``. Recording a callback call costs two clock reads, a
+bisect and a lock round trip, so it can stay on in production.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, Prometheus style (the implicit last bucket is +Inf)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Cumulative-on-render bucket counts plus sum and count."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+_lock = threading.Lock()
+_callback_latency = {}   # callback name -> Histogram
+_callback_bytes = {}     # callback name -> [request bytes, response bytes]
+_callback_errors = {}    # callback name -> exception count
+_stage_latency = {}      # process_logs stage -> Histogram
+_counters = {}           # free-form counter name -> value
+_bad_rows_total = {}     # reason -> rows rejected since start
+_bad_rows_last = {}      # reason -> rows rejected by the last ingestion pass
+_cache_requests = {}     # (function, result) -> memoized helper calls
+_cache_size = [0, 0]     # bytes, entries held by the process-local cache
+_over_budget = {}        # callback name -> responses over the payload budget
+
+def observe_callback(name, seconds, request_bytes=0, response_bytes=0):
+    """Record one callback execution."""
+    with _lock:
+        hist = _callback_latency.get(name)
+        if hist is None:
+            hist = _callback_latency[name] = Histogram()
+            _callback_bytes[name] = [0, 0]
+        hist.observe(seconds)
+        sizes = _callback_bytes[name]
+        sizes[0] += request_bytes
+        sizes[1] += response_bytes
+
+def record_exception(name):
+    """Count an exception raised (or caught and reported) by a callback."""
+    with _lock:
+        _callback_errors[name] = _callback_errors.get(name, 0) + 1
+
+def observe_stage(stage, seconds):
+    """Record the duration of one process_logs stage."""
+    with _lock:
+        hist = _stage_latency.get(stage)
+        if hist is None:
+            hist = _stage_latency[stage] = Histogram()
+        hist.observe(seconds)
+
+@contextmanager
+def stage_timer(stage):
+    """Time the enclosed block as a process_logs stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+def inc(name, amount=1):
+    """Increment a free-form counter, e.g. cache hits."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def record_bad_rows(counts):
+    """Record the rows an ingestion pass rejected, by reason code."""
+    with _lock:
+        _bad_rows_last.clear()
+        _bad_rows_last.update(counts)
+        for reason, n in counts.items():
+            _bad_rows_total[reason] = _bad_rows_total.get(reason, 0) + n
+
+def record_cache(function, result):
+    """Count a memoized helper call by result: hit, disk_hit, miss or bypass."""
+    with _lock:
+        key = (function, result)
+        _cache_requests[key] = _cache_requests.get(key, 0) + 1
+
+def set_cache_size(size_bytes, entries):
+    with _lock:
+        _cache_size[0] = size_bytes
+        _cache_size[1] = entries
+
+def record_over_budget(name):
+    """Count a callback response larger than its payload budget."""
+    with _lock:
+        _over_budget[name] = _over_budget.get(name, 0) + 1
+
+def instrument_callback(name, func):
+    """Wrap a Dash callback entry point so every call is recorded."""
+    from flask import has_request_context, request
+    from dash.exceptions import PreventUpdate
+
+    def instrumented(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+        except PreventUpdate:
+            observe_callback(name, time.perf_counter() - started)
+            raise
+        except Exception:
+            record_exception(name)
+            observe_callback(name, time.perf_counter() - started)
+            raise
+        request_bytes = (request.content_length or 0) if has_request_context() else 0
+        # Dash hands back the serialized JSON response as a str
+        response_bytes = len(response) if isinstance(response, str) else 0
+        observe_callback(name, time.perf_counter() - started, request_bytes, response_bytes)
+        return response
+
+    instrumented.__name__ = getattr(func, "__name__", name)
+    instrumented.__wrapped__ = func
+    instrumented._instrumented = True
+    return instrumented
+
+def instrument_callbacks(app):
+    """Wrap every callback registered so far, on the app and via dash.callback."""
+    from dash import _callback
+
+    for callback_map in (app.callback_map, _callback.GLOBAL_CALLBACK_MAP):
+        for entry in callback_map.values():
+            func = entry.get("callback")
+            if func is None or getattr(func, "_instrumented", False):
+                continue
+            entry["callback"] = instrument_callback(getattr(func, "__name__", "unknown"), func)
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def _render_histogram(lines, metric, label, hist):
+    cumulative = 0
+    for bound, count in zip(hist.buckets, hist.counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+    lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {hist.count}')
+    lines.append(f"{metric}_sum{{{label}}} {hist.sum:.6f}")
+    lines.append(f"{metric}_count{{{label}}} {hist.count}")
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        lines.append("# HELP dash_callback_latency_seconds Callback execution time.")
+        lines.append("# TYPE dash_callback_latency_seconds histogram")
+        for name, hist in sorted(_callback_latency.items()):
+            _render_histogram(lines, "dash_callback_latency_seconds", f'callback="{_label(name)}"', hist)
+
+        lines.append("# HELP dash_callback_request_bytes_total Callback request payload bytes.")
+        lines.append("# TYPE dash_callback_request_bytes_total counter")
+        for name, sizes in sorted(_callback_bytes.items()):
+            lines.append(f'dash_callback_request_bytes_total{{callback="{_label(name)}"}} {sizes[0]}')
+
+        lines.append("# HELP dash_callback_response_bytes_total Callback response payload bytes.")
+        lines.append("# TYPE dash_callback_response_bytes_total counter")
+        for name, sizes in sorted(_callback_bytes.items()):
+            lines.append(f'dash_callback_response_bytes_total{{callback="{_label(name)}"}} {sizes[1]}')
+
+        lines.append("# HELP dash_callback_exceptions_total Exceptions raised or reported by callbacks.")
+        lines.append("# TYPE dash_callback_exceptions_total counter")
+        for name, count in sorted(_callback_errors.items()):
+            lines.append(f'dash_callback_exceptions_total{{callback="{_label(name)}"}} {count}')
+
+        lines.append("# HELP dash_callback_over_budget_total Responses larger than the callback's payload budget.")
+        lines.append("# TYPE dash_callback_over_budget_total counter")
+        for name, count in sorted(_over_budget.items()):
+            lines.append(f'dash_callback_over_budget_total{{callback="{_label(name)}"}} {count}')
+
+        lines.append("# HELP process_logs_stage_seconds Time spent in each process_logs stage.")
+        lines.append("# TYPE process_logs_stage_seconds histogram")
+        for stage, hist in sorted(_stage_latency.items()):
+            _render_histogram(lines, "process_logs_stage_seconds", f'stage="{_label(stage)}"', hist)
+
+        lines.append("# HELP ingest_bad_rows_total Log rows rejected during ingestion.")
+        lines.append("# TYPE ingest_bad_rows_total counter")
+        for reason, n in sorted(_bad_rows_total.items()):
+            lines.append(f'ingest_bad_rows_total{{reason="{_label(reason)}"}} {n}')
+
+        lines.append("# HELP ingest_bad_rows_last_pass Log rows rejected by the latest ingestion pass.")
+        lines.append("# TYPE ingest_bad_rows_last_pass gauge")
+        for reason, n in sorted(_bad_rows_last.items()):
+            lines.append(f'ingest_bad_rows_last_pass{{reason="{_label(reason)}"}} {n}')
+
+        lines.append("# HELP query_cache_requests_total Memoized query helper calls by result.")
+        lines.append("# TYPE query_cache_requests_total counter")
+        for (function, result), n in sorted(_cache_requests.items()):
+            lines.append(f'query_cache_requests_total{{function="{_label(function)}",result="{result}"}} {n}')
+
+        lines.append("# HELP query_cache_bytes Size of the process-local query cache.")
+        lines.append("# TYPE query_cache_bytes gauge")
+        lines.append(f"query_cache_bytes {_cache_size[0]}")
+        lines.append("# HELP query_cache_entries Entries in the process-local query cache.")
+        lines.append("# TYPE query_cache_entries gauge")
+        lines.append(f"query_cache_entries {_cache_size[1]}")
+
+        lines.append("# HELP dashboard_events_total Free-form counters such as cache hits.")
+        lines.append("# TYPE dashboard_events_total counter")
+        for name, value in sorted(_counters.items()):
+            lines.append(f'dashboard_events_total{{event="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def register_route(server, path="/metrics"):
+    """Expose render() on the Flask server."""
+    from flask import Response
+
+    def metrics_view():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    server.add_url_rule(path, "metrics", metrics_view)
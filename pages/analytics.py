@@ -1,12 +1,26 @@
-from dash import dcc, html, Input, Output, callback, dash_table
+from dash import dcc, html, Input, Output, callback, clientside_callback, ClientsideFunction, dash_table
 import dash
 import dash_bootstrap_components as dbc
-import plotly.express as px
-import pandas as pd
-from utils import calculate_statistics, PLOTLY_COUNTRY_MAPPING
+from metrics import record_exception
+# pandas and plotly.express are imported inside the callbacks so that importing
+# the page (and therefore starting the app) stays cheap.
+import os
+import tempfile
+from figures import store_frame
+from utils import (calculate_statistics, get_demographic_cube,
+                   count_by, is_aggregated, export_logs_csv, sampling_note,
+                   PLOTLY_COUNTRY_MAPPING)
+from anomalies import get_detector
+from sessions import get_tracker, session_stats, funnel_counts, SESSION_GAP_MINUTES
+
+# Filter and count the User Distribution tab in the browser
+# (assets/demographics.js) instead of on the server
+CLIENTSIDE_AGGREGATION = os.environ.get("CLIENTSIDE_AGGREGATION", "0") == "1"
+# How often the error spike panel re-reads the detector
+SPIKE_REFRESH_MS = int(os.environ.get("SPIKE_REFRESH_MS", "60000"))
 
 def calculate_percentages(dataframe):
-    counts = dataframe['request_type'].value_counts().reset_index()
+    counts = count_by(dataframe, 'request_type')
     counts.columns = ['request_type', 'count']
     total = counts['count'].sum()
     counts['percentage'] = (counts['count'] / total * 100).round(1)
@@ -84,7 +98,8 @@ layout = dbc.Container(
                                                 width=4
                                             )
                                         ]),
-                                        dcc.Graph(id='demographic-chart')
+                                        dcc.Graph(id='demographic-chart'),
+                                        dcc.Store(id='demographic-cube')
                                     ]),
                                     label="User Distribution",
                                     tab_id="user-distribution",
@@ -157,6 +172,34 @@ layout = dbc.Container(
                                     label="Statistics",
                                     tab_id="statistics",
                                     tabClassName="py-2"
+                                ),
+                                dbc.Tab(
+                                    id="sessions-tab",
+                                    children=html.Div([
+                                        html.P(f"Visits grouped into sessions: requests from one IP with no gap longer than {SESSION_GAP_MINUTES:g} minutes. The funnel counts sessions that went on to book a demo.", 
+                                               className="text-muted mb-3"),
+                                        dbc.Row([
+                                            dbc.Col(
+                                                dcc.Dropdown(
+                                                    id='sessions-groupby',
+                                                    options=[
+                                                        {'label': 'By Country', 'value': 'plotly_country'},
+                                                        {'label': 'By User Role', 'value': 'user_role'},
+                                                        {'label': 'By Request Type', 'value': 'request_type'}
+                                                    ],
+                                                    value='plotly_country',
+                                                    clearable=False,
+                                                    className="mb-3"
+                                                ),
+                                                width=6
+                                            )
+                                        ]),
+                                        html.Div(id='sessions-table-container'),
+                                        dcc.Graph(id='funnel-chart')
+                                    ]),
+                                    label="Sessions",
+                                    tab_id="sessions",
+                                    tabClassName="py-2"
                                 )
                             ],
                             active_tab="request-composition"
@@ -166,6 +209,20 @@ layout = dbc.Container(
                 width=12
             )
         ]),
+        dbc.Row([
+            dbc.Col(
+                dbc.Card([
+                    dbc.CardHeader(html.H4("Active Error Spikes", className="d-inline")),
+                    dbc.CardBody([
+                        html.P("Endpoint and country pairs whose latest error rate (4xx and 5xx responses) is well above their recent baseline.", 
+                               className="text-muted mb-3"),
+                        html.Div(id='error-spikes-container'),
+                        dcc.Interval(id='error-spikes-interval', interval=SPIKE_REFRESH_MS)
+                    ])
+                ], className="shadow-lg mb-4"),
+                width=12
+            )
+        ]),
         dcc.Download(id="download-analytics")
     ],
     fluid=True
@@ -178,7 +235,7 @@ layout = dbc.Container(
 def update_country_filter(data):
     if not data:
         return []
-    df = pd.DataFrame(data)
+    df = store_frame(data)
     # Use plotly_country if available, otherwise fall back to country
     country_col = 'plotly_country' if 'plotly_country' in df.columns else 'country'
     return [{'label': c, 'value': c} for c in df[country_col].unique()]
@@ -188,11 +245,12 @@ def update_country_filter(data):
     Input('data-store', 'data')
 )
 def update_pie_chart(data):
+    import plotly.express as px
     if not data:
         return px.pie(title="No data available")
     
     try:
-        df = pd.DataFrame(data)
+        df = store_frame(data)
         percent_df = calculate_percentages(df)
         
         return px.pie(
@@ -211,6 +269,7 @@ def update_pie_chart(data):
         )
     except Exception as e:
         print(f"Error updating pie chart: {e}")
+        record_exception("update_pie_chart")
         return px.pie(title="Error loading data")
 
 @callback(
@@ -218,53 +277,64 @@ def update_pie_chart(data):
     Input('data-store', 'data')
 )
 def update_trends_chart(data):
+    import pandas as pd
+    import plotly.express as px
     if not data:
         return px.histogram(title="No data available")
     
     try:
-        df = pd.DataFrame(data)
+        df = store_frame(data)
         
-        # Ensure datetime is properly formatted
+        # Ensure datetime is properly formatted; the frame is shared, so
+        # derived columns go on a new one
         if 'datetime' not in df.columns:
-            df['datetime'] = pd.to_datetime(df['timestamp'], errors='coerce')
+            df = df.assign(datetime=pd.to_datetime(df['timestamp'], errors='coerce'))
             df = df.dropna(subset=['datetime'])
         
         # Calculate appropriate number of bins
+        df = df.assign(datetime=pd.to_datetime(df['datetime']))
         unique_dates = len(df['datetime'].unique())
         nbins = min(20, unique_dates) if unique_dates > 0 else 1
         
-        fig = px.histogram(
-            df,
-            x='datetime',
+        # Bin on the server: a histogram would ship every row's timestamp,
+        # while the binned counts travel as a few typed arrays
+        edges = pd.date_range(df['datetime'].min(), df['datetime'].max(), periods=nbins + 1)
+        df = df.assign(bin=pd.cut(df['datetime'], bins=edges, labels=edges[:-1], include_lowest=True) if nbins > 1 else edges[0])
+        counts = count_by(df, ['bin', 'request_type'])
+        counts['bin'] = pd.to_datetime(counts['bin'])
+        width_ms = (edges[1] - edges[0]).total_seconds() * 1000 if nbins > 1 else None
+        fig = px.bar(
+            counts,
+            x='bin',
+            y='count',
             color='request_type',
             title="Requests by Type Over Time",
-            nbins=nbins,
-            barmode='stack'
+            barmode='stack',
+            labels={'bin': 'Date', 'count': 'Requests', 'request_type': 'Request Type'}
         )
+        if width_ms:
+            fig.update_traces(width=width_ms, offset=0)
         
         return fig.update_layout(
             paper_bgcolor='var(--card-bg)',
             plot_bgcolor='var(--card-bg)',
             font_color='var(--text-color)',
             yaxis_title="Number of Requests",
-            xaxis_title="Date"
+            xaxis_title="Date",
+            bargap=0
         )
         
     except Exception as e:
         print(f"Error updating trends chart: {e}")
+        record_exception("update_trends_chart")
         return px.histogram(title="Error loading data")
     
-@callback(
-    Output('demographic-chart', 'figure'),
-    [Input('demographic-type', 'value'),
-     Input('country-filter-demographic', 'value'),
-     Input('data-store', 'data')]
-)
 def update_demographic_chart(demographic_type, countries, data):
+    import plotly.express as px
     if not data:
         return px.bar()
     
-    df = pd.DataFrame(data)
+    df = store_frame(data)
     
     # Filter by selected countries if any
     if countries and len(countries) > 0:
@@ -278,7 +348,7 @@ def update_demographic_chart(demographic_type, countries, data):
         return px.bar()
     
     if demographic_type == 'age_group':
-        demo_data = filtered_df['age_group'].value_counts().reset_index()
+        demo_data = count_by(filtered_df, 'age_group')
         demo_data.columns = ['age_group', 'count']
         fig = px.bar(
             demo_data,
@@ -291,7 +361,7 @@ def update_demographic_chart(demographic_type, countries, data):
             text='count'
         )
     else:
-        demo_data = filtered_df['user_role'].value_counts().reset_index()
+        demo_data = count_by(filtered_df, 'user_role')
         demo_data.columns = ['user_role', 'count']
         fig = px.pie(
             demo_data,
@@ -309,6 +379,33 @@ def update_demographic_chart(demographic_type, countries, data):
         margin={'t': 40, 'b': 20}
     )
 
+def update_demographic_cube(data):
+    if not data:
+        return None
+    return get_demographic_cube(store_frame(data))
+
+if CLIENTSIDE_AGGREGATION:
+    # The cube is only recomputed when data-store changes; dropdown changes
+    # never reach the server.
+    callback(
+        Output('demographic-cube', 'data'),
+        Input('data-store', 'data')
+    )(update_demographic_cube)
+    clientside_callback(
+        ClientsideFunction(namespace='demographics', function_name='update_chart'),
+        Output('demographic-chart', 'figure'),
+        [Input('demographic-type', 'value'),
+         Input('country-filter-demographic', 'value'),
+         Input('demographic-cube', 'data')]
+    )
+else:
+    callback(
+        Output('demographic-chart', 'figure'),
+        [Input('demographic-type', 'value'),
+         Input('country-filter-demographic', 'value'),
+         Input('data-store', 'data')]
+    )(update_demographic_chart)
+
 @callback(
     Output('crossfilter-chart', 'figure'),
     [Input('crossfilter-x', 'value'),
@@ -316,16 +413,17 @@ def update_demographic_chart(demographic_type, countries, data):
      Input('data-store', 'data')]
 )
 def update_crossfilter_chart(x_col, y_col, data):
+    import plotly.express as px
     if not data:
         return px.density_heatmap()
     
-    df = pd.DataFrame(data)
+    df = store_frame(data)
     
     # Ensure we have data for the selected columns
     if x_col not in df.columns or y_col not in df.columns:
         return px.density_heatmap()
     
-    cross_data = df.groupby([x_col, y_col]).size().reset_index(name='count')
+    cross_data = count_by(df, [x_col, y_col])
     
     if cross_data.empty:
         return px.density_heatmap()
@@ -338,7 +436,7 @@ def update_crossfilter_chart(x_col, y_col, data):
             y=y_col,
             z='count',
             histfunc="sum",
-            title=f"{x_col.title()} vs {y_col.title()} Distribution",
+            title=f"{x_col.title()} vs {y_col.title()} Distribution{sampling_note(df)}",
             color_continuous_scale='Viridis'
         )
     else:
@@ -349,7 +447,7 @@ def update_crossfilter_chart(x_col, y_col, data):
             y=y_col,
             size='count',
             color='count',
-            title=f"{x_col.title()} vs {y_col.title()} Distribution",
+            title=f"{x_col.title()} vs {y_col.title()} Distribution{sampling_note(df)}",
             color_continuous_scale='Viridis'
         )
     
@@ -371,8 +469,9 @@ def update_stats_table(groupby_col, data):
     if not data:
         return dash.no_update
     
-    df = pd.DataFrame(data)
-    stats_df = calculate_statistics(df, groupby_col)
+    # Computed from the same data-store contents as the other charts, and
+    # memoized per data-store version (see figures.store_frame)
+    stats_df = calculate_statistics(store_frame(data), groupby_col)
     stats_df = stats_df.astype(str)
     
     if groupby_col == 'overall':
@@ -409,6 +508,104 @@ def update_stats_table(groupby_col, data):
         page_size=10
     )
 
+@callback(
+    [Output('sessions-table-container', 'children'),
+     Output('funnel-chart', 'figure')],
+    [Input('sessions-groupby', 'value'),
+     Input('data-store', 'data')]
+)
+def update_sessions(groupby_col, data):
+    import plotly.express as px
+    if not data:
+        return dash.no_update, dash.no_update
+    
+    try:
+        # Sessions need every row, so they are counted during ingestion rather
+        # than from the (possibly sampled or aggregated) data-store
+        counts = get_tracker().counts()
+        stats_df = session_stats(counts, groupby_col)
+        stats_df.columns = [groupby_col.replace('plotly_', '').replace('_', ' ').title(),
+                            'Sessions', 'Avg Minutes', 'Median Minutes', 'Avg Requests']
+        table = dash_table.DataTable(
+            id='sessions-table',
+            columns=[{"name": col, "id": col} for col in stats_df.columns],
+            data=stats_df.to_dict('records'),
+            style_table={'overflowX': 'auto'},
+            style_cell={
+                'textAlign': 'left',
+                'padding': '10px',
+                'backgroundColor': 'var(--card-bg)',
+                'color': 'var(--text-color)'
+            },
+            style_header={
+                'backgroundColor': 'var(--card-bg)',
+                'color': 'var(--text-color)',
+                'fontWeight': 'bold'
+            },
+            sort_action="native",
+            page_size=10
+        )
+        
+        funnel_df = funnel_counts(counts)
+        figure = px.funnel(
+            funnel_df,
+            x='sessions',
+            y='step',
+            color='funnel',
+            title=f"Session Funnels ({counts.total:,} sessions)",
+            labels={'sessions': 'Sessions', 'step': 'Step', 'funnel': 'Funnel'}
+        ).update_layout(
+            paper_bgcolor='var(--card-bg)',
+            font_color='var(--text-color)',
+            margin={'t': 40, 'b': 20}
+        )
+        return table, figure
+    except Exception as e:
+        print(f"Error updating sessions: {e}")
+        record_exception("update_sessions")
+        return html.P("Error loading sessions.", className="mb-0"), px.funnel(title="Error loading data")
+
+@callback(
+    Output('error-spikes-container', 'children'),
+    [Input('error-spikes-interval', 'n_intervals'),
+     Input('data-store', 'data')]
+)
+def update_error_spikes(n_intervals, data):
+    spikes = get_detector().anomalies()
+    if not spikes:
+        return html.P("No active error spikes.", className="mb-0")
+    
+    rows = [{
+        'Endpoint': spike['endpoint'],
+        'Country': spike['country'],
+        'Window Start': spike['window_start'].strftime("%Y-%m-%d %H:%M"),
+        'Requests': spike['requests'],
+        'Errors': spike['errors'],
+        'Error Rate': f"{spike['error_rate']:.1%}",
+        'Baseline': f"{spike['baseline_rate']:.1%}",
+        'Score': round(spike['score'], 1)
+    } for spike in spikes]
+    
+    return dash_table.DataTable(
+        id='error-spikes-table',
+        columns=[{"name": col, "id": col} for col in rows[0]],
+        data=rows,
+        style_table={'overflowX': 'auto'},
+        style_cell={
+            'textAlign': 'left',
+            'padding': '10px',
+            'backgroundColor': 'var(--card-bg)',
+            'color': 'var(--text-color)'
+        },
+        style_header={
+            'backgroundColor': 'var(--card-bg)',
+            'color': 'var(--text-color)',
+            'fontWeight': 'bold'
+        },
+        sort_action="native",
+        page_size=10
+    )
+
 @callback(
     Output("download-analytics", "data"),
     [Input("export-analytics-btn", "n_clicks"),
@@ -417,7 +614,11 @@ def update_stats_table(groupby_col, data):
 )
 def export_analytics(n_clicks, data):
     if n_clicks and data:
-        df = pd.DataFrame(data)
+        df = store_frame(data)
+        if is_aggregated(df):
+            # Aggregated or sampled data lacks raw rows, so stream them from the log
+            with tempfile.TemporaryDirectory() as tmp:
+                return dcc.send_file(export_logs_csv(os.path.join(tmp, "analytics_data.csv")))
         return dcc.send_data_frame(
             df.to_csv,
             "analytics_data.csv",
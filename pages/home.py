@@ -1,9 +1,14 @@
-from dash import dcc, html, Input, Output, State, callback, no_update, dash_table
+from dash import dcc, html, Input, Output, State, callback, no_update, dash_table, Patch
 import dash
 import dash_bootstrap_components as dbc
-import plotly.express as px
-import pandas as pd
-from utils import get_country_dataframe, PLOTLY_COUNTRY_MAPPING
+from metrics import record_exception
+# pandas and plotly.express are imported inside the callbacks so that importing
+# the page (and therefore starting the app) stays cheap.
+import os
+import tempfile
+from utils import (get_country_dataframe, count_by, is_aggregated, export_logs_csv, sampling_note,
+                   get_dimension_counts, PLOTLY_COUNTRY_MAPPING, ISO3_TO_PLOTLY_COUNTRY, get_iso3)
+from figures import store_frame, build_figures, bar_figure, pie_figure
 import logging
 
 logger = logging.getLogger(__name__)
@@ -92,6 +97,9 @@ layout = dbc.Container(
             )
         ]),
         dcc.Store(id='selected-country'),
+        # ISO-3 locations of the map figure on the client; set after the first
+        # full render so later updates can be sent as patches
+        dcc.Store(id='world-map-rendered'),
         dcc.Download(id="download-all-data"),
         dcc.Download(id="download-country-data")
     ],
@@ -100,38 +108,56 @@ layout = dbc.Container(
 
 # World Map Visualization
 @callback(
-    Output("world-map", "figure"),
+    [Output("world-map", "figure"),
+     Output("world-map-rendered", "data")],
     Input('data-store', 'data'),
+    State("world-map-rendered", "data"),
     prevent_initial_call=False
 )
-def update_map(data):
+def update_map(data, rendered):
+    import plotly.express as px
+    import plotly.graph_objects as go
     if not data:
-        return px.choropleth(title="Data loading...")
+        return px.choropleth(title="Data loading..."), None
     
     try:
-        df = pd.DataFrame(data)
+        df = store_frame(data)
         
         if 'plotly_country' not in df.columns:
-            df['plotly_country'] = df['country'].replace(PLOTLY_COUNTRY_MAPPING)
+            df = df.assign(plotly_country=df['country'].replace(PLOTLY_COUNTRY_MAPPING))
         
-        if df['plotly_country'].isnull().all():
-            return px.choropleth(title="No valid country data available")
-        
-        country_counts = df['plotly_country'].value_counts().reset_index()
+        country_counts = count_by(df, 'plotly_country')
         country_counts.columns = ['country', 'requests']
+        country_counts['iso3'] = country_counts['country'].map(get_iso3)
+        # Stable order so an unchanged set of countries only needs new z values
+        country_counts = country_counts.dropna(subset=['iso3']).sort_values('iso3')
         
-        fig = px.choropleth(
-            country_counts,
-            locations="country",
-            locationmode="country names",
-            color="requests",
-            color_continuous_scale=px.colors.sequential.Plasma,
-            range_color=[country_counts['requests'].min(), country_counts['requests'].max()],
-            hover_name="country",
-            hover_data={"requests": ":,", "country": False},
-            title="<b>Live Request Heatmap</b>",
-            height=700
-        )
+        if country_counts.empty:
+            return px.choropleth(title="No valid country data available"), None
+        
+        locations = country_counts['iso3'].tolist()
+        requests = country_counts['requests'].tolist()
+        names = country_counts['country'].tolist()
+        
+        if rendered:
+            # The geo layout is already on the client, only send what changed
+            patch = Patch()
+            if rendered != locations:
+                patch['data'][0]['locations'] = locations
+                patch['data'][0]['text'] = names
+            patch['data'][0]['z'] = requests
+            patch['layout']['coloraxis']['cmin'] = min(requests)
+            patch['layout']['coloraxis']['cmax'] = max(requests)
+            return patch, (no_update if rendered == locations else locations)
+        
+        fig = go.Figure(go.Choropleth(
+            locations=locations,
+            locationmode="ISO-3",
+            z=requests,
+            text=names,
+            coloraxis="coloraxis",
+            hovertemplate="<b>%{text}</b><br>requests=%{z:,}<extra></extra>"
+        ))
         
         fig.update_geos(
             projection_type="natural earth",
@@ -142,10 +168,17 @@ def update_map(data):
         )
         
         fig.update_layout(
+            title="<b>Live Request Heatmap</b>",
+            height=700,
             margin={"r":0,"t":40,"l":0,"b":0},
-            coloraxis_colorbar={
-                "title": "Requests",
-                "thickness": 20
+            coloraxis={
+                "colorscale": px.colors.sequential.Plasma,
+                "cmin": min(requests),
+                "cmax": max(requests),
+                "colorbar": {
+                    "title": "Requests",
+                    "thickness": 20
+                }
             },
             geo=dict(
                 bgcolor='rgba(0,0,0,0)',
@@ -153,11 +186,12 @@ def update_map(data):
             )
         )
         
-        return fig
+        return fig, locations
         
     except Exception as e:
         print(f"Map error: {str(e)}")
-        return px.choropleth(title="Error visualizing data")
+        record_exception("update_map")
+        return px.choropleth(title="Error visualizing data"), None
 
 # Combined Drilldown Handler (fixes duplicate callback issue)
 @callback(
@@ -179,7 +213,9 @@ def handle_drilldown(click_data, close_clicks, is_open, current_country):
     trigger_id = ctx.triggered[0]['prop_id'].split('.')[0]
     
     if trigger_id == 'world-map' and click_data:
-        country = click_data['points'][0]['location']
+        location = click_data['points'][0]['location']
+        # Map locations are ISO-3 codes; the rest of the page uses Plotly names
+        country = ISO3_TO_PLOTLY_COUNTRY.get(location, location)
         return True, f"Country Analysis: {country}", country
     elif trigger_id == 'close-drilldown':
         return False, dash.no_update, current_country
@@ -195,69 +231,70 @@ def handle_drilldown(click_data, close_clicks, is_open, current_country):
      Input('data-store', 'data')]
 )
 def update_drilldown_visualizations(country, data):
+    from plotly import colors
     if not country or not data:
         return no_update, no_update, no_update
     
     try:
-        df = pd.DataFrame(data)
-        country_col = 'plotly_country' if 'plotly_country' in df.columns else 'country'
-        country_df = df[df[country_col] == country]
+        df = store_frame(data)
+        # One aggregate per data version serves every country's drilldown
+        counts = get_dimension_counts(df)
+        country_counts = counts[counts['plotly_country'] == country]
         
-        if country_df.empty:
+        if country_counts.empty:
             return no_update, no_update, no_update
         
-        # Request Types Chart
-        req_counts = country_df['request_type'].value_counts().reset_index()
-        req_counts.columns = ['request_type', 'count']
-        req_fig = px.bar(
-            req_counts,
-            x='request_type',
-            y='count',
-            title=f"Request Types in {country}",
-            color='request_type',
-            labels={'count': 'Number of Requests'},
-            color_discrete_sequence=px.colors.qualitative.Pastel
-        ).update_layout(
-            paper_bgcolor='var(--card-bg)',
-            plot_bgcolor='var(--card-bg)',
-            font_color='var(--text-color)'
-        )
+        # Counts are scaled up by the sample weights when the log is sampled
+        note = sampling_note(df)
+        card = {'paper_bgcolor': 'var(--card-bg)', 'font': {'color': 'var(--text-color)'}}
         
-        # Age Group Chart
-        age_fig = px.pie(
-            country_df,
-            names='age_group',
-            title=f"Age Groups in {country}",
-            hole=0.4,
-            color_discrete_sequence=px.colors.sequential.Plasma
-        ).update_layout(
-            paper_bgcolor='var(--card-bg)',
-            font_color='var(--text-color)'
-        )
+        def totals(cols):
+            return (country_counts.groupby(cols, observed=True)['count'].sum()
+                    .sort_values(ascending=False).reset_index())
         
-        # User Roles Chart
-        role_counts = country_df.groupby(['user_role', 'request_type']).size().reset_index(name='count')
-        role_fig = px.bar(
-            role_counts,
-            x='user_role',
-            y='count',
-            color='request_type',
-            title=f"User Roles in {country}",
-            labels={'count': 'Number of Requests', 'user_role': 'User Role'},
-            barmode='stack',
-            color_discrete_sequence=px.colors.qualitative.Set3
-        ).update_layout(
-            paper_bgcolor='var(--card-bg)',
-            plot_bgcolor='var(--card-bg)',
-            font_color='var(--text-color)',
-            xaxis={'categoryorder': 'total descending'},
-            legend_title_text='Request Type'
-        )
+        def request_types():
+            return bar_figure(
+                totals('request_type'),
+                x='request_type',
+                y='count',
+                title=f"Request Types in {country}{note}",
+                color='request_type',
+                labels={'count': 'Number of Requests'},
+                colors=colors.qualitative.Pastel,
+                layout=dict(card, plot_bgcolor='var(--card-bg)')
+            )
+        
+        def age_groups():
+            return pie_figure(
+                totals('age_group'),
+                names='age_group',
+                values='count',
+                title=f"Age Groups in {country}{note}",
+                hole=0.4,
+                colors=colors.sequential.Plasma,
+                layout=card
+            )
+        
+        def user_roles():
+            return bar_figure(
+                totals(['user_role', 'request_type']),
+                x='user_role',
+                y='count',
+                color='request_type',
+                title=f"User Roles in {country}{note}",
+                labels={'count': 'Number of Requests', 'user_role': 'User Role'},
+                barmode='stack',
+                colors=colors.qualitative.Set3,
+                layout=dict(card, plot_bgcolor='var(--card-bg)',
+                            xaxis={'categoryorder': 'total descending'},
+                            legend={'title': {'text': 'Request Type'}})
+            )
         
-        return req_fig, age_fig, role_fig
+        return tuple(build_figures(request_types, age_groups, user_roles))
         
     except Exception as e:
         print(f"Error in drilldown visualizations: {e}")
+        record_exception("update_drilldown_visualizations")
         return no_update, no_update, no_update
 
 # Data Export Callbacks
@@ -269,7 +306,11 @@ def update_drilldown_visualizations(country, data):
 )
 def export_all_data(n_clicks, data):
     if n_clicks and data:
-        df = pd.DataFrame(data)
+        df = store_frame(data)
+        if is_aggregated(df):
+            # Aggregated or sampled data lacks raw rows, so stream them from the log
+            with tempfile.TemporaryDirectory() as tmp:
+                return dcc.send_file(export_logs_csv(os.path.join(tmp, "all_requests_data.csv")))
         return dcc.send_data_frame(
             df.to_csv,
             "all_requests_data.csv",
@@ -286,7 +327,12 @@ def export_all_data(n_clicks, data):
 )
 def export_country_data(n_clicks, country, data):
     if n_clicks and country and data:
-        df = pd.DataFrame(data)
+        df = store_frame(data)
+        if is_aggregated(df):
+            # Aggregated or sampled data lacks raw rows, so stream them from the log
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, f"{country}_requests_data.csv")
+                return dcc.send_file(export_logs_csv(path, country=country))
         country_col = 'plotly_country' if 'plotly_country' in df.columns else 'country'
         country_df = df[df[country_col] == country]
         return dcc.send_data_frame(
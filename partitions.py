@@ -0,0 +1,322 @@
+# partitions.py
+
+"""Date-partitioned raw log storage.
+
+With LOG_LAYOUT=partitioned the log lives under PARTITION_DIR instead of a
+single CSV file:
+
+    date=YYYY-MM-DD/part-<id>.csv     raw rows, same format as server_logs.csv
+    date=YYYY-MM-DD/_partition.json   row count and min/max timestamp per part
+
+Parts keep the raw CSV format so reads go through the same validation and
+quarantine as the single-file log. A writer finishes a part before listing
+it in _partition.json (replaced atomically under a lock file), and readers
+only open listed parts, so they never see a partial write. Each write also
+bumps the version in the root's manifest (see manifest.py), which is what
+caches key on.
+
+parts() prunes on the date in the directory name first and on the metadata
+second, so a query for the last day opens one or two partitions however
+much history is stored. Lines without a parseable timestamp go to
+date=unknown, which only unbounded reads include.
+
+compact() merges the parts of partitions older than
+PARTITION_COMPACT_AFTER_DAYS into one. The replaced parts stay on disk for
+PARTITION_ORPHAN_GRACE_SECONDS so readers that listed them can finish.
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+import manifest
+from schema import LOG_COLUMNS, TIMESTAMP_FORMAT
+
+LOG_LAYOUT = os.environ.get("LOG_LAYOUT", "file")
+PARTITION_DIR = os.environ.get("LOG_PARTITION_DIR", "data/logs")
+# The log path every loader defaults to: a partition root or a CSV file
+LOG_PATH = PARTITION_DIR if LOG_LAYOUT == "partitioned" else "data/server_logs.csv"
+
+PARTITION_COMPACT_AFTER_DAYS = int(os.environ.get("PARTITION_COMPACT_AFTER_DAYS", "1"))
+# How often the background compactor runs (0 disables it)
+PARTITION_COMPACT_INTERVAL_SECONDS = float(os.environ.get("PARTITION_COMPACT_INTERVAL_SECONDS", "3600"))
+PARTITION_ORPHAN_GRACE_SECONDS = float(os.environ.get("PARTITION_ORPHAN_GRACE_SECONDS", "600"))
+
+LOG_HEADER = LOG_COLUMNS
+METADATA_FILE = "_partition.json"
+LOCK_FILE = "_partition.lock"
+UNKNOWN_DATE = "unknown"
+_TIMESTAMP = re.compile(rb"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+# Lines of an imported log written per part
+IMPORT_BLOCK_LINES = 500000
+
+def is_partitioned(path):
+    """Whether path names a partition root rather than a CSV file."""
+    return os.path.isdir(path) or not os.path.splitext(path)[1]
+
+def _partition_dir(root, day):
+    return os.path.join(root, f"date={day}")
+
+def _read_metadata(directory):
+    try:
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"parts": {}}
+
+def _write_metadata(directory, metadata):
+    parts = metadata["parts"].values()
+    metadata["rows"] = sum(part["rows"] for part in parts)
+    metadata["min"] = min((part["min"] for part in parts if part["min"]), default=None)
+    metadata["max"] = max((part["max"] for part in parts if part["max"]), default=None)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(metadata, f, indent=1, sort_keys=True)
+    manifest.make_readable(tmp_path)
+    os.replace(tmp_path, os.path.join(directory, METADATA_FILE))
+
+def _locked(directory):
+    """Hold a partition's lock file; works across processes and platforms."""
+    return manifest.file_lock(os.path.join(directory, LOCK_FILE))
+
+def _time_bound(value):
+    """A datetime, date or string bound as a TIMESTAMP_FORMAT string."""
+    if value is None or isinstance(value, str):
+        return value
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+class PartitionWriter:
+    """Appends raw log lines to the partition of each line's date."""
+
+    def __init__(self, root=PARTITION_DIR, header=LOG_HEADER):
+        self.root = root
+        self.header = ",".join(header).encode()
+
+    def write_rows(self, rows):
+        """Write rows given as lists of field values, timestamp first."""
+        return self.write_lines([",".join(map(str, row)).encode() for row in rows])
+
+    def write_lines(self, lines):
+        """Write raw CSV lines (bytes, without line endings), one new part per date.
+
+        Returns the number of partitions written to.
+        """
+        by_date = {}
+        for line in lines:
+            day = line[:10].decode("ascii", "replace") if _TIMESTAMP.match(line) else UNKNOWN_DATE
+            by_date.setdefault(day, []).append(line)
+        for day, day_lines in by_date.items():
+            self._write_part(day, day_lines)
+        if by_date:
+            manifest.publish(self.root, rows=sum(map(len, by_date.values())))
+        return len(by_date)
+
+    def _write_part(self, day, lines):
+        directory = _partition_dir(self.root, day)
+        os.makedirs(directory, exist_ok=True)
+        name = f"part-{time.time_ns()}-{os.getpid()}-{threading.get_ident() % 10000}.csv"
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.header + b"\n")
+            f.write(b"\n".join(lines) + b"\n")
+        manifest.make_readable(tmp_path)
+        os.replace(tmp_path, os.path.join(directory, name))
+
+        stamps = [line[:19].decode("ascii") for line in lines if _TIMESTAMP.match(line)]
+        part = {
+            "rows": len(lines),
+            "min": min(stamps, default=None),
+            "max": max(stamps, default=None),
+            "bytes": os.path.getsize(os.path.join(directory, name)),
+        }
+        with _locked(directory):
+            metadata = _read_metadata(directory)
+            metadata["date"] = day
+            metadata["parts"][name] = part
+            _write_metadata(directory, metadata)
+
+def partitions(root=PARTITION_DIR):
+    """(date, directory) of every partition under root, oldest first.
+
+    Raises FileNotFoundError when root does not exist.
+    """
+    found = []
+    for name in os.listdir(root):
+        if name.startswith("date=") and os.path.isdir(os.path.join(root, name)):
+            found.append((name[5:], os.path.join(root, name)))
+    return sorted(found)
+
+def parts(root=PARTITION_DIR, start=None, end=None):
+    """Paths of the parts that can hold rows with start <= timestamp < end.
+
+    Bounds are datetimes, dates or TIMESTAMP_FORMAT strings; None is
+    unbounded.
+    """
+    start, end = _time_bound(start), _time_bound(end)
+    bounded = start is not None or end is not None
+    paths = []
+    for day, directory in partitions(root):
+        if day == UNKNOWN_DATE:
+            if bounded:
+                continue
+        elif (start is not None and day < start[:10]) or (end is not None and day > end[:10]):
+            continue
+        for name, part in sorted(_read_metadata(directory)["parts"].items()):
+            if bounded and part["min"] is None:
+                continue
+            if (start is not None and part["max"] < start) or (end is not None and part["min"] >= end):
+                continue
+            paths.append(os.path.join(directory, name))
+    return paths
+
+def part_rows(root=PARTITION_DIR):
+    """Path -> row count of every listed part under root."""
+    rows = {}
+    for _, directory in partitions(root):
+        for name, part in _read_metadata(directory)["parts"].items():
+            rows[os.path.join(directory, name)] = part["rows"]
+    return rows
+
+def signature(root=PARTITION_DIR):
+    """(latest metadata mtime, checksum of all metadata stats), or None without partitions."""
+    stats = []
+    try:
+        for day, directory in partitions(root):
+            stat = os.stat(os.path.join(directory, METADATA_FILE))
+            stats.append((day, stat.st_mtime_ns, stat.st_size))
+    except FileNotFoundError:
+        pass
+    if not stats:
+        return None
+    return (max(mtime for _, mtime, _ in stats), zlib.crc32(repr(stats).encode()))
+
+def clear(root=PARTITION_DIR):
+    """Delete every partition under root."""
+    try:
+        for _, directory in partitions(root):
+            shutil.rmtree(directory, ignore_errors=True)
+    except FileNotFoundError:
+        return
+    manifest.publish(root)
+
+def import_log(log_file, root=PARTITION_DIR, block_lines=IMPORT_BLOCK_LINES):
+    """Split a single-file CSV log into date partitions under root; returns lines written."""
+    written = 0
+    # The base file and any segments appended to it (see manifest.py)
+    for path in manifest.files(log_file):
+        with open(path, "rb") as f:
+            header = f.readline().strip().decode("utf-8", "replace").split(",")
+            writer = PartitionWriter(root, header)
+            block = []
+            for line in f:
+                line = line.rstrip(b"\r\n")
+                if line:
+                    block.append(line)
+                if len(block) >= block_lines:
+                    writer.write_lines(block)
+                    written += len(block)
+                    block = []
+            if block:
+                writer.write_lines(block)
+                written += len(block)
+    return written
+
+def _remove_orphans(directory, grace=PARTITION_ORPHAN_GRACE_SECONDS):
+    """Delete parts and temporary files no longer listed in the metadata."""
+    listed = _read_metadata(directory)["parts"]
+    now = time.time()
+    for name in os.listdir(directory):
+        if name in listed or not (name.startswith("part-") or name.endswith(".tmp")):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > grace:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def compact(root=PARTITION_DIR, older_than_days=PARTITION_COMPACT_AFTER_DAYS):
+    """Merge the parts of each partition older than older_than_days into one part.
+
+    Returns the number of partitions compacted.
+    """
+    cutoff = (date.today() - timedelta(days=older_than_days)).isoformat()
+    compacted = 0
+    for day, directory in partitions(root):
+        _remove_orphans(directory)
+        if day == UNKNOWN_DATE or day >= cutoff or len(_read_metadata(directory)["parts"]) < 2:
+            continue
+        with _locked(directory):
+            metadata = _read_metadata(directory)
+            old = sorted(metadata["parts"])
+            if len(old) < 2:
+                continue
+            name = f"part-{time.time_ns()}-{os.getpid()}-compacted.csv"
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as out:
+                for i, part_name in enumerate(old):
+                    with open(os.path.join(directory, part_name), "rb") as f:
+                        header = f.readline()
+                        if i == 0:
+                            out.write(header)
+                        shutil.copyfileobj(f, out)
+            manifest.make_readable(tmp_path)
+            os.replace(tmp_path, os.path.join(directory, name))
+            stamps = [metadata["parts"][part_name] for part_name in old]
+            metadata["parts"] = {name: {
+                "rows": sum(part["rows"] for part in stamps),
+                "min": min((part["min"] for part in stamps if part["min"]), default=None),
+                "max": max((part["max"] for part in stamps if part["max"]), default=None),
+                "bytes": os.path.getsize(os.path.join(directory, name)),
+            }}
+            _write_metadata(directory, metadata)
+        compacted += 1
+    return compacted
+
+_compactor = None
+
+def start_compactor(root=PARTITION_DIR, interval=PARTITION_COMPACT_INTERVAL_SECONDS):
+    """Run compact() every interval seconds in a daemon thread (once per process)."""
+    global _compactor
+    if not interval or _compactor is not None:
+        return _compactor
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                compacted = compact(root)
+                if compacted:
+                    print(f"Compacted {compacted} log partitions in {root}")
+            except Exception as e:
+                print(f"Error compacting log partitions: {e}")
+
+    _compactor = threading.Thread(target=run, name="partition-compactor", daemon=True)
+    _compactor.start()
+    return _compactor
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage date-partitioned log storage")
+    parser.add_argument("command", choices=["import", "compact", "list"])
+    parser.add_argument("log_file", nargs="?", default="data/server_logs.csv",
+                        help="CSV log to import")
+    parser.add_argument("--root", default=PARTITION_DIR)
+    args = parser.parse_args()
+    if args.command == "import":
+        print(f"Imported {import_log(args.log_file, args.root)} lines into {args.root}")
+    elif args.command == "compact":
+        print(f"Compacted {compact(args.root)} partitions in {args.root}")
+    else:
+        for day, directory in partitions(args.root):
+            metadata = _read_metadata(directory)
+            print(f"{day}  {len(metadata['parts'])} parts  {metadata.get('rows', 0)} rows  "
+                  f"{metadata.get('min')} .. {metadata.get('max')}")
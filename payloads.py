@@ -0,0 +1,173 @@
+# payloads.py
+
+"""Smaller and cheaper callback responses.
+
+- register_compression() gzips JSON and HTML responses of at least
+  COMPRESS_MIN_BYTES for clients that accept it. The data-store compresses
+  about tenfold.
+- store_records() serializes the data-store frame with pandas instead of
+  letting plotly's encoder clean every Timestamp and numpy scalar, which is
+  several times faster. The records are sent with a short version derived
+  from the frame's dataset version, which figures.store_frame() keys on.
+- enforce_budgets() checks every callback response against its payload
+  budget: PAYLOAD_BUDGET_KB, or a per-callback value from PAYLOAD_BUDGETS
+  such as "load_data=4096,update_map=256". Oversized responses are logged
+  and counted on /metrics. With PAYLOAD_BUDGET_ACTION=downsample,
+  store_records() also samples the data-store down to its budget.
+
+Figures need no extra work for compact floats: plotly encodes numeric numpy
+arrays as base64 typed arrays, and serializes with orjson when it is
+installed.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+
+from metrics import record_over_budget
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/html", "text/css",
+                          "text/plain", "application/javascript"}
+
+PAYLOAD_BUDGET_KB = float(os.environ.get("PAYLOAD_BUDGET_KB", "2048"))
+PAYLOAD_BUDGET_ACTION = os.environ.get("PAYLOAD_BUDGET_ACTION", "warn")
+# Keeps a downsampled data-store, which gains a weight column, under its budget
+DOWNSAMPLE_MARGIN = 0.9
+# Sample weights are fractional; more digits only add bytes
+WEIGHT_DECIMALS = 4
+
+def _parse_budgets(spec):
+    budgets = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, kb = item.partition("=")
+        try:
+            budgets[name.strip()] = float(kb)
+        except ValueError:
+            print(f"Ignoring invalid payload budget: {item}")
+    return budgets
+
+PAYLOAD_BUDGETS = _parse_budgets(os.environ.get("PAYLOAD_BUDGETS", ""))
+
+def budget_bytes(name):
+    """Response size budget of the named callback in bytes (0 means none)."""
+    return int(PAYLOAD_BUDGETS.get(name, PAYLOAD_BUDGET_KB) * 1024)
+
+def register_compression(server, min_bytes=COMPRESS_MIN_BYTES, level=COMPRESS_LEVEL):
+    """Gzip eligible responses of the Flask server."""
+    from flask import request
+
+    @server.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.direct_passthrough
+                or "Content-Encoding" in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or "gzip" not in request.headers.get("Accept-Encoding", "")):
+            return response
+        body = response.get_data()
+        if len(body) < min_bytes:
+            return response
+        response.set_data(gzip.compress(body, compresslevel=level))
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Content-Length"] = str(len(response.get_data()))
+        response.vary.add("Accept-Encoding")
+        return response
+
+    return compress
+
+def _budgeted(name, func):
+    budget = budget_bytes(name)
+
+    def checked(*args, **kwargs):
+        response = func(*args, **kwargs)
+        # Dash hands back the serialized JSON response as a str
+        if budget and isinstance(response, str) and len(response) > budget:
+            print(f"Callback {name} returned {len(response) / 1024:.0f} KB, "
+                  f"over its {budget / 1024:.0f} KB payload budget")
+            record_over_budget(name)
+        return response
+
+    checked.__name__ = getattr(func, "__name__", name)
+    checked.__wrapped__ = func
+    checked._budgeted = True
+    return checked
+
+def enforce_budgets(app):
+    """Wrap every registered callback with its payload budget check."""
+    from dash import _callback
+
+    for callback_map in (app.callback_map, _callback.GLOBAL_CALLBACK_MAP):
+        for entry in callback_map.values():
+            func = entry.get("callback")
+            if func is None or getattr(func, "_budgeted", False):
+                continue
+            name = getattr(func, "__name__", "unknown")
+            entry["callback"] = _budgeted(name, func)
+
+def _loads(text):
+    try:
+        import orjson
+        return orjson.loads(text)
+    except ImportError:
+        return json.loads(text)
+
+def _records_json(df):
+    from utils import WEIGHT_COLUMN
+    if WEIGHT_COLUMN in df.columns and df[WEIGHT_COLUMN].dtype.kind == 'f':
+        df = df.assign(**{WEIGHT_COLUMN: df[WEIGHT_COLUMN].round(WEIGHT_DECIMALS)})
+    return df.to_json(orient="records", date_format="iso", date_unit="s")
+
+def _hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+def store_version(df, name="load_data"):
+    """Version of df's data-store, or None when df has no dataset version."""
+    from cache import version_of
+    source = version_of(df)
+    if source is None:
+        return None
+    return _hash(f"{source}|{PAYLOAD_BUDGET_ACTION}|{budget_bytes(name)}")
+
+def store_records(df, name="load_data"):
+    """df as data-store contents: {"version": ..., "records": [...]}, or None if empty.
+
+    records are plain JSON values. The version changes with df's dataset
+    version and the settings below, or with the records themselves for a
+    frame without one. With PAYLOAD_BUDGET_ACTION=downsample, raw rows
+    beyond the callback's budget are replaced by a weighted sample
+    (utils.sample_logs) that fits.
+    """
+    from figures import keep_store_frame
+    if df.empty:
+        return None
+    text = _records_json(df)
+    budget = budget_bytes(name)
+    if PAYLOAD_BUDGET_ACTION == "downsample" and budget and len(text) > budget:
+        from utils import sample_logs, is_aggregated, is_sampled, WEIGHT_COLUMN
+        # Aggregates have no rows to drop, but a sample can be sampled again
+        if not is_aggregated(df) or is_sampled(df):
+            rows = df.drop(columns=WEIGHT_COLUMN) if is_sampled(df) else df
+            max_rows = int(len(df) * budget / len(text) * DOWNSAMPLE_MARGIN)
+            sample = sample_logs(rows, max_rows=max(max_rows, 1))
+            if is_sampled(df):
+                # Both samples weight rows uniformly per stratum, so weights multiply
+                sample[WEIGHT_COLUMN] = sample[WEIGHT_COLUMN] * df.loc[sample.index, WEIGHT_COLUMN]
+            print(f"Downsampled data-store from {len(df)} to {len(sample)} rows "
+                  f"to fit its {budget / 1024:.0f} KB budget")
+            text = _records_json(sample)
+    version = store_version(df, name) or _hash(text)
+    records = _loads(text)
+    keep_store_frame(version, records)
+    return {"version": version, "records": records}
+
+def dashboard_store():
+    """data-store contents of utils.get_dashboard_logs(), as load_data sends them."""
+    from utils import get_dashboard_logs
+    return store_records(get_dashboard_logs())
+
+def dashboard_store_version():
+    """Version dashboard_store() has, without serializing anything."""
+    from utils import get_dashboard_logs
+    return store_version(get_dashboard_logs())
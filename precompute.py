@@ -0,0 +1,274 @@
+# precompute.py
+
+"""Offline rendering of the dashboard's default callback responses.
+
+    python precompute.py [--keep 3]
+
+Loads the log once through the normal loaders and replays every callback
+that a page load runs, with the layout's default input values, through the
+app's own /_dash-update-component endpoint. Each response body is saved
+verbatim in a new snapshot directory under SNAPSHOT_DIR. The directory is
+then published by renaming it to the next version number and pointing
+SNAPSHOT_DIR/LATEST at it, so readers only ever see complete snapshots.
+
+The app wraps its callbacks with serve_snapshots(). When a snapshot exists,
+a call whose inputs (other than the data-store contents) equal the recorded
+defaults is answered with the saved body, so a cold page load is a file
+read. Any other combination is computed live, as is every call once a new
+version of the log is published (see manifest.py) or while the settings
+that shape responses differ from those recorded (see response_config()).
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import manifest
+from callback_requests import update_body
+from metrics import inc as inc_metric
+from partitions import LOG_PATH
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "data/snapshots")
+# Set to 0 to always compute live even when a snapshot exists
+SNAPSHOTS_ENABLED = os.environ.get("SNAPSHOTS", "1") == "1"
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "3"))
+LATEST_FILE = "LATEST"
+INDEX_FILE = "index.json"
+
+# Pages a browser can open cold; callbacks reading url.pathname are
+# rendered once for each
+SNAPSHOT_PATHS = ["/", "/analytics"]
+# Inputs only a user action sets; their callbacks never run on a cold load
+USER_ACTION_PROPS = {"n_clicks", "clickData"}
+DATA_STORE = "data-store.data"
+
+def _args_key(values):
+    return json.dumps(values, sort_keys=True, separators=(",", ":"))
+
+def response_config():
+    """Settings that shape the data-store and the responses built from it.
+
+    A snapshot is only served under the settings it was rendered with. The
+    dashboard window's start moves with LOG_WINDOW_HOURS, so a snapshot of a
+    windowed dashboard expires within the hour.
+    """
+    import payloads
+    import storage
+    import utils
+    from pages import analytics
+    start = utils.dashboard_window()
+    return {
+        "ingest_mode": utils.INGEST_MODE,
+        "aggregate_time_freq": utils.AGGREGATE_TIME_FREQ,
+        "sample_threshold_rows": utils.SAMPLE_THRESHOLD_ROWS,
+        "sample_seed": utils.SAMPLE_SEED,
+        "log_backend": storage.LOG_BACKEND,
+        "clientside_aggregation": analytics.CLIENTSIDE_AGGREGATION,
+        "payload_budget_action": payloads.PAYLOAD_BUDGET_ACTION,
+        "payload_budget_kb": payloads.PAYLOAD_BUDGET_KB,
+        "payload_budgets": payloads.PAYLOAD_BUDGETS,
+        "window_start": None if start is None else start.isoformat(),
+    }
+
+def _data_positions(dependency):
+    """Argument positions (inputs then state) holding the data-store contents."""
+    props = dependency["inputs"] + dependency.get("state", [])
+    return [i for i, p in enumerate(props) if f"{p['id']}.{p['property']}" == DATA_STORE]
+
+class Snapshot:
+    """A published snapshot: its version and the saved body for each call."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.version = index["version"]
+        self.created = index["created"]
+        # Log version the responses were rendered from (None: log without a manifest)
+        self.data_version = index.get("data_version")
+        # response_config() at render time (None: rendered before it was recorded)
+        self.config = index.get("config")
+        self.entries = index["entries"]
+
+    def read(self, output, key):
+        """Saved response body for output called with key, or None."""
+        name = self.entries.get(output, {}).get(key)
+        if name is None:
+            return None
+        with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+            return f.read()
+
+# (LATEST stat, Snapshot), replaced as a whole so readers need no lock
+_latest = (None, None)
+
+def latest_snapshot(root=SNAPSHOT_DIR):
+    """The newest published snapshot, or None."""
+    global _latest
+    pointer = os.path.join(root, LATEST_FILE)
+    try:
+        stat = os.stat(pointer)
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _latest
+    if cached[0] == signature:
+        return cached[1]
+    try:
+        with open(pointer) as f:
+            snapshot = Snapshot(os.path.join(root, f.read().strip()))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Ignoring unreadable snapshot in {root}: {e}")
+        snapshot = None
+    _latest = (signature, snapshot)
+    return snapshot
+
+def _serving(output, func, data_positions):
+    def serve(*args, **kwargs):
+        snapshot = latest_snapshot()
+        # Without data-store contents the page is still loading, which is cheap
+        if (snapshot is not None and all(args[i] for i in data_positions)
+                and snapshot.data_version == manifest.pinned(LOG_PATH)[0]
+                and snapshot.config == response_config()):
+            key = _args_key([v for i, v in enumerate(args) if i not in data_positions])
+            try:
+                body = snapshot.read(output, key)
+            except OSError:
+                # Pruned while being read; fall back to a live computation
+                body = None
+            if body is not None:
+                inc_metric("snapshot_responses")
+                return body
+        return func(*args, **kwargs)
+
+    serve.__name__ = getattr(func, "__name__", output)
+    serve.__wrapped__ = func
+    serve._snapshots = True
+    return serve
+
+def serve_snapshots(app):
+    """Wrap every registered callback so default calls are answered from the latest snapshot."""
+    from dash import _callback
+    if not SNAPSHOTS_ENABLED:
+        return
+    for callback_map in (app.callback_map, _callback.GLOBAL_CALLBACK_MAP):
+        for output, entry in callback_map.items():
+            func = entry.get("callback")
+            if func is None or getattr(func, "_snapshots", False):
+                continue
+            entry["callback"] = _serving(output, func, _data_positions(entry))
+
+def _layout_defaults(layouts):
+    """"id.prop" -> value for every property set on an identified component."""
+    defaults = {}
+    for layout in layouts:
+        for component in [layout] + list(layout._traverse()):
+            component_id = getattr(component, "id", None)
+            if isinstance(component_id, str):
+                for prop, value in component.to_plotly_json()["props"].items():
+                    defaults[f"{component_id}.{prop}"] = value
+    return defaults
+
+def render(client, layouts):
+    """Render the default calls; returns {output: {args key: response body}}."""
+    dependencies = [d for d in json.loads(client.get("/_dash-dependencies").data)
+                    if not d.get("clientside_function")]
+    defaults = _layout_defaults(layouts)
+    rendered = {}
+
+    def call(dependency, values):
+        body = update_body(dependency, values)
+        response = client.post("/_dash-update-component", json=body)
+        if response.status_code != 200:
+            # 204: every output was no_update
+            return None
+        args = [p["value"] for p in body["inputs"] + body["state"]]
+        positions = _data_positions(dependency)
+        key = _args_key([v for i, v in enumerate(args) if i not in positions])
+        rendered.setdefault(dependency["output"], {})[key] = response.get_data(as_text=True)
+        return response
+
+    load = next(d for d in dependencies if d["output"] == DATA_STORE)
+    data = None
+    for path in SNAPSHOT_PATHS:
+        response = call(load, {**defaults, "url.pathname": path})
+        data = json.loads(response.get_data())["response"]["data-store"]["data"]
+
+    for dependency in dependencies:
+        if dependency is load:
+            continue
+        props = {p["property"] for p in dependency["inputs"]}
+        if props & USER_ACTION_PROPS:
+            continue
+        paths = SNAPSHOT_PATHS if {"id": "url", "property": "pathname"} in dependency["inputs"] else [None]
+        for path in paths:
+            call(dependency, {**defaults, DATA_STORE: data, "url.pathname": path})
+    return rendered
+
+def _versions(root):
+    return sorted(int(name) for name in os.listdir(root) if name.isdigit())
+
+def publish(rendered, root=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP, data_version=None, config=None):
+    """Write rendered responses as the next snapshot version and point LATEST at it."""
+    os.makedirs(root, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=root, prefix=".staging-")
+    manifest.make_readable(staging)
+    entries = {}
+    for i, (output, calls) in enumerate(sorted(rendered.items())):
+        for j, (key, body) in enumerate(sorted(calls.items())):
+            name = f"{i:03d}-{j:02d}.json"
+            with open(os.path.join(staging, name), "w", encoding="utf-8") as f:
+                f.write(body)
+            entries.setdefault(output, {})[key] = name
+
+    # Another publisher may claim a version first; renaming onto an existing
+    # directory fails, so take the next one
+    while True:
+        version = max(_versions(root), default=0) + 1
+        with open(os.path.join(staging, INDEX_FILE), "w") as f:
+            json.dump({"version": version, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "data_version": data_version, "config": config,
+                       "entries": entries}, f, indent=1)
+        try:
+            os.rename(staging, os.path.join(root, f"{version:06d}"))
+            break
+        except OSError:
+            if not os.path.isdir(os.path.join(root, f"{version:06d}")):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=root, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{version:06d}")
+    manifest.make_readable(tmp_path)
+    os.replace(tmp_path, os.path.join(root, LATEST_FILE))
+
+    for old in _versions(root)[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(root, f"{old:06d}"), ignore_errors=True)
+    return version
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Precompute the dashboard's default responses")
+    parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP, help="Snapshots to keep")
+    parser.add_argument("--root", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    # Render live rather than from the previous snapshot, with data loaded upfront
+    os.environ["SNAPSHOTS"] = "0"
+    os.environ["STARTUP_MODE"] = "eager"
+    started = time.perf_counter()
+    import app
+    from pages import home, analytics
+    # Read before rendering: a version published meanwhile then only makes
+    # the snapshot unused, never wrongly served
+    data_version = manifest.current(LOG_PATH)[0]
+    config = response_config()
+    rendered = render(app.server.test_client(), [app.app.layout, home.layout, analytics.layout])
+    version = publish(rendered, args.root, args.keep, data_version, config)
+    calls = sum(len(calls) for calls in rendered.values())
+    print(f"Published snapshot {version} with {calls} responses in "
+          f"{time.perf_counter() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
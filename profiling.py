@@ -0,0 +1,157 @@
+# profiling.py
+
+"""Opt-in cProfile capture for slow callbacks and process_logs runs.
+
+Profiling is enabled for every call with PROFILE_REQUESTS=1. When a shared
+secret is set in PROFILE_TOKEN, a single request can also be profiled by
+sending it in the ``X-Profile`` header. Only runs slower than
+PROFILE_THRESHOLD_MS are kept. Each one is written as a pstats file into
+PROFILE_DIR, which keeps the newest PROFILE_KEEP files, and summarised on
+``/admin/slow-requests``. That route needs the same header and is not found
+without PROFILE_TOKEN.
+"""
+
+import cProfile
+import functools
+import hmac
+import io
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+# Empty disables the header and the admin route
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_HEADER = "X-Profile"
+PROFILE_THRESHOLD_MS = float(os.environ.get("PROFILE_THRESHOLD_MS", "500"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "data/profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+TOP_FRAMES = 10
+
+# Only one profiler can be active at a time, so concurrent or nested runs
+# are simply not profiled instead of waiting.
+_profiler_lock = threading.Lock()
+_recent = deque(maxlen=PROFILE_KEEP)
+
+def _authorized():
+    """Whether the current request carries PROFILE_TOKEN in the profile header."""
+    if not PROFILE_TOKEN:
+        return False
+    from flask import has_request_context, request
+    if not has_request_context():
+        return False
+    return hmac.compare_digest(request.headers.get(PROFILE_HEADER, ""), PROFILE_TOKEN)
+
+def _requested():
+    """Whether the current call should be profiled."""
+    return PROFILE_REQUESTS or _authorized()
+
+def _top_frames(profiler, limit=TOP_FRAMES):
+    """Return the functions with the most self time as plain dicts."""
+    stats = pstats.Stats(profiler, stream=io.StringIO()).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [
+        {
+            "function": f"{os.path.basename(filename)}:{lineno}({func})",
+            "calls": nc,
+            "self_ms": round(tt * 1000, 3),
+            "cumulative_ms": round(ct * 1000, 3),
+        }
+        for (filename, lineno, func), (cc, nc, tt, ct, callers) in rows
+    ]
+
+def _rotate():
+    """Delete all but the newest PROFILE_KEEP profile files."""
+    files = [os.path.join(PROFILE_DIR, f) for f in os.listdir(PROFILE_DIR) if f.endswith(".prof")]
+    files.sort(key=os.path.getmtime, reverse=True)
+    for path in files[PROFILE_KEEP:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _save(name, elapsed_ms, profiler):
+    started_at = datetime.now()
+    filename = f"{started_at:%Y%m%d-%H%M%S-%f}-{name}-{int(elapsed_ms)}ms.prof"
+    path = os.path.join(PROFILE_DIR, filename)
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path)
+        _rotate()
+    except OSError as e:
+        print(f"Could not write profile {path}: {e}")
+        path = None
+
+    _recent.append({
+        "name": name,
+        "time": started_at.isoformat(timespec="seconds"),
+        "elapsed_ms": round(elapsed_ms, 1),
+        "file": path,
+        "top_frames": _top_frames(profiler),
+    })
+
+def run_profiled(name, func, *args, **kwargs):
+    """Call func, profiling it if requested and keeping the profile if slow."""
+    if not _requested() or not _profiler_lock.acquire(blocking=False):
+        return func(*args, **kwargs)
+    try:
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiling tool (e.g. a debugger) already owns the hook
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms >= PROFILE_THRESHOLD_MS:
+                _save(name, elapsed_ms, profiler)
+    finally:
+        _profiler_lock.release()
+
+def profiled(name):
+    """Decorator form of run_profiled."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return run_profiled(name, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def profile_callbacks(app):
+    """Wrap every registered Dash callback with run_profiled."""
+    from dash import _callback
+
+    for callback_map in (app.callback_map, _callback.GLOBAL_CALLBACK_MAP):
+        for entry in callback_map.values():
+            func = entry.get("callback")
+            if func is None or getattr(func, "_profiled", False):
+                continue
+            wrapped = profiled(getattr(func, "__name__", "callback"))(func)
+            wrapped._profiled = True
+            entry["callback"] = wrapped
+
+def recent_slow_requests():
+    """Most recent slow runs first."""
+    return list(reversed(_recent))
+
+def register_route(server, path="/admin/slow-requests"):
+    """Expose recent_slow_requests() as JSON on the Flask server."""
+    from flask import abort, jsonify
+
+    def slow_requests_view():
+        if not _authorized():
+            abort(404)
+        return jsonify({
+            "threshold_ms": PROFILE_THRESHOLD_MS,
+            "profile_dir": PROFILE_DIR,
+            "requests": recent_slow_requests(),
+        })
+
+    server.add_url_rule(path, "slow_requests", slow_requests_view)
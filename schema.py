@@ -0,0 +1,37 @@
+# schema.py
+
+"""Layout of the log CSV and of the processed rows built from it.
+
+Imported by utils (parsing and validation), partitions (the header of every
+part) and storage (the SQLite table), so the three agree on one column list
+and timestamp format. It only imports the value lists from log_generator.
+"""
+
+from log_generator import countries as country_ip_ranges, USER_ROLES
+
+AGE_GROUPS = ["18-24", "25-34", "35-44", "45-54", "55+"]
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Declared layout of the log CSV as written by log_generator, in file order.
+# Columns listed with a domain only accept those values; everything else is
+# rejected.
+LOG_SCHEMA = {
+    'timestamp': {'dtype': 'str'},
+    'ip': {'dtype': 'str'},
+    'method': {'dtype': 'category'},
+    'endpoint': {'dtype': 'category'},
+    'status': {'dtype': 'Int64'},
+    'country': {'dtype': 'category', 'domain': list(country_ip_ranges)},
+    'user_role': {'dtype': 'category', 'domain': USER_ROLES},
+    'age_group': {'dtype': 'category', 'domain': AGE_GROUPS},
+}
+LOG_COLUMNS = list(LOG_SCHEMA)
+
+# Columns enrich_logs adds to every processed row
+DERIVED_COLUMNS = ['datetime', 'plotly_country', 'request_type']
+PROCESSED_COLUMNS = LOG_COLUMNS + DERIVED_COLUMNS
+
+def schema_dtypes():
+    """read_csv dtypes from LOG_SCHEMA."""
+    return {col: spec['dtype'] for col, spec in LOG_SCHEMA.items()}
@@ -0,0 +1,360 @@
+# sessions.py
+
+"""Visitor sessions built from log rows.
+
+A session is a run of requests from one IP with no gap longer than
+SESSION_GAP_MINUTES. Rows are sorted by (ip, datetime) and split with
+vectorized diffs. Per-session values (start, end, request count, request
+types, funnel progress) come from numpy reductions over the sorted rows,
+not from Python loops.
+
+SessionTracker applies this incrementally. Ingestion feeds it each
+processed chunk. It keeps every IP's last session open and merges it with
+that IP's first session in later rows when they are within the gap.
+Sessions that can no longer grow are folded into SessionCounts, which
+keep per-dimension counts by session length, so memory grows with the
+number of open sessions rather than with the log. Incremental results
+match a full pass when the rows arrive in time order across chunks, as
+they do in an appended log.
+"""
+
+# numpy and pandas are imported inside the functions that need them, as in
+# utils, so importing the app does not load them.
+import os
+import threading
+
+SESSION_GAP_MINUTES = float(os.environ.get("SESSION_GAP_MINUTES", "30"))
+
+# Values of utils.categorize_endpoint; the bit for each is set in type_mask
+REQUEST_TYPES = ["Scheduled Demo", "Promotional Event", "Job Request", "AI Assistant", "Other"]
+
+# Ordered request types a session must go through, e.g. trying the AI
+# assistant and then booking a demo
+FUNNELS = {
+    "AI Assistant → Scheduled Demo": ["AI Assistant", "Scheduled Demo"],
+    "Promotional Event → Scheduled Demo": ["Promotional Event", "Scheduled Demo"],
+}
+
+SESSION_COLUMNS = ['ip', 'plotly_country', 'user_role', 'start', 'end', 'requests', 'type_mask']
+# Values session_stats groups by
+STAT_DIMENSIONS = ['plotly_country', 'user_role', 'request_type']
+
+def _funnel_columns(index):
+    return f"funnel_{index}_step", f"funnel_{index}_at"
+
+def _empty_sessions():
+    import numpy as np
+    import pandas as pd
+    dtypes = {'ip': 'str', 'plotly_country': 'category', 'user_role': 'category',
+              'start': 'datetime64[ns]', 'end': 'datetime64[ns]',
+              'requests': np.int64, 'type_mask': np.uint8}
+    for i in range(len(FUNNELS)):
+        step, at = _funnel_columns(i)
+        dtypes[step] = np.int8
+        dtypes[at] = 'datetime64[ns]'
+    return pd.DataFrame({col: pd.Series([], dtype=dtype) for col, dtype in dtypes.items()}).set_index('ip', drop=False).rename_axis(None)
+
+def _advance_funnel(steps, progress, reached_at, session_of_row, type_codes, times):
+    """Advance each session's funnel progress over its (time-sorted) rows.
+
+    progress[s] is the number of steps session s has completed and
+    reached_at[s] when it completed the last one. A step only counts if
+    it happens at or after the previous step.
+    """
+    import numpy as np
+    for k, request_type in enumerate(steps):
+        code = REQUEST_TYPES.index(request_type)
+        waiting = progress[session_of_row] == k
+        candidates = np.flatnonzero(waiting & (type_codes == code) & (times >= reached_at[session_of_row]))
+        if not len(candidates):
+            continue
+        # Rows are sorted by session then time, so each session's first hit
+        # is its earliest
+        hit_sessions = session_of_row[candidates]
+        first = np.flatnonzero(np.append(True, hit_sessions[1:] != hit_sessions[:-1]))
+        progress[hit_sessions[first]] = k + 1
+        reached_at[hit_sessions[first]] = times[candidates[first]]
+
+def _take_categorical(column, positions):
+    """column[positions] as a Categorical, without materializing the labels."""
+    import pandas as pd
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return pd.Categorical.from_codes(column.cat.codes.to_numpy()[positions],
+                                         dtype=column.dtype)
+    return pd.Categorical(column.to_numpy()[positions])
+
+def _overwrite(values, mask, replacements):
+    """Categorical values with values[mask] set to replacements."""
+    import pandas as pd
+    if not mask.any():
+        return values
+    replacements = pd.Categorical(replacements)
+    categories = values.categories.union(replacements.categories, sort=False)
+    codes = values.set_categories(categories).codes.copy()
+    codes[mask] = replacements.set_categories(categories).codes
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+def build_sessions(rows, gap_minutes=SESSION_GAP_MINUTES, carried=None):
+    """Split processed log rows into sessions.
+
+    carried holds open sessions from earlier rows, indexed by ip. Each
+    IP's first session here is merged into its carried one when it starts
+    within the gap. Returns (sessions, touched, continued): one row per
+    session in SESSION_COLUMNS plus funnel progress, and boolean masks over
+    carried of the sessions whose IP appears in rows and of those merged
+    into a session here.
+    """
+    import numpy as np
+    import pandas as pd
+    n_carried = 0 if carried is None else len(carried)
+    touched = np.zeros(n_carried, dtype=bool)
+    continued = np.zeros(n_carried, dtype=bool)
+    if rows.empty:
+        return _empty_sessions(), touched, continued
+
+    gap = int(gap_minutes * 60 * 1e9)
+    ip_codes, ips = pd.factorize(rows['ip'])
+    times = rows['datetime'].to_numpy(dtype='datetime64[ns]').view('int64')
+    type_codes = pd.Categorical(rows['request_type'], categories=REQUEST_TYPES).codes.astype(np.int8)
+    type_codes[type_codes < 0] = REQUEST_TYPES.index("Other")
+
+    order = np.lexsort((times, ip_codes))
+    ip_codes, times, type_codes = ip_codes[order], times[order], type_codes[order]
+
+    new_ip = np.empty(len(order), dtype=bool)
+    new_ip[0] = True
+    new_ip[1:] = ip_codes[1:] != ip_codes[:-1]
+    new_session = new_ip.copy()
+    new_session[1:] |= np.diff(times) > gap
+    starts = np.flatnonzero(new_session)
+    session_of_row = np.cumsum(new_session) - 1
+    ends = np.append(starts[1:], len(order))
+
+    session_ips = ips.take(ip_codes[starts])
+    start = times[starts]
+    end = times[ends - 1]
+    requests = ends - starts
+    type_mask = np.bitwise_or.reduceat(np.left_shift(1, type_codes).astype(np.uint8), starts)
+    # Country and role of each session's first row, kept as categoricals
+    first_rows = order[starts]
+    countries = _take_categorical(rows['plotly_country'], first_rows)
+    roles = _take_categorical(rows['user_role'], first_rows)
+
+    n_funnels = len(FUNNELS)
+    progress = np.zeros((n_funnels, len(starts)), dtype=np.int8)
+    reached_at = np.full((n_funnels, len(starts)), np.iinfo(np.int64).min, dtype=np.int64)
+
+    if n_carried:
+        # Only an IP's first session here can continue its carried session
+        first = new_ip[starts]
+        position = carried.index.get_indexer(session_ips)
+        carried_end = carried['end'].to_numpy(dtype='datetime64[ns]').view('int64')
+        merge = first & (position >= 0)
+        merge[merge] = start[merge] - carried_end[position[merge]] <= gap
+        source = position[merge]
+        touched[position[position >= 0]] = True
+        continued[source] = True
+        start[merge] = carried['start'].to_numpy(dtype='datetime64[ns]').view('int64')[source]
+        requests[merge] += carried['requests'].to_numpy(dtype=np.int64)[source]
+        type_mask[merge] |= carried['type_mask'].to_numpy().astype(np.uint8)[source]
+        countries = _overwrite(countries, merge, carried['plotly_country'].take(source))
+        roles = _overwrite(roles, merge, carried['user_role'].take(source))
+        for i in range(n_funnels):
+            step, at = _funnel_columns(i)
+            progress[i, merge] = carried[step].to_numpy()[source]
+            reached_at[i, merge] = carried[at].to_numpy(dtype='datetime64[ns]').view('int64')[source]
+
+    for i, steps in enumerate(FUNNELS.values()):
+        _advance_funnel(steps, progress[i], reached_at[i], session_of_row, type_codes, times)
+
+    sessions = pd.DataFrame({
+        'ip': session_ips,
+        'plotly_country': countries,
+        'user_role': roles,
+        'start': start.view('datetime64[ns]'),
+        'end': end.view('datetime64[ns]'),
+        'requests': requests,
+        'type_mask': type_mask,
+    })
+    for i in range(n_funnels):
+        step, at = _funnel_columns(i)
+        sessions[step] = progress[i]
+        sessions[at] = reached_at[i].view('datetime64[ns]')
+    return sessions, touched, continued
+
+def _weighted_median(values, weights):
+    """np.median of values each repeated weights times."""
+    import numpy as np
+    order = np.argsort(values, kind='stable')
+    values, cumulative = values[order], np.cumsum(weights[order])
+    n = cumulative[-1]
+    low = values[np.searchsorted(cumulative, (n - 1) // 2, side='right')]
+    high = values[np.searchsorted(cumulative, n // 2, side='right')]
+    return (low + high) / 2
+
+class SessionCounts:
+    """What session_stats and funnel_counts need from a set of sessions.
+
+    Per value of each of STAT_DIMENSIONS, the number of sessions and their
+    requests for every session length in whole seconds (log timestamps have
+    no finer resolution), so medians stay exact. Its size grows with the
+    distinct lengths, not with the number of sessions.
+    """
+
+    def __init__(self):
+        self.total = 0
+        # dimension -> frame indexed by (value, seconds) with sessions and requests
+        self.lengths = {}
+        self.funnel_steps = [[0] * len(steps) for steps in FUNNELS.values()]
+
+    def copy(self):
+        counts = SessionCounts()
+        counts.total = self.total
+        counts.lengths = dict(self.lengths)
+        counts.funnel_steps = [list(steps) for steps in self.funnel_steps]
+        return counts
+
+    def add(self, sessions):
+        """Count sessions, a frame as built by build_sessions."""
+        import numpy as np
+        import pandas as pd
+        if sessions.empty:
+            return
+        seconds = ((sessions['end'] - sessions['start']) // pd.Timedelta(seconds=1)).to_numpy()
+        requests = sessions['requests'].to_numpy()
+        mask = sessions['type_mask'].to_numpy()
+        for by in STAT_DIMENSIONS:
+            if by == 'request_type':
+                # A session counts towards every request type it contains
+                selected = [(mask & (1 << i)) != 0 for i in range(len(REQUEST_TYPES))]
+                values = np.concatenate([np.full(s.sum(), t, dtype=object)
+                                         for s, t in zip(selected, REQUEST_TYPES)])
+                rows = pd.DataFrame({'value': values,
+                                     'seconds': np.concatenate([seconds[s] for s in selected]),
+                                     'sessions': 1,
+                                     'requests': np.concatenate([requests[s] for s in selected])})
+            else:
+                rows = pd.DataFrame({'value': np.asarray(sessions[by], dtype=object),
+                                     'seconds': seconds, 'sessions': 1, 'requests': requests})
+            table = rows.groupby(['value', 'seconds'])[['sessions', 'requests']].sum()
+            if by in self.lengths:
+                table = pd.concat([self.lengths[by], table]).groupby(level=[0, 1]).sum()
+            self.lengths[by] = table
+        for i in range(len(FUNNELS)):
+            progress = sessions[_funnel_columns(i)[0]].to_numpy()
+            steps = self.funnel_steps[i]
+            for k in range(len(steps)):
+                steps[k] += int((progress > k).sum())
+        self.total += len(sessions)
+
+def count_sessions(sessions):
+    """SessionCounts of a frame of sessions."""
+    counts = SessionCounts()
+    counts.add(sessions)
+    return counts
+
+class SessionTracker:
+    """Incrementally maintained sessions: counts of closed ones plus one open session per IP.
+
+    A session is closed, and only counted from then on, once another session
+    of its IP starts or once it ended more than the gap before the newest
+    row seen, after which no row in time order can extend it.
+    """
+
+    stage = "sessionization"
+
+    def __init__(self, gap_minutes=SESSION_GAP_MINUTES):
+        self.gap_minutes = gap_minutes
+        self.open = _empty_sessions()
+        self.closed = SessionCounts()
+        self.latest = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Pickled by ingestd.py into the ingest state (see ingest_state.py)
+        with self._lock:
+            state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def observe_frame(self, rows):
+        """Add newly ingested rows."""
+        import numpy as np
+        import pandas as pd
+        with self._lock:
+            sessions, touched, continued = build_sessions(rows, self.gap_minutes, self.open)
+            if sessions.empty:
+                return
+            # An IP's last session stays open; earlier ones can no longer grow
+            ips = sessions['ip']
+            last = np.append((ips.iloc[1:].to_numpy() != ips.iloc[:-1].to_numpy()), True)
+            self.closed.add(self.open[touched & ~continued])
+            self.closed.add(sessions[~last])
+            self.open = pd.concat([self.open[~touched],
+                                   sessions[last].set_index('ip', drop=False).rename_axis(None)])
+            newest = rows['datetime'].max()
+            self.latest = newest if self.latest is None else max(self.latest, newest)
+            expired = (self.open['end'] < self.latest - pd.Timedelta(minutes=self.gap_minutes)).to_numpy()
+            if expired.any():
+                self.closed.add(self.open[expired])
+                self.open = self.open[~expired]
+
+    def counts(self):
+        """SessionCounts of all sessions so far, closed and open."""
+        with self._lock:
+            counts = self.closed.copy()
+            counts.add(self.open)
+            return counts
+
+def session_stats(counts, by='plotly_country'):
+    """Session count, length and requests per session for each value of by.
+
+    counts is a SessionCounts; by is one of STAT_DIMENSIONS. A session
+    counts towards every request type it contains.
+    """
+    import pandas as pd
+    columns = [by, 'sessions', 'avg_minutes', 'median_minutes', 'avg_requests']
+    table = counts.lengths.get(by)
+    rows = []
+    if table is not None:
+        for value, group in table.groupby(level=0, sort=False):
+            seconds = group.index.get_level_values(1).to_numpy()
+            sessions = group['sessions'].to_numpy()
+            total = int(sessions.sum())
+            rows.append({
+                by: value,
+                'sessions': total,
+                'avg_minutes': (seconds * sessions).sum() / total / 60,
+                'median_minutes': _weighted_median(seconds, sessions) / 60,
+                'avg_requests': group['requests'].sum() / total,
+            })
+    stats = pd.DataFrame(rows, columns=columns)
+    return stats.sort_values('sessions', ascending=False).round(2).reset_index(drop=True)
+
+def funnel_counts(counts):
+    """Sessions reaching each step of every funnel, as (funnel, step, sessions) rows."""
+    import pandas as pd
+    rows = []
+    for (name, steps), reached in zip(FUNNELS.items(), counts.funnel_steps):
+        for step, sessions in zip(steps, reached):
+            rows.append({'funnel': name, 'step': step, 'sessions': sessions})
+    return pd.DataFrame(rows, columns=['funnel', 'step', 'sessions'])
+
+# Created on first use so importing this module stays cheap
+_tracker = None
+
+def get_tracker():
+    """The process's tracker, fed each new row once (see utils.observe_log)."""
+    global _tracker
+    if _tracker is None:
+        _tracker = SessionTracker()
+    return _tracker
+
+def publish(tracker):
+    """Make tracker the one the dashboard reads from."""
+    global _tracker
+    _tracker = tracker
@@ -0,0 +1,150 @@
+# storage.py
+
+"""Optional SQLite storage for processed log rows.
+
+Enabled with LOG_BACKEND=sqlite. Once the store has been loaded, the web
+app reads the dashboard's data-store from SQLITE_PATH (see
+utils.get_store_logs): the dashboard window is selected in SQL, and in
+aggregate mode the counts are grouped there too, so the app never
+processes the log into a frame of its own.
+
+The app only reads the database. It is written by one process at a time,
+under SQLITE_PATH + ".lock": ingestd.py appends the rows of each batch it
+publishes, and
+
+    python storage.py load [log path]
+
+(re)builds it from the whole log, streaming it in chunks. The meta table
+records the log version (see manifest.py) the rows match.
+"""
+
+import os
+import sqlite3
+import threading
+
+from schema import LOG_SCHEMA, PROCESSED_COLUMNS, TIMESTAMP_FORMAT
+
+LOG_BACKEND = os.environ.get("LOG_BACKEND", "pandas")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "data/server_logs.db")
+INSERT_BATCH_SIZE = 10000
+# How long a reader waits for a writer's transaction to commit
+BUSY_TIMEOUT_SECONDS = 30
+
+# Column name -> SQLite type, in table order: the processed columns of
+# schema.py, with datetimes stored as TIMESTAMP_FORMAT text
+LOG_COLUMNS = {
+    col: "INTEGER" if LOG_SCHEMA.get(col, {}).get("dtype") == "Int64" else "TEXT"
+    for col in PROCESSED_COLUMNS
+}
+
+INDEXES = {
+    "idx_logs_datetime": ("datetime",),
+    "idx_logs_country_datetime": ("plotly_country", "datetime"),
+    "idx_logs_request_type_datetime": ("request_type", "datetime"),
+    "idx_logs_role_age": ("user_role", "age_group"),
+}
+
+class SQLiteLogStore:
+    """A WAL-mode SQLite table of processed log rows with one connection per thread."""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._create_schema()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_schema(self):
+        columns = ", ".join(f"{name} {kind}" for name, kind in LOG_COLUMNS.items())
+        with self.connection as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS logs ({columns})")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            for name, columns in INDEXES.items():
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON logs ({', '.join(columns)})")
+
+    def _rows(self, df):
+        """Restrict df to the table columns with datetimes as sortable text."""
+        rows = df.reindex(columns=list(LOG_COLUMNS))
+        if "datetime" in df.columns:
+            rows["datetime"] = df["datetime"].dt.strftime(TIMESTAMP_FORMAT)
+        return rows
+
+    def loaded_version(self):
+        """Version id of the log the rows match, or None before the first load."""
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'log_version'").fetchone()
+        return None if row is None else int(row[0])
+
+    def _set_version(self, conn, version):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('log_version', ?)",
+                     (str(version),))
+
+    def append(self, df, version):
+        """Insert processed rows in batches and record version, within one transaction."""
+        with self.connection as conn:
+            self._rows(df).to_sql("logs", conn, if_exists="append", index=False,
+                                  chunksize=INSERT_BATCH_SIZE)
+            self._set_version(conn, version)
+
+    def load(self, chunks, version):
+        """Swap the whole table contents for the rows of chunks atomically; returns the row count."""
+        rows = 0
+        with self.connection as conn:
+            conn.execute("DELETE FROM logs")
+            for chunk in chunks:
+                self._rows(chunk).to_sql("logs", conn, if_exists="append", index=False,
+                                         chunksize=INSERT_BATCH_SIZE)
+                rows += len(chunk)
+            self._set_version(conn, version)
+        return rows
+
+    def query(self, sql, params=()):
+        """Run a SELECT and return the result as a DataFrame."""
+        import pandas as pd
+        df = pd.read_sql_query(sql, self.connection, params=params)
+        if "datetime" in df.columns:
+            df["datetime"] = pd.to_datetime(df["datetime"], format=TIMESTAMP_FORMAT)
+        return df
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM logs").fetchone()[0]
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Return the process-wide store, or None when the pandas backend is active."""
+    global _store
+    if LOG_BACKEND != "sqlite":
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = SQLiteLogStore()
+    return _store
+
+def writer_lock(store):
+    """Lock held by the one process writing to store."""
+    from manifest import file_lock
+    return file_lock(store.path + ".lock")
+
+if __name__ == "__main__":
+    import argparse
+    from partitions import LOG_PATH
+    parser = argparse.ArgumentParser(description="Load a log into the SQLite store")
+    parser.add_argument("command", choices=["load"])
+    parser.add_argument("log_path", nargs="?", default=LOG_PATH)
+    args = parser.parse_args()
+    from utils import load_store
+    store = SQLiteLogStore()
+    version, rows = load_store(store, args.log_path)
+    print(f"Loaded {rows} rows of {args.log_path} version {version} into {store.path}")
@@ -1,12 +1,27 @@
 # utils.py
 
-import pandas as pd
+# pandas is imported inside the functions that need it so importing the app
+# (and health-checking it) does not pay for it up front.
+import csv
+import functools
+import io
 import ipaddress
-from datetime import datetime
-from log_generator import countries as country_ip_ranges, USER_ROLES
-
-# Age groups for random assignment
-AGE_GROUPS = ["18-24", "25-34", "35-44", "45-54", "55+"]
+import os
+import threading
+from datetime import datetime, timedelta
+from log_generator import countries as country_ip_ranges
+import anomalies
+import ingest_state
+import manifest
+import partitions
+import sessions
+from cache import memoize, register_version
+from partitions import LOG_PATH
+from metrics import stage_timer, inc as inc_metric, record_bad_rows
+from profiling import profiled
+from schema import (AGE_GROUPS, DERIVED_COLUMNS, LOG_COLUMNS, LOG_SCHEMA,
+                    TIMESTAMP_FORMAT, schema_dtypes)
+from storage import get_store, writer_lock
 
 # utils.py - Update PLOTLY_COUNTRY_MAPPING
 PLOTLY_COUNTRY_MAPPING = {
@@ -35,12 +50,57 @@ PLOTLY_COUNTRY_MAPPING = {
 # Reverse mapping for validation
 PLOTLY_TO_OUR_COUNTRY = {v: k for k, v in PLOTLY_COUNTRY_MAPPING.items()}
 
+# ISO 3166-1 alpha-3 codes, used as choropleth locations so plotly.js does
+# not have to resolve country names
+ISO3_COUNTRY_CODES = {
+    'United States': 'USA',
+    'United Kingdom': 'GBR',
+    'Germany': 'DEU',
+    'France': 'FRA',
+    'Japan': 'JPN',
+    'India': 'IND',
+    'Brazil': 'BRA',
+    'Australia': 'AUS',
+    'Canada': 'CAN',
+    'China': 'CHN',
+    'South Africa': 'ZAF',
+    'Mexico': 'MEX',
+    'Russia': 'RUS',
+    'South Korea': 'KOR',
+    'Singapore': 'SGP',
+    'Italy': 'ITA',
+    'Spain': 'ESP',
+    'Netherlands': 'NLD',
+    'Sweden': 'SWE',
+    'Switzerland': 'CHE'
+}
+
+# ISO-3 code back to the Plotly country name used throughout the pages
+ISO3_TO_PLOTLY_COUNTRY = {code: PLOTLY_COUNTRY_MAPPING[country]
+                          for country, code in ISO3_COUNTRY_CODES.items()}
+
+def get_iso3(country):
+    """ISO-3 code for a country in either naming convention, or None."""
+    return ISO3_COUNTRY_CODES.get(PLOTLY_TO_OUR_COUNTRY.get(country, country))
+
+# The log's columns are declared in schema.LOG_SCHEMA
+REQUIRED_COLUMNS = LOG_COLUMNS
+
+# CSV parser for log chunks: "auto" uses pyarrow when installed, else "c"
+LOG_CSV_ENGINE = os.environ.get("LOG_CSV_ENGINE", "auto")
+
+def _out_of_domain(df):
+    """Boolean mask of rows with a value outside its column's declared domain."""
+    import pandas as pd
+    mask = pd.Series(False, index=df.index)
+    for col, spec in LOG_SCHEMA.items():
+        if 'domain' in spec and col in df.columns:
+            mask |= df[col].notna() & ~df[col].isin(spec['domain'])
+    return mask
+
 def validate_dataframe(df):
     """Validate essential columns and country values."""
-    required_columns = ['timestamp', 'ip', 'method', 'endpoint', 'status', 
-                       'country', 'user_role', 'age_group']
-    
-    if not all(col in df.columns for col in required_columns):
+    if not all(col in df.columns for col in REQUIRED_COLUMNS):
         print("Missing required columns in dataframe")
         return False
     
@@ -48,6 +108,10 @@ def validate_dataframe(df):
     if df.empty or df['country'].isnull().all():
         print("Empty dataframe or no valid countries")
         return False
+
+    if _out_of_domain(df).any():
+        print("Values outside the declared log schema")
+        return False
     
     return True
 
@@ -80,68 +144,1030 @@ def get_country_from_ip(ip):
     except Exception:
         return "Unknown"
 
-def process_logs(log_file="data/server_logs.csv"):
-    try:
-        df = pd.read_csv(log_file)
+def enrich_logs(df):
+    """Add datetime, plotly_country and request_type columns to raw log rows."""
+    import pandas as pd
 
-        # Convert timestamp to datetime
-        df['datetime'] = pd.to_datetime(df['timestamp'], errors='coerce')
+    # Convert timestamp to datetime (validate_rows may have done it already)
+    with stage_timer("datetime_parse"):
+        if 'datetime' not in df.columns:
+            df['datetime'] = pd.to_datetime(df['timestamp'], format=TIMESTAMP_FORMAT,
+                                            errors='coerce')
         df = df.dropna(subset=['datetime'])
 
+    with stage_timer("country_mapping"):
         # Ensure country column exists and is valid
         if 'country' not in df.columns:
             df['country'] = df['ip'].apply(get_country_from_ip)
         
-        # Create a dedicated column for Plotly-compatible country names
-        df['plotly_country'] = df['country'].replace(PLOTLY_COUNTRY_MAPPING)
+        # Create a dedicated column for Plotly-compatible country names.
+        # Mapping the distinct values keeps categorical columns categorical,
+        # and mapping every category gives each chunk the same categories.
+        countries = df['country']
+        countries = (countries.cat.categories if isinstance(countries.dtype, pd.CategoricalDtype)
+                     else countries.dropna().unique())
+        plotly_names = {c: PLOTLY_COUNTRY_MAPPING.get(c, c) for c in countries}
+        df['plotly_country'] = df['country'].map(plotly_names)
         
         # Remove any rows with null countries
         df = df.dropna(subset=['plotly_country'])
-        
-        # Categorize endpoints
-        df['request_type'] = df['endpoint'].apply(categorize_endpoint)
-        
-        # Ensure numeric values
-        df['status'] = pd.to_numeric(df['status'], errors='coerce')
-        
-        print("Processed data sample:", df[['country', 'plotly_country']].head())
-        print("Unique plotly countries:", df['plotly_country'].unique())
-        
-        return df
+    
+    # Categorize endpoints, once per distinct endpoint
+    with stage_timer("categorization"):
+        request_types = {e: categorize_endpoint(e) for e in df['endpoint'].dropna().unique()}
+        df['request_type'] = df['endpoint'].map(request_types)
+    
+    # Ensure numeric values
+    df['status'] = pd.to_numeric(df['status'], errors='coerce')
+    return df
 
-    except Exception as e:
+QUARANTINE_FILE = os.environ.get("QUARANTINE_FILE", "data/quarantine.csv")
+
+# Reason codes for rejected rows, used in the quarantine file and metrics
+BAD_FIELD_COUNT = "field_count"
+BAD_MISSING_FIELD = "missing_field"
+BAD_TIMESTAMP = "bad_timestamp"
+BAD_STATUS = "bad_status"
+BAD_VALUE = "unknown_value"
+
+class LogFormatError(ValueError):
+    """The log header lacks required columns, so no row can be used."""
+
+@functools.lru_cache(maxsize=None)
+def _csv_engine():
+    if LOG_CSV_ENGINE in ("auto", "pyarrow"):
+        try:
+            import pyarrow  # noqa: F401
+            return "pyarrow"
+        except ImportError:
+            if LOG_CSV_ENGINE == "pyarrow":
+                print("pyarrow is not installed, reading logs with the C engine")
+    return "c"
+
+def _read_arrow(data, columns, usecols):
+    """Parse with pyarrow.csv, dictionary-encoding the categorical columns."""
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    arrow_types = {'str': pa.string(), 'Int64': pa.int64(),
+                   'category': pa.dictionary(pa.int32(), pa.string())}
+    table = pa_csv.read_csv(
+        io.BytesIO(data),
+        read_options=pa_csv.ReadOptions(column_names=columns),
+        parse_options=pa_csv.ParseOptions(quote_char=False),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={col: arrow_types[spec['dtype']] for col, spec in LOG_SCHEMA.items()},
+            include_columns=usecols,
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+def _parse_lines(data, columns):
+    """Parse CSV lines, all with the header's field count, with the schema's dtypes.
+
+    A chunk whose values do not fit the declared dtypes (e.g. a non-numeric
+    status) is re-read untyped so validate_rows can reject the offending rows.
+    """
+    import pandas as pd
+    usecols = [col for col in columns if col in LOG_SCHEMA]
+    if _csv_engine() == "pyarrow":
+        try:
+            return _read_arrow(data, columns, usecols)
+        except ValueError:
+            pass
+    # The C parser reads numbers as floats far faster than as nullable ints
+    integers = {col: dtype for col, dtype in schema_dtypes().items() if dtype == 'Int64'}
+    try:
+        rows = pd.read_csv(io.BytesIO(data), header=None, names=columns, usecols=usecols,
+                           dtype={**schema_dtypes(), **dict.fromkeys(integers, 'float64')},
+                           quoting=csv.QUOTE_NONE)
+        return rows.astype(integers)
+    except (ValueError, TypeError):
+        return pd.read_csv(io.BytesIO(data), header=None, names=columns, usecols=usecols,
+                           dtype=str, quoting=csv.QUOTE_NONE)
+
+def _line_blocks(f, block_bytes):
+    """Yield blocks of whole lines of roughly block_bytes from a binary file."""
+    remainder = b''
+    while True:
+        block = f.read(block_bytes)
+        if not block:
+            if remainder:
+                yield remainder
+            return
+        block = remainder + block
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            # A single line longer than the block, keep reading
+            remainder = block
+            continue
+        remainder = block[cut:]
+        yield block[:cut]
+
+def read_log_chunks(log_file, chunk_rows, offset=0, first_line=2):
+    """Yield (rows, bad_lines) for successive blocks of about chunk_rows lines.
+
+    Reading starts offset bytes past the header, at line number first_line.
+
+    Lines whose field count does not match the header are set aside as
+    (line number, raw bytes) before pandas parses the rest, so one broken
+    line never fails the chunk. rows is indexed by file line number and typed
+    per LOG_SCHEMA. The log format never quotes fields, so quotes are read
+    literally.
+    """
+    import pandas as pd
+    with open(log_file, 'rb') as f:
+        header_line = f.readline()
+        if not header_line.strip():
+            raise pd.errors.EmptyDataError(f"{log_file} has no header")
+        columns = header_line.decode('utf-8', 'replace').strip().split(',')
+        missing = [col for col in REQUIRED_COLUMNS if col not in columns]
+        if missing:
+            raise LogFormatError(f"{log_file} is missing required columns: {missing}")
+
+        if offset:
+            f.seek(len(header_line) + offset)
+        sample = f.peek(1 << 16)
+        line_bytes = max(len(sample) // max(sample.count(b'\n'), 1), 1)
+        line_number = first_line
+        for block in _line_blocks(f, max(chunk_rows, 1) * line_bytes):
+            with stage_timer("read"):
+                rows, bad = parse_log_block(block, columns, line_number)
+                line_number += block.count(b'\n') + (not block.endswith(b'\n'))
+            yield rows, bad
+
+def _line_bounds(block):
+    """(starts, ends, separators) of each line in block, found with numpy.
+
+    ends are the offsets of the newlines (or of the block's end for a last
+    line without one) and separators the number of commas on each line.
+    """
+    import numpy as np
+    data = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord('\n'))
+    if not block.endswith(b'\n'):
+        ends = np.append(ends, len(block))
+    starts = np.append(0, ends[:-1] + 1)
+    commas = np.flatnonzero(data == ord(','))
+    separators = np.diff(np.searchsorted(commas, ends), prepend=0)
+    return starts, ends, separators
+
+def parse_log_block(block, columns, first_line):
+    """Parse a block of whole log lines into (rows, bad_lines) as read_log_chunks does.
+
+    columns is the log's header and first_line the line number of the
+    block's first line. The block is parsed by one read_csv (or pyarrow)
+    call; lines with the wrong field count, which the C parser would pad or
+    truncate silently, are cut out of it first.
+    """
+    import numpy as np
+    import pandas as pd
+    starts, ends, separators = _line_bounds(block)
+    misfits = np.flatnonzero(separators != len(columns) - 1)
+    bad = []
+    data = block
+    if len(misfits):
+        pieces, kept_from = [], 0
+        for i in misfits:
+            line = block[starts[i]:ends[i]]
+            # Blank lines are skipped without being reported
+            if line.strip():
+                bad.append((first_line + int(i), line))
+            pieces.append(block[kept_from:starts[i]])
+            kept_from = ends[i] + 1
+        pieces.append(block[kept_from:])
+        data = b''.join(pieces)
+    numbers = first_line + np.delete(np.arange(len(ends)), misfits)
+    if len(numbers):
+        rows = _parse_lines(data, columns)
+    else:
+        rows = pd.DataFrame(columns=[col for col in columns if col in LOG_SCHEMA])
+    rows.index = numbers
+    return rows, bad
+
+def validate_rows(df):
+    """Split parsed rows into (valid, invalid); invalid rows get a 'reason' column.
+
+    Valid rows come back with datetime parsed and status numeric.
+    """
+    import pandas as pd
+    reasons = pd.Series(None, index=df.index, dtype=object)
+    reasons[df[REQUIRED_COLUMNS].isna().any(axis=1)] = BAD_MISSING_FIELD
+
+    with stage_timer("datetime_parse"):
+        datetimes = pd.to_datetime(df['timestamp'], format=TIMESTAMP_FORMAT, errors='coerce')
+    reasons[reasons.isna() & datetimes.isna()] = BAD_TIMESTAMP
+
+    status = pd.to_numeric(df['status'], errors='coerce')
+    reasons[reasons.isna() & status.isna()] = BAD_STATUS
+
+    reasons[reasons.isna() & _out_of_domain(df)] = BAD_VALUE
+
+    bad = reasons.notna()
+    valid = df[~bad].copy()
+    valid['datetime'] = datetimes[~bad]
+    valid['status'] = status[~bad].astype(LOG_SCHEMA['status']['dtype'])
+    # Fix categorical columns to their declared domain so chunks concatenate
+    # without falling back to object columns
+    for col, spec in LOG_SCHEMA.items():
+        if 'domain' in spec:
+            valid[col] = valid[col].astype(pd.CategoricalDtype(spec['domain']))
+    return valid, df[bad].assign(reason=reasons[bad])
+
+class Quarantine:
+    """Rejected rows of one ingestion pass, written as line,reason,raw CSV.
+
+    The file is written under a temporary name and renamed on close, so it
+    always describes a complete pass. With append=True (for a long-running
+    ingester) rows are instead added to the end of path, and are visible
+    there once flush() is called.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.counts = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if append:
+            self._tmp_path = None
+            self._file = open(path, 'a', newline='')
+            new = self._file.tell() == 0
+        else:
+            self._tmp_path = f"{path}.{os.getpid()}.tmp"
+            self._file = open(self._tmp_path, 'w', newline='')
+            new = True
+        self._writer = csv.writer(self._file)
+        if new:
+            self._writer.writerow(['line', 'reason', 'raw'])
+
+    def _count(self, reason, n):
+        self.counts[reason] = self.counts.get(reason, 0) + n
+
+    def add_lines(self, bad_lines, reason=BAD_FIELD_COUNT):
+        for line_number, raw in bad_lines:
+            self._writer.writerow([line_number, reason, raw.decode('utf-8', 'replace').rstrip('\r\n')])
+        if bad_lines:
+            self._count(reason, len(bad_lines))
+
+    def add_rows(self, invalid):
+        if invalid.empty:
+            return
+        import pandas as pd
+        raw = [','.join('' if pd.isna(value) else str(value) for value in row)
+               for row in invalid.drop(columns='reason').itertuples(index=False)]
+        self._writer.writerows(zip(invalid.index, invalid['reason'], raw))
+        for reason, n in invalid['reason'].value_counts().items():
+            self._count(reason, int(n))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        if self._tmp_path is not None:
+            os.replace(self._tmp_path, self.path)
+        record_bad_rows(self.counts)
+        if self.counts:
+            print(f"Quarantined {sum(self.counts.values())} bad log rows to {self.path}: {self.counts}")
+
+def _empty_processed_frame():
+    import pandas as pd
+    return pd.DataFrame(columns=REQUIRED_COLUMNS + DERIVED_COLUMNS)
+
+def _concat_rows(frames):
+    """Concatenate processed row frames, keeping categorical columns categorical.
+
+    Categories that depend on the data (e.g. endpoint) differ between
+    chunks, and pandas would otherwise fall back to plain strings.
+    """
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+    frames = list(frames)
+    for col in frames[0].columns:
+        dtypes = [frame[col].dtype for frame in frames]
+        if (all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes)
+                and any(dtype != dtypes[0] for dtype in dtypes)):
+            categories = union_categoricals([frame[col] for frame in frames], ignore_order=True).categories
+            frames = [frame.assign(**{col: frame[col].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def _new_observers():
+    return anomalies.SpikeDetector(), sessions.SessionTracker()
+
+def _publish_observers(observers, log_file=None, position=None):
+    """Publish a detector and tracker, covering log_file up to position when given."""
+    anomalies.publish(observers[0])
+    sessions.publish(observers[1])
+    _observed.clear()
+    if log_file is not None:
+        _observed.update(log=os.path.abspath(log_file), position=position)
+
+@profiled("process_logs")
+def process_logs(log_file=LOG_PATH, regenerate=True, start=None, end=None, sources=None, resume=False,
+                 observers=None):
+    """Validated, enriched rows of log_file, or only of sources (see log_sources).
+
+    The rows are fed to observers; by default a new SpikeDetector and
+    SessionTracker are built from them and published. With resume=True the
+    rows continue an earlier pass, so rejected ones are appended to the
+    quarantine file.
+    """
+    import pandas as pd
+    publish = observers is None
+    if publish:
+        observers = _new_observers()
+    try:
+        chunks = list(iter_processed_chunks(log_file, quarantine_file=QUARANTINE_FILE,
+                                            observers=observers, start=start, end=end,
+                                            sources=sources, append_quarantine=resume))
+    except (FileNotFoundError, pd.errors.EmptyDataError) as e:
         print(f"Error processing logs: {e}")
-        # Generate fresh logs if there's an error
+        # Only a log that was never published (no manifest) and is missing or
+        # empty is replaced with generated data. A published version can go
+        # missing when pruned while pinned, and bad rows in a real log are
+        # quarantined instead.
+        if resume or not regenerate or manifest.read_manifest(log_file) is not None:
+            return _empty_processed_frame()
         from log_generator import generate_logs
-        generate_logs(5000, refresh=True)
-        return process_logs(log_file)
+        generate_logs(5000, output_file=log_file, refresh=True)
+        return process_logs(log_file, regenerate=False, start=start, end=end,
+                            observers=None if publish else observers)
+    except LogFormatError as e:
+        print(f"Error processing logs: {e}")
+        return _empty_processed_frame()
+
+    df = _concat_rows(chunks) if chunks else _empty_processed_frame()
+    if publish:
+        _publish_observers(observers)
+    if resume:
+        return df
+
+    print("Processed data sample:", df[['country', 'plotly_country']].head())
+    print("Unique plotly countries:", df['plotly_country'].unique())
+    
+    return df
+
+# Last processed frame per (log file, start, end), as (_file_signature(),
+# frame, log_sources() position of its last row)
+_processed_cache = {}
+# Held while a cached frame or the published detector and tracker are
+# brought up to date, so new rows are only processed once
+_refresh_lock = threading.RLock()
+# Log and log_sources() position the published detector and tracker cover
+_observed = {}
+
+def _file_signature(log_file):
+    """The log's pinned version id (see manifest.py), or file stats for a log without a manifest."""
+    version, _ = manifest.pinned(log_file)
+    if version is not None:
+        return ("version", version)
+    if partitions.is_partitioned(log_file):
+        return partitions.signature(log_file)
+    try:
+        stat = os.stat(log_file)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def _dataset_version(kind, log_file, signature):
+    """Version string identifying a frame built from log_file in a given way."""
+    if signature is None:
+        return None
+    return f"{kind}:{os.path.abspath(log_file)}:{signature[0]}:{signature[1]}"
+
+def _range_kind(kind, start, end):
+    """kind qualified with a time range, so differently bounded frames never share a version."""
+    if start is None and end is None:
+        return kind
+    return f"{kind}[{start},{end})"
+
+def _versioned(df, kind, log_file, signature):
+    version = _dataset_version(kind, log_file, signature)
+    if version is not None:
+        register_version(df, version)
+    return df
+
+def _cache_hit(cache, key, signature):
+    cached = cache.get(key)
+    if signature is not None and cached is not None and cached[0] == signature:
+        return cached[1]
+    return None
+
+def _update(cached, log_file, start, end):
+    """(sources, position, resumed): the rows added since cached, or the whole log.
+
+    sources is None when the log cannot be read.
+    """
+    if cached is not None and cached[2] is not None:
+        sources, position = log_sources(log_file, start, end, since=cached[2])
+        if sources is not None:
+            return sources, position, True
+        print(f"{log_file} was rewritten or compacted, processing it in full")
+    try:
+        return log_sources(log_file, start, end) + (False,)
+    except FileNotFoundError:
+        # process_logs reports it (and may generate the log)
+        return None, None, False
+
+def _observed_position(log_file):
+    return _observed.get("position") if _observed.get("log") == os.path.abspath(log_file) else None
+
+def _adopt_ingest_observers(log_file):
+    """Publish ingestd.py's detector and tracker of log_file when they are further along."""
+    import copy
+    state = ingest_state.load()
+    if state is None or state.get("log") != os.path.abspath(log_file) or "detector" not in state:
+        return
+    version = state["position"]["version"]
+    pinned_version = manifest.pinned(log_file)[0]
+    if pinned_version is None or version > pinned_version:
+        return
+    position = _observed_position(log_file)
+    if position is not None and position["version"] >= version:
+        return
+    # Copied, as the loaded state is shared with later loads
+    _publish_observers((copy.deepcopy(state["detector"]), copy.deepcopy(state["tracker"])),
+                       log_file, state["position"])
+    print(f"Adopted ingestd's spike detector and sessions of {log_file} version {version}")
+
+def _observers_for(log_file, since, start, end):
+    """Observers to feed during a pass over the rows of log_file after since.
+
+    The published ones when the pass continues exactly where they stopped,
+    new ones for a full pass unless the published ones can be continued
+    instead, and none otherwise (see _observed_to).
+    """
+    if start is not None or end is not None:
+        return ()
+    _adopt_ingest_observers(log_file)
+    observed = _observed_position(log_file)
+    if since is None:
+        try:
+            if observed is not None and log_sources(log_file, since=observed)[0] is not None:
+                return ()
+        except FileNotFoundError:
+            pass
+        return _new_observers()
+    if observed == since:
+        return anomalies.get_detector(), sessions.get_tracker()
+    return ()
+
+def _observed_to(log_file, observers, position):
+    """Record a pass that fed observers up to position, or catch up without one."""
+    if not observers:
+        observe_log(log_file)
+        return
+    _publish_observers(observers, log_file, position)
+
+def observe_log(log_file=LOG_PATH):
+    """Feed the published detector and tracker the rows of log_file they have not seen.
+
+    They are rebuilt from the whole log when they cover another log or one
+    that was rewritten since. ingestd.py's are adopted when further along.
+    """
+    with _refresh_lock:
+        _adopt_ingest_observers(log_file)
+        since = _observed_position(log_file)
+        try:
+            sources, position = (None, None) if since is None else log_sources(log_file, since=since)
+            observers = (anomalies.get_detector(), sessions.get_tracker())
+            if sources is None:
+                sources, position = log_sources(log_file)
+                observers = _new_observers()
+            if position is not None and position == since:
+                return
+            for _ in iter_processed_chunks(log_file, observers=observers, sources=sources):
+                pass
+        except FileNotFoundError:
+            return
+        _observed_to(log_file, observers, position)
 
+def get_processed_logs(log_file=LOG_PATH, start=None, end=None):
+    """Return process_logs() output, reusing it while the file is unchanged.
+
+    When a version only appends rows (see log_sources), just those are
+    processed and added to the cached frame. The returned frame is shared
+    between callers and must not be modified.
+    """
+    key = (log_file, start, end)
+    signature = _file_signature(log_file)
+    df = _cache_hit(_processed_cache, key, signature)
+    if df is not None:
+        inc_metric("processed_logs_cache_hit")
+        return df
+
+    with _refresh_lock:
+        df = _cache_hit(_processed_cache, key, signature)
+        if df is not None:
+            return df
+        inc_metric("processed_logs_cache_miss")
+        cached = _processed_cache.get(key)
+        sources, position, resumed = _update(cached, log_file, start, end)
+        observers = _observers_for(log_file, cached[2] if resumed else None, start, end)
+        if resumed:
+            added = process_logs(log_file, start=start, end=end, sources=sources, resume=True,
+                                 observers=observers)
+            df = _concat_rows([cached[1], added]) if len(added) else cached[1]
+            print(f"Processed {len(added)} new log rows ({len(df)} in total)")
+        else:
+            df = process_logs(log_file, start=start, end=end, sources=sources, observers=observers)
+        _observed_to(log_file, observers, position)
+        if signature is None:
+            # process_logs generated the missing file, so sign it now
+            signature = _file_signature(log_file)
+        # Frames are large, so only the latest range of each file is kept
+        for stale in [k for k in _processed_cache if k[0] == log_file]:
+            del _processed_cache[stale]
+        _processed_cache[key] = (signature, _versioned(df, _range_kind("rows", start, end), log_file, signature),
+                                 position)
+    return df
+
+# "rows" keeps every processed row in memory; "aggregate" streams the log in
+# chunks and keeps only the weighted counts the dashboards need
+INGEST_MODE = os.environ.get("INGEST_MODE", "rows")
+INGEST_MEMORY_LIMIT_MB = float(os.environ.get("INGEST_MEMORY_LIMIT_MB", "256"))
+# Time resolution of aggregated rows (a pandas offset alias)
+AGGREGATE_TIME_FREQ = os.environ.get("AGGREGATE_TIME_FREQ", "D")
+
+# Aggregated frames carry one row per distinct combination of these columns
+# (plus datetime floored to AGGREGATE_TIME_FREQ) and the number of requests
+# it stands for in WEIGHT_COLUMN.
+AGGREGATE_DIMENSIONS = ['plotly_country', 'country', 'age_group', 'user_role',
+                        'request_type', 'status']
+WEIGHT_COLUMN = 'count'
+
+# Enriched chunks hold several temporaries per row while being processed
+CHUNK_MEMORY_OVERHEAD = 4
+MIN_CHUNK_ROWS = 1000
+
+def is_aggregated(df):
+    """Whether df is a weighted frame (aggregates or a sample) rather than raw rows."""
+    return WEIGHT_COLUMN in df.columns
+
+def _sum_weights(df, cols):
+    """Total WEIGHT_COLUMN per group of cols, in whole requests."""
+    counts = df.groupby(cols)[WEIGHT_COLUMN].sum()
+    if counts.dtype.kind == 'f':
+        # Sampled rows carry fractional weights
+        counts = counts.round().astype('int64')
+    return counts
+
+def count_by(df, cols):
+    """Like value_counts().reset_index() over cols, honouring aggregated weights."""
+    if is_aggregated(df):
+        counts = _sum_weights(df, cols)
+    else:
+        counts = df.groupby(cols).size()
+    return counts.sort_values(ascending=False).reset_index(name='count')
+
+def log_sources(log_file, start=None, end=None, since=None):
+    """Reads holding the rows of log_file between start and end, and where they end.
+
+    Returns (sources, position). sources are (path, byte offset past the
+    header, first line number) to pass to read_log_chunks: the pinned
+    version's base file and appended segments (see manifest.py), or for a
+    partition root only the parts whose timestamps overlap [start, end).
+    position records the log version and what it holds, and is None for a
+    log without a manifest. With since, a position from an earlier call,
+    only the rows added after it are listed; sources is then None when the
+    log was rewritten (or a partition compacted) in between.
+    """
+    if partitions.is_partitioned(log_file):
+        # The version is read first, so the parts listed hold at least its rows
+        version = manifest.pinned(log_file)[0]
+        listed = partitions.part_rows(log_file)
+        if not listed and partitions.signature(log_file) is None:
+            raise FileNotFoundError(f"No log partitions in {log_file}")
+        position = {"version": version, "parts": listed}
+        done = {} if since is None else since.get("parts")
+        if done is None or not done.keys() <= listed.keys():
+            return None, position
+        paths = [path for path in partitions.parts(log_file, start, end)
+                 if path in listed and path not in done]
+        return [(path, 0, 2) for path in paths], position
+
+    version, base = manifest.pinned(log_file)
+    segments = manifest.pinned_segments(log_file)
+    if version is None:
+        return (None if since is not None else [(base, 0, 2)]), None
+    # Absolute, as ingestd.py may share the position with a process in another directory
+    position = {"version": version, "base": os.path.abspath(base),
+                "rows": sum(segment["rows"] for segment in segments),
+                "bytes": sum(segment["bytes"] for segment in segments)}
+    if since is None:
+        return [(base, 0, 2)] + [(segment["path"], 0, 2) for segment in segments], position
+    if since.get("base") != position["base"] or since["rows"] > position["rows"]:
+        return None, position
+    # Segments only ever grow at the end or merge in order, so the rows
+    # already seen are a prefix of their lines
+    sources, rows, size = [], 0, 0
+    for segment in segments:
+        if rows + segment["rows"] > since["rows"]:
+            skip_rows = max(since["rows"] - rows, 0)
+            skip_bytes = max(since["bytes"] - size, 0)
+            sources.append((segment["path"], skip_bytes, 2 + skip_rows))
+        rows += segment["rows"]
+        size += segment["bytes"]
+    return sources, position
+
+def position_rows(position):
+    """Rows stored at a log_sources() position, valid and not."""
+    if "parts" in position:
+        return sum(position["parts"].values())
+    return position["rows"]
+
+def _in_range(df, start=None, end=None):
+    """Rows of df with start <= datetime < end."""
+    import pandas as pd
+    if start is not None:
+        df = df[df['datetime'] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df['datetime'] < pd.Timestamp(end)]
+    return df
+
+def chunk_rows_for_memory(log_file, memory_limit_mb=INGEST_MEMORY_LIMIT_MB, sample_rows=1000):
+    """Rows per chunk such that one enriched chunk stays within memory_limit_mb."""
+    sources = log_sources(log_file)[0]
+    if not sources:
+        return MIN_CHUNK_ROWS
+    rows, _ = next(read_log_chunks(sources[0][0], sample_rows), (None, None))
+    if rows is None:
+        return MIN_CHUNK_ROWS
+    sample = enrich_logs(validate_rows(rows)[0])
+    if sample.empty:
+        return MIN_CHUNK_ROWS
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    rows = int(memory_limit_mb * 1024 * 1024 / (bytes_per_row * CHUNK_MEMORY_OVERHEAD))
+    return max(rows, MIN_CHUNK_ROWS)
+
+def iter_processed_chunks(log_file=LOG_PATH, chunk_rows=None, quarantine_file=None,
+                          observers=(), start=None, end=None, sources=None, append_quarantine=False):
+    """Yield validated, enriched chunks of the log, holding one chunk at a time.
+
+    Rejected rows are written to quarantine_file when given (appended with
+    append_quarantine=True), and dropped otherwise (e.g. when re-scanning
+    for an export). Each chunk is also fed to the observe_frame of every
+    observer (e.g. an anomalies.SpikeDetector or a sessions.SessionTracker),
+    timed under the observer's stage name. With start or end, only rows with
+    start <= datetime < end are yielded, and a partitioned log only opens
+    the partitions that can hold them. sources (see log_sources) limits the
+    reads to those.
+    """
+    if sources is None:
+        sources = log_sources(log_file, start, end)[0]
+    if chunk_rows is None:
+        chunk_rows = chunk_rows_for_memory(log_file)
+    bounded = start is not None or end is not None
+    quarantine = None
+    try:
+        for path, offset, first_line in sources:
+            for rows, bad_lines in read_log_chunks(path, chunk_rows, offset, first_line):
+                valid, invalid = validate_rows(rows)
+                if quarantine_file:
+                    if quarantine is None:
+                        quarantine = Quarantine(quarantine_file, append=append_quarantine)
+                    quarantine.add_lines(bad_lines)
+                    quarantine.add_rows(invalid)
+                chunk = enrich_logs(valid)
+                if bounded:
+                    chunk = _in_range(chunk, start, end)
+                for observer in observers:
+                    with stage_timer(observer.stage):
+                        observer.observe_frame(chunk)
+                yield chunk
+    finally:
+        if quarantine is not None:
+            quarantine.close()
+
+AGGREGATE_KEYS = ['datetime'] + AGGREGATE_DIMENSIONS
+
+def _empty_aggregate():
+    import pandas as pd
+    return pd.DataFrame(columns=AGGREGATE_KEYS + [WEIGHT_COLUMN])
+
+def aggregate_rows(rows):
+    """Counts of processed rows per AGGREGATE_DIMENSIONS and datetime bucket."""
+    rows = rows.assign(datetime=rows['datetime'].dt.floor(AGGREGATE_TIME_FREQ))
+    return rows.groupby(AGGREGATE_KEYS, dropna=False).size().reset_index(name=WEIGHT_COLUMN)
+
+def merge_aggregates(parts):
+    """One aggregated frame summing the counts of parts."""
+    import pandas as pd
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return _empty_aggregate()
+    merged = pd.concat(parts, ignore_index=True)
+    return merged.groupby(AGGREGATE_KEYS, dropna=False)[WEIGHT_COLUMN].sum().reset_index()
+
+@profiled("aggregate_logs")
+def aggregate_logs(log_file=LOG_PATH, memory_limit_mb=INGEST_MEMORY_LIMIT_MB, start=None, end=None,
+                   sources=None, resume=False, quarantine_file=QUARANTINE_FILE, observers=None):
+    """Stream the log in memory-bounded chunks and return an aggregated frame.
+
+    Each chunk is enriched exactly as in process_logs, reduced to counts per
+    AGGREGATE_DIMENSIONS and datetime bucket, and discarded. The result's size
+    depends on the number of distinct combinations, not on the log size.
+    sources, resume and observers work as in process_logs.
+    """
+    publish = observers is None
+    if publish:
+        observers = _new_observers()
+    try:
+        chunk_rows = chunk_rows_for_memory(log_file, memory_limit_mb)
+        parts, pending_rows = [], 0
+        for chunk in iter_processed_chunks(log_file, chunk_rows, quarantine_file=quarantine_file,
+                                           observers=observers, start=start, end=end,
+                                           sources=sources, append_quarantine=resume):
+            part = aggregate_rows(chunk)
+            parts.append(part)
+            pending_rows += len(part)
+            # Keep the partial results within one chunk's worth of rows
+            if pending_rows > chunk_rows:
+                parts = [merge_aggregates(parts)]
+                pending_rows = len(parts[0])
+        if publish:
+            _publish_observers(observers)
+        aggregated = merge_aggregates(parts)
+        if not resume:
+            print(f"Aggregated {aggregated[WEIGHT_COLUMN].sum()} log rows into {len(aggregated)} rows")
+        return aggregated
+    except Exception as e:
+        print(f"Error aggregating logs: {e}")
+        return _empty_aggregate()
+
+# As _processed_cache
+_aggregated_cache = {}
+
+def _ingest_state(log_file, signature, start, end):
+    """ingestd.py's running aggregate of log_file when this process can use it, or None.
+
+    It must cover all history at AGGREGATE_TIME_FREQ and be no newer than
+    the pinned version.
+    """
+    if start is not None or end is not None or signature is None or signature[0] != "version":
+        return None
+    state = ingest_state.load()
+    if (state is None or state.get("log") != os.path.abspath(log_file) or state.get("aggregate") is None
+            or state.get("freq") != AGGREGATE_TIME_FREQ or state["position"]["version"] > signature[1]):
+        return None
+    return state
+
+def get_aggregated_logs(log_file=LOG_PATH, start=None, end=None):
+    """Return aggregate_logs() output, reusing it while the file is unchanged.
+
+    A newer running aggregate published by ingestd.py (see ingest_state.py)
+    is adopted as is. Otherwise only the rows added since the cached frame
+    (or ingestd's) are aggregated and merged into it.
+    """
+    key = (log_file, start, end)
+    signature = _file_signature(log_file)
+    df = _cache_hit(_aggregated_cache, key, signature)
+    if df is not None:
+        inc_metric("aggregated_logs_cache_hit")
+        return df
+
+    with _refresh_lock:
+        df = _cache_hit(_aggregated_cache, key, signature)
+        if df is not None:
+            return df
+        inc_metric("aggregated_logs_cache_miss")
+        cached = _aggregated_cache.get(key)
+        state = _ingest_state(log_file, signature, start, end)
+        cached_version = None if cached is None or cached[2] is None else cached[2]["version"]
+        if state is not None and (cached_version is None or state["position"]["version"] > cached_version):
+            cached = (None, state["aggregate"], state["position"])
+            print(f"Adopted ingestd's aggregate of {log_file} version {state['position']['version']}")
+        sources, position, resumed = _update(cached, log_file, start, end)
+        observers = _observers_for(log_file, cached[2] if resumed else None, start, end)
+        if resumed:
+            df = cached[1]
+            if sources:
+                df = merge_aggregates([df, aggregate_logs(log_file, start=start, end=end, sources=sources,
+                                                          resume=True, observers=observers)])
+        else:
+            df = aggregate_logs(log_file, start=start, end=end, sources=sources, observers=observers)
+        _observed_to(log_file, observers, position)
+        kind = _range_kind(f"aggregate-{AGGREGATE_TIME_FREQ}", start, end)
+        for stale in [k for k in _aggregated_cache if k[0] == log_file]:
+            del _aggregated_cache[stale]
+        _aggregated_cache[key] = (signature, _versioned(df, kind, log_file, signature), position)
+    return df
+
+# Only show the last LOG_WINDOW_HOURS of logs (0 shows all history). With a
+# partitioned log, older partitions are then never opened.
+LOG_WINDOW_HOURS = float(os.environ.get("LOG_WINDOW_HOURS", "0"))
+
+def dashboard_window():
+    """Start of the dashboard's time window, or None for all history.
+
+    Rounded down to the hour so the cached frames are reused within it.
+    """
+    if not LOG_WINDOW_HOURS:
+        return None
+    start = datetime.now() - timedelta(hours=LOG_WINDOW_HOURS)
+    return start.replace(minute=0, second=0, microsecond=0)
+
+# In rows mode, logs larger than SAMPLE_THRESHOLD_ROWS are sent to the pages as
+# a stratified sample of about that many rows (0 disables sampling). Each
+# sampled row carries the number of rows it stands for in WEIGHT_COLUMN.
+SAMPLE_THRESHOLD_ROWS = int(os.environ.get("SAMPLE_THRESHOLD_ROWS", "100000"))
+SAMPLE_SEED = int(os.environ.get("SAMPLE_SEED", "0"))
+SAMPLE_STRATA = ['plotly_country', 'request_type']
+
+def sample_logs(df, max_rows=SAMPLE_THRESHOLD_ROWS, seed=SAMPLE_SEED):
+    """Reproducible stratified sample of df per SAMPLE_STRATA.
+
+    Every (country, request type) stratum keeps the same share of its rows,
+    and at least one row, so rare strata still show up. Returns df unchanged
+    when it is within max_rows.
+    """
+    import numpy as np
+    import pandas as pd
+    if not max_rows or len(df) <= max_rows or is_aggregated(df):
+        return df
+    rate = max_rows / len(df)
+    strata = [df[col] for col in SAMPLE_STRATA]
+    sizes = df.groupby(strata, observed=True, dropna=False)[SAMPLE_STRATA[0]].transform('size')
+    quotas = np.maximum(1, np.ceil(sizes * rate))
+    keys = pd.Series(np.random.default_rng(seed).random(len(df)), index=df.index)
+    ranks = keys.groupby(strata, observed=True, dropna=False).rank(method='first')
+    keep = ranks <= quotas
+    sample = df[keep].copy()
+    sample[WEIGHT_COLUMN] = sizes[keep] / quotas[keep]
+    return sample
+
+def is_sampled(df):
+    """Whether df is a weighted sample of raw rows (aggregates have no timestamp)."""
+    return is_aggregated(df) and 'timestamp' in df.columns
+
+def sampling_rate(df):
+    """Fraction of the log's rows present in df (1.0 unless it is a sample)."""
+    if not is_sampled(df) or df.empty:
+        return 1.0
+    return len(df) / df[WEIGHT_COLUMN].sum()
+
+def sampling_note(df):
+    """Title suffix telling the reader that counts are scaled up from a sample."""
+    if not is_sampled(df):
+        return ""
+    return f" (estimated from a {sampling_rate(df):.2%} sample)"
+
+_sample_cache = {}
+
+def get_dashboard_logs(log_file=LOG_PATH):
+    """Frame the pages are fed: raw processed rows, or aggregates in aggregate mode.
+
+    Both cover dashboard_window(). Raw rows beyond SAMPLE_THRESHOLD_ROWS are
+    replaced by sample_logs(). With LOG_BACKEND=sqlite they are read from
+    the store once it has been loaded (see get_store_logs).
+    """
+    start = dashboard_window()
+    store = get_store()
+    if store is not None and log_file == LOG_PATH:
+        df = get_store_logs(store, start)
+        if df is not None:
+            return df
+    if INGEST_MODE == "aggregate":
+        return get_aggregated_logs(log_file, start=start)
+    df = get_processed_logs(log_file, start=start)
+    cached = _sample_cache.get(log_file)
+    if cached is not None and cached[0] is df:
+        return cached[1]
+    with stage_timer("sampling"):
+        sample = sample_logs(df)
+    if sample is not df:
+        print(f"Sampling {len(sample)} of {len(df)} log rows ({sampling_rate(sample):.2%})")
+        kind = _range_kind(f"sample-{SAMPLE_THRESHOLD_ROWS}-{SAMPLE_SEED}", start, None)
+        _versioned(sample, kind, log_file, _processed_cache[(log_file, start, None)][0])
+    _sample_cache[log_file] = (df, sample)
+    return sample
+
+def export_logs_csv(output_file, country=None, log_file=LOG_PATH):
+    """Write processed rows (optionally for one Plotly country) by re-scanning the log.
+
+    Used for exports in aggregate mode, where raw rows are not kept in memory.
+    """
+    header = True
+    with open(output_file, 'w', newline='') as f:
+        for chunk in iter_processed_chunks(log_file, start=dashboard_window()):
+            if country:
+                chunk = chunk[chunk['plotly_country'] == country]
+            chunk.to_csv(f, index=False, header=header)
+            header = False
+    return output_file
+
+# SQL expressions flooring the datetime column to AGGREGATE_TIME_FREQ; other
+# frequencies are floored in pandas after grouping by the full timestamp
+SQL_TIME_FLOOR = {
+    'D': "substr(datetime, 1, 10) || ' 00:00:00'",
+    'h': "substr(datetime, 1, 13) || ':00:00'",
+    'H': "substr(datetime, 1, 13) || ':00:00'",
+    'min': "substr(datetime, 1, 16) || ':00'",
+}
+
+# (store version, window start) -> frame, for the latest of each
+_store_cache = {}
+
+def get_store_logs(store, start=None):
+    """get_dashboard_logs() read from the SQLite store, or None before its first load.
+
+    In aggregate mode the counts are grouped in SQL. Otherwise the rows
+    since start are selected and sampled like the processed frame. The
+    detector and tracker are brought up to date from the log (see
+    observe_log) whenever the store changes, as it holds no state of its own.
+    """
+    version = store.loaded_version()
+    if version is None:
+        if store.path not in _store_cache:
+            print(f"{store.path} has not been loaded yet; run python storage.py load")
+            _store_cache[store.path] = (None, None)
+        return None
+    key = (version, start)
+    cached = _store_cache.get(store.path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    observe_log(LOG_PATH)
+
+    where, params = ("WHERE datetime >= ?", (start.strftime(TIMESTAMP_FORMAT),)) if start else ("", ())
+    signature = ("sqlite", version)
+    with stage_timer("sqlite_query"):
+        if INGEST_MODE == "aggregate":
+            dims = ', '.join(AGGREGATE_DIMENSIONS)
+            bucket = SQL_TIME_FLOOR.get(AGGREGATE_TIME_FREQ, "datetime")
+            df = store.query(f"SELECT {bucket} AS datetime, {dims}, COUNT(*) AS {WEIGHT_COLUMN} "
+                             f"FROM logs {where} GROUP BY 1, {dims}", params)
+            if AGGREGATE_TIME_FREQ not in SQL_TIME_FLOOR:
+                df['datetime'] = df['datetime'].dt.floor(AGGREGATE_TIME_FREQ)
+                df = merge_aggregates([df])
+            kind = f"aggregate-{AGGREGATE_TIME_FREQ}"
+        else:
+            df = sample_logs(store.query(f"SELECT * FROM logs {where}", params))
+            kind = f"sample-{SAMPLE_THRESHOLD_ROWS}-{SAMPLE_SEED}"
+    print(f"Read {len(df)} rows of {store.path} (log version {version})")
+    _versioned(df, _range_kind(kind, start, None), store.path, signature)
+    _store_cache[store.path] = (key, df)
+    return df
+
+def load_store(store, log_file=LOG_PATH):
+    """Replace the store's rows with the whole log, read in chunks; returns (version, rows)."""
+    with writer_lock(store):
+        version = manifest.current(log_file)[0]
+        with stage_timer("sqlite_load"):
+            # A log without a manifest is recorded as version 0
+            rows = store.load(iter_processed_chunks(log_file), version or 0)
+    return version, rows
+
+def append_to_store(store, rows, version, log_file=LOG_PATH):
+    """Add processed rows just published as log version to the store.
+
+    When the store is not at the version before (e.g. another writer
+    published in between), it is reloaded from the log instead.
+    """
+    with writer_lock(store):
+        loaded = store.loaded_version()
+        if loaded == version:
+            return
+        if loaded == version - 1:
+            with stage_timer("sqlite_load"):
+                store.append(rows, version)
+            return
+    print(f"{store.path} is at log version {loaded}, reloading it for version {version}")
+    load_store(store, log_file)
+
+@memoize
 def get_country_data(df, country):
     """Subset dataframe for a specific country."""
     # Convert back from Plotly country name to our name if needed
     original_country = PLOTLY_TO_OUR_COUNTRY.get(country, country)
     return df[df["country"] == original_country]
 
+@memoize
 def get_request_type_counts(df, country=None):
     """Count request types, globally or by country."""
     if country:
         # Convert back from Plotly country name if needed
         original_country = PLOTLY_TO_OUR_COUNTRY.get(country, country)
         df = df[df["country"] == original_country]
-    return df["request_type"].value_counts().reset_index()
+    return count_by(df, "request_type")
 
 def get_country_dataframe(df=None):
     """Prepare country summary dataframe with Plotly-compatible names."""
     if df is None:
-        df = process_logs()
+        df = get_dashboard_logs()
+    return _country_counts(df)
 
+@memoize
+def _country_counts(df):
+    import pandas as pd
     if df.empty or 'plotly_country' not in df.columns:
         return pd.DataFrame({'country': [], 'count': []})
 
-    counts = df['plotly_country'].value_counts().reset_index()
+    counts = count_by(df, 'plotly_country')
     counts.columns = ['country', 'count']
     return counts
 
+@memoize
 def get_demographic_data(df, demographic_type='age_group', countries=None):
     """Return demographic stats."""
     if countries:
@@ -150,10 +1176,46 @@ def get_demographic_data(df, demographic_type='age_group', countries=None):
         df = df[df['country'].isin(original_countries)]
 
     if demographic_type == 'age_group':
-        return df['age_group'].value_counts().reset_index()
+        return count_by(df, 'age_group')
     else:
-        return df['user_role'].value_counts().reset_index()
+        return count_by(df, 'user_role')
+
+# Dimensions of the pre-aggregated table sent to the browser
+CUBE_DIMENSIONS = ['plotly_country', 'age_group', 'user_role', 'request_type']
 
+def _encode_array(values, dtype):
+    import base64
+    import numpy as np
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+@memoize
+def get_dimension_counts(df):
+    """Request counts per combination of CUBE_DIMENSIONS, the aggregate most figures start from."""
+    return count_by(df, CUBE_DIMENSIONS)
+
+def get_demographic_cube(df):
+    """Request counts per (country, age group, role, request type) for clientside use.
+
+    Each dimension is dictionary-encoded: its labels plus a base64 array of
+    little-endian codes. Counts are a base64 uint32 array. The browser decodes
+    these into typed arrays and filters and sums them without a round trip.
+    """
+    import pandas as pd
+    counts = get_dimension_counts(df)
+
+    cube = {'length': len(counts), 'dimensions': {}}
+    for col in CUBE_DIMENSIONS:
+        codes, labels = pd.factorize(counts[col], sort=True)
+        dtype = '<u1' if len(labels) <= 0xff else '<u2'
+        cube['dimensions'][col] = {
+            'labels': [str(label) for label in labels],
+            'dtype': 'uint8' if dtype == '<u1' else 'uint16',
+            'codes': _encode_array(codes, dtype),
+        }
+    cube['counts'] = _encode_array(counts['count'].to_numpy(), '<u4')
+    return cube
+
+@memoize
 def get_crossfilter_data(df, x_col, y_col):
     """Cross-tabulate x and y columns."""
     # Handle case where x_col or y_col is country (need to use plotly_country)
@@ -161,11 +1223,16 @@ def get_crossfilter_data(df, x_col, y_col):
         x_col = 'plotly_country'
     if y_col == 'country':
         y_col = 'plotly_country'
-        
-    return df.groupby([x_col, y_col]).size().reset_index(name='count')
 
+    return count_by(df, [x_col, y_col])
+
+@memoize
 def calculate_statistics(df, groupby_col=None):
     """Calculate general or grouped statistics."""
+    import pandas as pd
+    if is_aggregated(df):
+        return _calculate_statistics_counted(df, groupby_col)
+
     if groupby_col and groupby_col != 'overall':
         # Handle country case specially
         if groupby_col == 'country':
@@ -199,4 +1266,57 @@ def calculate_statistics(df, groupby_col=None):
             ]
         })
 
-    return stats
\ No newline at end of file
+    return stats
+
+def _grouped_counts(source, cols):
+    """Request counts per distinct combination of cols of a weighted frame, as columns cols + ['n']."""
+    return _sum_weights(source, cols).reset_index(name='n')
+
+def _modes(source, col, groupby_col=None):
+    """Most common value of col (smallest on ties, like Series.mode()[0]), per group."""
+    import pandas as pd
+    if groupby_col == col:
+        # Every group's mode is its own key
+        values = _grouped_counts(source, [col])[col]
+        return pd.Series(values.values, index=values.values)
+    keys = [groupby_col] if groupby_col else []
+    counts = _grouped_counts(source, keys + [col])
+    if counts.empty:
+        return pd.Series(dtype=object) if groupby_col else 'N/A'
+    counts = counts.sort_values(['n', col], ascending=[False, True])
+    if not groupby_col:
+        return counts[col].iloc[0]
+    return counts.drop_duplicates(groupby_col).set_index(groupby_col)[col]
+
+def _calculate_statistics_counted(source, groupby_col=None):
+    """calculate_statistics() for an aggregated or sampled frame."""
+    import pandas as pd
+    if groupby_col and groupby_col != 'overall':
+        if groupby_col == 'country':
+            groupby_col = 'plotly_country'
+
+        totals = _grouped_counts(source, [groupby_col]).sort_values(groupby_col).set_index(groupby_col)
+        stats = pd.DataFrame({
+            'age_group_mode': _modes(source, 'age_group', groupby_col),
+            'user_role_mode': _modes(source, 'user_role', groupby_col),
+            'request_type_mode': _modes(source, 'request_type', groupby_col),
+        }).reindex(totals.index).fillna('N/A')
+        stats['count'] = totals['n']
+        stats = stats.rename_axis(groupby_col).reset_index()
+
+        if groupby_col == 'plotly_country':
+            stats = stats.rename(columns={'plotly_country': 'country'})
+        return stats
+
+    countries = _grouped_counts(source, ['plotly_country'])
+    return pd.DataFrame({
+        'Metric': ['Total Users', 'Unique Countries', 'Most Common Age Group',
+                   'Most Common Role', 'Most Common Request Type'],
+        'Value': [
+            int(countries['n'].sum()),
+            len(countries),
+            _modes(source, 'age_group'),
+            _modes(source, 'user_role'),
+            _modes(source, 'request_type'),
+        ]
+    })
\ No newline at end of file